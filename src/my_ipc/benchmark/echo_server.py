@@ -0,0 +1,43 @@
+import sys
+from typing import Any, Dict, Iterable, Union
+
+import numpy as np
+from my_ipc.ipc_server import IPCServer
+from my_ipc.public import ShmArray
+
+
+class EchoServer(IPCServer):
+    """
+    基准测试使用的服务器
+    op 为 "echo" 时原样返回 data；"tmp_shm" 时把结果写入 tmp_shm；"read_shared" 时拷贝出共享数组 name
+    流式请求重复 n 次返回 item
+    """
+
+    def __init__(self, id: str):
+        super().__init__(id)
+        # tmp_shm 的结果，按形状缓存，不把分配内存的时间计入传输
+        self._outputs: Dict[int, np.ndarray] = {}
+
+    def handle_request(
+        self, request: Dict[str, Any], tmp_shm: Union[ShmArray, None]
+    ) -> Dict[str, Any]:
+        op = request.get("op", "echo")
+        if op == "tmp_shm":
+            assert tmp_shm is not None
+            nbytes = tmp_shm.info.nbytes
+            if nbytes not in self._outputs:
+                self._outputs = {nbytes: np.ones(tmp_shm.info.shape, tmp_shm.info.dtype)}
+            tmp_shm.write(self._outputs[nbytes])
+            return {}
+        if op == "read_shared":
+            return {"nbytes": self.get_shared_array(request["name"]).read().nbytes}
+        return {"data": request.get("data")}
+
+    def handle_stream_request(self, request: Dict[str, Any]) -> Iterable[Dict[str, Any]]:
+        item = request.get("item", {})
+        for _ in range(request["n"]):
+            yield item
+
+
+if __name__ == "__main__":
+    EchoServer(sys.argv[1]).start_server()
@@ -0,0 +1,20 @@
+import sys
+from typing import Any, Dict, Iterable
+
+from my_ipc.ipc_server_embedded import IPCServer
+
+
+class EchoServer(IPCServer):
+    """与 echo_server.EchoServer 相同，只支持 "echo" 和流式请求"""
+
+    def handle_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
+        return {"data": request.get("data")}
+
+    def handle_stream_request(self, request: Dict[str, Any]) -> Iterable[Dict[str, Any]]:
+        item = request.get("item", {})
+        for _ in range(request["n"]):
+            yield item
+
+
+if __name__ == "__main__":
+    EchoServer(sys.argv[1]).start_server()
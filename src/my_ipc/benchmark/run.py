@@ -0,0 +1,296 @@
+"""
+IPC 基准测试，结果以 JSON 输出，便于比较不同提交的性能
+
+    python -m my_ipc.benchmark.run -o before.json
+    python -m my_ipc.benchmark.run -o after.json --compare before.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess as sp
+import sys
+import time
+from typing import Any, Callable, Dict, List, Union
+
+import numpy as np
+from my_ipc.ipc_client import IPCClient
+from my_ipc.ipc_client_embedded import IPCClient as EmbeddedIPCClient
+from my_ipc.public import ShmArrayInfo
+
+SERVER_CMDS = {
+    "full": f"{sys.executable} -m my_ipc.benchmark.echo_server {{id}}",
+    "embedded": f"{sys.executable} -m my_ipc.benchmark.echo_server_embedded {{id}}",
+}
+CLIENTS = {"full": IPCClient, "embedded": EmbeddedIPCClient}
+SUITES = ("latency", "tmp_shm", "shared_array", "stream", "startup")
+
+# 小请求为一个很小的 dict，大请求为约 1MB 的 JSON 可编码数据
+PAYLOADS = {
+    "small": {"a": 1, "b": "x"},
+    "large": {"tokens": list(range(100_000)), "text": "x" * (512 * 1024)},
+}
+
+
+def summarize(seconds: List[float]) -> Dict[str, float]:
+    """每次操作耗时（秒）的统计"""
+    arr = np.asarray(seconds)
+    return {
+        "n": len(arr),
+        "mean": float(arr.mean()),
+        "p50": float(np.percentile(arr, 50)),
+        "p90": float(np.percentile(arr, 90)),
+        "p99": float(np.percentile(arr, 99)),
+        "min": float(arr.min()),
+        "max": float(arr.max()),
+    }
+
+
+def timed(fn: Callable[[], Any], n: int, warmup: int) -> List[float]:
+    for _ in range(warmup):
+        fn()
+    seconds = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    return seconds
+
+
+def sizes_between(min_bytes: int, max_bytes: int) -> List[int]:
+    """min_bytes 到 max_bytes 之间每 4 倍取一个大小"""
+    sizes = []
+    size = min_bytes
+    while size <= max_bytes:
+        sizes.append(size)
+        size *= 4
+    return sizes
+
+
+def iterations_for(nbytes: int, budget_bytes: int, lo: int = 3, hi: int = 200) -> int:
+    """大数据少跑几次，使每个大小传输的总字节数约为 budget_bytes"""
+    return max(lo, min(hi, budget_bytes // max(nbytes, 1)))
+
+
+def bench_latency(args: argparse.Namespace) -> Dict[str, Any]:
+    """小请求和大请求的往返延迟，完整客户端和嵌入式客户端分别测试"""
+    results: Dict[str, Any] = {}
+    for kind in args.clients:
+        client = CLIENTS[kind](SERVER_CMDS[kind])
+        try:
+            for name, payload in PAYLOADS.items():
+                n = args.iterations if name == "small" else max(10, args.iterations // 20)
+                request = {"op": "echo", "data": payload}
+                seconds = timed(lambda: client.send_request(request), n, warmup=min(n, 20))
+                results[f"{kind}/{name}"] = summarize(seconds)
+        finally:
+            client.close()
+    return results
+
+
+def bench_tmp_shm(args: argparse.Namespace) -> Dict[str, Any]:
+    """服务器把结果写入 tmp_shm、客户端拷贝出来的带宽"""
+    results: Dict[str, Any] = {}
+    client = IPCClient(SERVER_CMDS["full"])
+    try:
+        for nbytes in sizes_between(args.min_bytes, args.max_bytes):
+            info = ShmArrayInfo((nbytes,), np.uint8)
+            request = {"op": "tmp_shm"}
+            n = iterations_for(nbytes, args.budget_bytes)
+            seconds = timed(lambda: client.send_request(request, tmp_shm=info), n, warmup=1)
+            stats = summarize(seconds)
+            stats["bytes"] = nbytes
+            stats["gb_per_s"] = nbytes / stats["p50"] / 1e9
+            results[str(nbytes)] = stats
+    finally:
+        client.close()
+    return results
+
+
+def bench_shared_array(args: argparse.Namespace) -> Dict[str, Any]:
+    """客户端写入持久共享数组、服务器拷贝出来的带宽"""
+    results: Dict[str, Any] = {}
+    client = IPCClient(SERVER_CMDS["full"])
+    try:
+        for nbytes in sizes_between(args.min_bytes, args.max_bytes):
+            info = ShmArrayInfo((nbytes,), np.uint8)
+            if "bench" in client.shm_arrs:
+                shm_arr = client.resize_shared_array("bench", info)
+            else:
+                shm_arr = client.register_shared_array("bench", info)
+            data = np.ones(nbytes, np.uint8)
+            request = {"op": "read_shared", "name": "bench"}
+
+            def transfer():
+                shm_arr.write(data)
+                client.send_request(request)
+
+            seconds = timed(transfer, iterations_for(nbytes, args.budget_bytes), warmup=1)
+            stats = summarize(seconds)
+            stats["bytes"] = nbytes
+            stats["gb_per_s"] = nbytes / stats["p50"] / 1e9
+            results[str(nbytes)] = stats
+            del data
+    finally:
+        client.close()
+    return results
+
+
+def bench_stream(args: argparse.Namespace) -> Dict[str, Any]:
+    """流式请求每秒的数据个数：完整客户端（socket 与环形缓冲区）和嵌入式客户端"""
+    results: Dict[str, Any] = {}
+    n = args.stream_items
+    request = {"n": n, "item": {"i": 1, "text": "x" * 64}}
+    for kind in args.clients:
+        client = CLIENTS[kind](SERVER_CMDS[kind])
+        try:
+            variants: Dict[str, Dict[str, Any]] = {"socket": {}}
+            if kind == "full":
+                variants["ring"] = {"ring_bytes": 1 << 22}
+            for variant, kwargs in variants.items():
+
+                def consume():
+                    for _ in client.send_stream_request(request, **kwargs):
+                        pass
+
+                seconds = timed(consume, 3, warmup=1)
+                stats = summarize(seconds)
+                stats["items"] = n
+                stats["items_per_s"] = n / stats["p50"]
+                results[f"{kind}/{variant}"] = stats
+        finally:
+            client.close()
+    return results
+
+
+def bench_startup(args: argparse.Namespace) -> Dict[str, Any]:
+    """从启动服务器进程到完成握手的时间"""
+    results: Dict[str, Any] = {}
+    for kind in args.clients:
+        clients = []
+
+        def start():
+            clients.append(CLIENTS[kind](SERVER_CMDS[kind]))
+
+        try:
+            seconds = timed(start, args.startup_iterations, warmup=1)
+        finally:
+            for client in clients:
+                client.close()
+        results[kind] = summarize(seconds)
+    return results
+
+
+BENCHMARKS: Dict[str, Callable[[argparse.Namespace], Dict[str, Any]]] = {
+    "latency": bench_latency,
+    "tmp_shm": bench_tmp_shm,
+    "shared_array": bench_shared_array,
+    "stream": bench_stream,
+    "startup": bench_startup,
+}
+
+
+def environment() -> Dict[str, Any]:
+    """记录结果对应的提交和运行环境"""
+    commit: Union[str, None] = None
+    try:
+        commit = sp.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, sp.CalledProcessError):
+        pass
+    return {
+        "commit": commit,
+        "time": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    """把嵌套的结果展开为 "suite/case/field" -> 数值"""
+    flat: Dict[str, float] = {}
+    for key, value in results.items():
+        path = f"{prefix}/{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, path))
+        elif isinstance(value, (int, float)):
+            flat[path] = value
+    return flat
+
+
+# 比较时关注的字段：耗时越小越好，吞吐越大越好
+_LOWER_IS_BETTER = ("p50", "p99")
+_HIGHER_IS_BETTER = ("gb_per_s", "items_per_s")
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any]) -> List[str]:
+    """逐项比较两次结果，返回可打印的行；比值大于 1 表示当前更好"""
+    old = flatten(baseline["results"])
+    new = flatten(current["results"])
+    lines = [f"{'指标':<48} {'基线':>12} {'当前':>12} {'提升':>8}"]
+    for path, value in new.items():
+        field = path.rsplit("/", 1)[-1]
+        if path not in old or field not in _LOWER_IS_BETTER + _HIGHER_IS_BETTER:
+            continue
+        if not old[path] or not value:
+            continue
+        ratio = old[path] / value if field in _LOWER_IS_BETTER else value / old[path]
+        lines.append(f"{path:<48} {old[path]:>12.4g} {value:>12.4g} {ratio:>7.2f}x")
+    return lines
+
+
+def main(argv: Union[List[str], None] = None):
+    parser = argparse.ArgumentParser(description="my_ipc 基准测试")
+    parser.add_argument("-o", "--output", help="结果 JSON 的路径，默认输出到标准输出")
+    parser.add_argument("--suites", nargs="+", choices=SUITES, default=list(SUITES))
+    parser.add_argument("--clients", nargs="+", choices=tuple(CLIENTS), default=list(CLIENTS))
+    parser.add_argument("--iterations", type=int, default=2000, help="小请求延迟的测试次数")
+    parser.add_argument("--min-bytes", type=int, default=4 << 10)
+    parser.add_argument("--max-bytes", type=int, default=1 << 30)
+    parser.add_argument(
+        "--budget-bytes", type=int, default=4 << 30, help="每个大小大约传输的总字节数"
+    )
+    parser.add_argument("--stream-items", type=int, default=20000)
+    parser.add_argument("--startup-iterations", type=int, default=5)
+    parser.add_argument("--quick", action="store_true", help="缩小规模，用于快速检查")
+    parser.add_argument("--compare", help="与之前保存的结果 JSON 比较")
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.iterations = min(args.iterations, 200)
+        args.max_bytes = min(args.max_bytes, 16 << 20)
+        args.budget_bytes = min(args.budget_bytes, 256 << 20)
+        args.stream_items = min(args.stream_items, 2000)
+        args.startup_iterations = min(args.startup_iterations, 2)
+
+    report: Dict[str, Any] = {
+        "environment": environment(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "results": {},
+    }
+    for suite in args.suites:
+        print(f"运行 {suite} ...", file=sys.stderr)
+        report["results"][suite] = BENCHMARKS[suite](args)
+
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print("\n".join(compare(baseline, report)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,142 +1,736 @@
-from multiprocessing import shared_memory
+from concurrent.futures import Future
+import itertools
+import queue
 import subprocess as sp
-import json
-import os
 import socket
+import threading
 import time
-from typing import Any, Dict, Iterable, Union, cast, overload, Tuple
+from typing import Any, Dict, Iterator, Sequence, Union, cast, overload, Tuple
 import uuid
 
 import numpy as np
+from my_ipc.ipc_client_cache import ResponseCache, request_key
+from my_ipc.ipc_metrics import Metrics, write_trace
 from my_ipc.public import (
+    ArrayTransport,
+    CODECS,
+    DEFAULT_CODECS,
+    IPCChannel,
+    IPCMessage,
     IPCMessageType,
     ShmArrayInfo,
     ShmArray,
+    ShmArrayPool,
+    ShmAttachCache,
+    ShmSlot,
+    SHM_ARRAY_THRESHOLD,
+    ShmSlotArray,
+    ShmRing,
+    ServerStartError,
+    _size_class,
+    connect_when_ready,
     generate_socket_path,
     generate_shm_name,
-    recv_str,
-    send_str,
+    spawn_server,
+    open_shm_array,
+    raise_for_error,
+    schedule_meta,
+    tcp_connect,
 )
 
+# 远程连接推送共享数组内容时每条 SHM_UPDATE 消息的最大字节数
+SHM_SYNC_CHUNK_BYTES = 4 << 20
+
+
+class PendingRequests:
+    """按请求 id 记录等待响应的 Future（普通请求）或 Queue（流式请求）"""
+
+    def __init__(self):
+        self._waiters: Dict[int, Union[Future, "queue.Queue[IPCMessage]"]] = {}
+        self._lock = threading.Lock()
+        self._next_id = itertools.count(1)
+
+    def register(self, waiter: Union[Future, "queue.Queue[IPCMessage]"]) -> int:
+        req_id = next(self._next_id)
+        with self._lock:
+            self._waiters[req_id] = waiter
+        return req_id
+
+    def discard(self, req_id: int) -> bool:
+        """不再等待该请求，返回等待者是否仍在记录中（没有收到响应也没有因断开而失败）"""
+        with self._lock:
+            return self._waiters.pop(req_id, None) is not None
+
+    def dispatch(self, msg: IPCMessage):
+        with self._lock:
+            waiter = self._waiters.get(msg.id)
+            if isinstance(waiter, Future):
+                del self._waiters[msg.id]
+        if waiter is None:
+            # 已经被放弃的流的剩余消息
+            return
+        if isinstance(waiter, Future):
+            waiter.set_result(msg)
+        else:
+            waiter.put(msg)
+
+    def fail_all(self, error: str):
+        with self._lock:
+            waiters, self._waiters = list(self._waiters.values()), {}
+        for waiter in waiters:
+            if isinstance(waiter, Future):
+                waiter.set_exception(ConnectionError(error))
+            else:
+                waiter.put(IPCMessage(IPCMessageType.ERROR, data=error))
+
+
+def prepare_tmp_shm(
+    tmp_shm_pool: ShmArrayPool, tmp_shm: Union[ShmArrayInfo, None]
+) -> Tuple[Union[ShmArray, None], Union[Dict[str, Any], None]]:
+    """从池中取出 tmp_shm 使用的共享内存段，并生成 REQUEST 消息的 meta"""
+    if tmp_shm is None:
+        return None, None
+    tmp_shm_arr = tmp_shm_pool.acquire(tmp_shm)
+    tmp_shm_arr.writing = True
+    meta = {
+        "tmp_shm": {
+            "info": tmp_shm.to_json(),
+            "name": tmp_shm_arr.name,
+            # 通知服务器解除已被淘汰段的映射
+            "evicted": tmp_shm_pool.pop_evicted(),
+        }
+    }
+    return tmp_shm_arr, meta
+
+
+def prepare_shm_update(
+    client_id: str,
+    shm_arrs: Dict[str, ShmArray],
+    op: str,
+    name: str,
+    info: Union[ShmArrayInfo, None] = None,
+    capacity: Union[int, None] = None,
+    memfd: bool = False,
+) -> Dict[str, Any]:
+    """
+    在客户端执行共享数组的注册、调整大小或注销，并生成 SHM_UPDATE 消息的 data
+    新建的共享内存段按 2 的幂预留容量（多槽数组为每个槽的容量），之后不超过容量的 resize 只需通知服务器新的形状
+    新建了 memfd 时 data 中带有 "fd"，需要随消息发送该数组的文件描述符
+    """
+    if op == "unregister":
+        shm_arrs.pop(name).close()
+        return {"op": op, "name": name}
+    assert info is not None
+    size = info.segment_size(max(info.nbytes, capacity or 0, _size_class(info.nbytes)))
+    shm_name = generate_shm_name(client_id, f"{name}_{uuid.uuid4().hex[:8]}")
+    if op == "register":
+        assert name not in shm_arrs, f"共享数组 {name} 已存在"
+        shm_arrs[name] = open_shm_array(info, shm_name, create=True, size=size, memfd=memfd)
+        created = True
+    else:
+        shm_arr = shm_arrs[name]
+        created = info.nbytes > shm_arr.capacity
+        if created:
+            shm_arr.remap(info, shm_name, create=True, size=size)
+        else:
+            shm_arr.resize(info)
+    update = {
+        "op": op,
+        "name": name,
+        "info": info.to_json(),
+        "shm_name": shm_arrs[name].name,
+    }
+    if created and shm_arrs[name].fd is not None:
+        update["fd"] = 0
+    return update
+
+
+def unpack_response(
+    msg: IPCMessage,
+    tmp_shm_arr: Union[ShmArray, None],
+    tmp_shm_pool: ShmArrayPool,
+    copy: bool,
+    metrics: Union[Metrics, None] = None,  # 设置后记录 tmp_shm 结果的拷贝耗时
+):
+    """把 RESPONSE/ERROR 消息转换为 send_request 的返回值，并归还 tmp_shm 使用的共享内存段"""
+    if tmp_shm_arr is not None:
+        tmp_shm_arr.writing = False
+    if msg.type == IPCMessageType.ERROR:
+        if tmp_shm_arr is not None:
+            tmp_shm_pool.release(tmp_shm_arr)
+        raise_for_error(msg, "请求")
+    if msg.meta and msg.meta.get("tmp_shm") == "inline":
+        # 远程服务器随响应发来的结果，已经在本端独立的接收缓冲区中
+        response, tmp_data = msg.data
+        return response, tmp_data
+    if tmp_shm_arr is None:
+        return msg.data
+    if copy:
+        start = time.perf_counter_ns()
+        tmp_data = tmp_shm_arr.read()
+        if metrics is not None:
+            metrics.observe("shm_copy", start, id=msg.id)
+            metrics.add("shm_copy_bytes", tmp_data.nbytes)
+    else:
+        tmp_data = tmp_shm_arr.view()
+    tmp_shm_pool.release(tmp_shm_arr)
+    return msg.data, tmp_data
+
+
+def cache_key(
+    namespace: Union[str, None],
+    kind: str,
+    request: Dict[str, Any],
+    tmp_shm: Union[ShmArrayInfo, None],
+    shm_arrs: Dict[str, ShmArray],
+    shared_array_names: Sequence[str],
+) -> str:
+    """
+    请求在 ResponseCache 中的键：服务器命令（或 id）、请求类型、request、tmp_shm 的形状，
+    以及 shared_array_names 中各共享数组的当前内容
+    """
+    contents = []
+    for name in shared_array_names:
+        shm_arr = shm_arrs[name]
+        if isinstance(shm_arr, ShmSlotArray):
+            raise TypeError(f"多槽共享数组 {name} 不能参与缓存键的计算")
+        info = shm_arr.get_info()
+        contents.append((name, np.ndarray(info.shape, dtype=info.dtype, buffer=shm_arr.shm.buf)))
+    return request_key(
+        namespace, kind, request, None if tmp_shm is None else tmp_shm.to_json(), contents
+    )
+
+
+def _read_loop(channel: IPCChannel, pending: PendingRequests):
+    """后台接收线程：按请求 id 把响应分发给对应的等待者；不引用 IPCClient，以免阻止其被回收"""
+    try:
+        while True:
+            pending.dispatch(channel.recv())
+    except (ConnectionError, OSError) as e:
+        pending.fail_all(f"连接已断开: {e}")
+
 
 class IPCClient:
 
     def __init__(
         self,
-        server_cmd: str,  # 启动服务器的命令，需包含 {id} 占位符
+        server_cmd: Union[str, None],  # 启动服务器的命令，需包含 {id} 占位符
         shm_arrs: Union[Dict[str, ShmArrayInfo], ShmArrayInfo] = {},
         max_wait: int = 60,
+        tmp_shm_pool_bytes: int = 1 << 30,  # 空闲临时共享内存的缓存上限，0 表示不复用
+        server_id: Union[str, None] = None,  # server_cmd 为 None 时，连接该 id 的已有服务器
+        codecs: Sequence[str] = DEFAULT_CODECS,  # 按优先级提供给服务器选择的消息编解码器
+        shm_backend: str = "posix",  # 共享数组使用 /dev/shm 中的具名共享内存（"posix"）或 "memfd"
+        cache: Union[ResponseCache, None] = None,  # 设置后相同的请求直接返回缓存的响应
+        cache_shared_arrays: Sequence[str] = (),  # 服务器会读取的共享数组，它们的内容也计入缓存键
+        metrics: bool = False,  # 记录各阶段耗时和收发的字节数，见 get_stats；每次收发都有额外开销
+        address: Union[str, None] = None,  # server_cmd 为 None 时，连接该 TCP 地址（host:port）上的服务器
     ):
+        assert shm_backend in ("posix", "memfd"), f"未知的共享内存后端: {shm_backend}"
         self.id = uuid.uuid4().hex
-        self.socket_path = generate_socket_path(self.id)
+        # 通过 TCP 连接的服务器可能在另一台机器上，不使用共享内存：数组随消息发送，
+        # 共享数组在请求之前把变化的内容推送给服务器，tmp_shm 的结果随响应发回
+        self.remote = server_cmd is None and address is not None
+        # memfd 通过 SCM_RIGHTS 传给服务器，没有名字冲突，进程退出后由内核回收；需要服务器为 IPCServer
+        self.memfd = shm_backend == "memfd"
+        self.cache = cache
+        self.cache_shared_arrays = list(cache_shared_arrays)
+        # 使用同一个服务器命令的客户端（例如 IPCClientPool 的各进程）共享缓存的条目
+        self.cache_namespace = next(
+            key for key in (server_cmd, server_id, address) if key is not None
+        )
+        self.metrics = Metrics() if metrics else None
+        self.socket_path = generate_socket_path(
+            self.id if server_id is None else server_id
+        )
         if isinstance(shm_arrs, ShmArrayInfo):
             shm_arrs = {"default": shm_arrs}
         self.shm_arrs: Dict[str, ShmArray] = {
-            name: ShmArray(
-                info=shm_arr, name=generate_shm_name(self.id, name), create=True
+            name: open_shm_array(
+                shm_arr, generate_shm_name(self.id, name), create=True, memfd=self.memfd
             )
             for name, shm_arr in shm_arrs.items()
         }
+        self.tmp_shm_pool = ShmArrayPool(self.id, max_bytes=tmp_shm_pool_bytes)
+        # 服务器通过共享内存发来的大数组的映射缓存
+        self.array_cache = ShmAttachCache(max_bytes=tmp_shm_pool_bytes)
 
-        # 启动服务器进程
-        cmd = server_cmd.format(id=self.id)
-        self.process = sp.Popen(cmd, shell=True, executable="/bin/bash")
-
-        # 等待服务器就绪
-        wait_time = 0
-        while wait_time < max_wait:
-            if os.path.exists(self.socket_path):
-                break
-            if self.process.poll() is not None:
-                raise RuntimeError("服务器进程意外退出")
-            time.sleep(1)
-            wait_time += 1
-
-        if not os.path.exists(self.socket_path):
-            self.process.terminate()
-            raise RuntimeError("服务器启动超时")
-
-        # 连接socket
-        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.socket.connect(self.socket_path)
-
-        shm_infos = {
-            name: shm_arr.get_info().to_json()
-            for name, shm_arr in self.shm_arrs.items()
-        }
-        send_str(self.socket, json.dumps(shm_infos))
+        if server_cmd is not None:
+            # 启动服务器进程，服务器 listen 后通过管道通知，无需轮询 socket 文件
+            self.process, ready_r = spawn_server(server_cmd.format(id=self.id))
+            try:
+                self.socket = connect_when_ready(ready_r, self.socket_path, max_wait)
+            except ServerStartError as e:
+                if self.process.poll() is None:
+                    self.process.terminate()
+                raise ServerStartError(f"{e}，返回码 {self.process.wait()}") from None
+        elif self.remote:
+            self.socket = tcp_connect(cast(str, address), max_wait)
+        else:
+            assert server_id is not None, "server_cmd、server_id 和 address 至少需要提供一个"
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(self.socket_path)
+
+        self.channel = IPCChannel(self.socket)
+
+        shm_infos: Dict[str, Dict[str, Any]] = {}
+        fds = []
+        # 远程连接：推送共享数组中被改写的部分时持有
+        self._sync_lock = threading.Lock()
+        for name, shm_arr in self.shm_arrs.items():
+            shm_infos[name] = {"info": shm_arr.get_info().to_json(), "name": shm_arr.name}
+            if self.remote:
+                shm_infos[name]["size"] = shm_arr.shm.size
+                shm_arr.mark_dirty()
+            elif shm_arr.fd is not None:
+                shm_infos[name]["fd"] = len(fds)
+                fds.append(shm_arr.fd)
+        self.channel.send(
+            IPCMessage(
+                IPCMessageType.INIT,
+                data={"shm_arrs": shm_infos, "codecs": list(codecs), "arrays": True},
+            ),
+            fds,
+        )
+        # 服务器回复选定的编解码器，之后的消息都使用二进制帧
+        reply = self.channel.recv()
+        self.channel.codec = CODECS[reply.data["codec"]]
+        if reply.data.get("arrays"):
+            # 服务器支持时，请求和响应中的 NumPy 数组自动传输，大数组经过共享内存（远程连接时都在帧中）
+            self.channel.arrays = ArrayTransport(
+                self.tmp_shm_pool,
+                self.array_cache,
+                threshold=None if self.remote else SHM_ARRAY_THRESHOLD,
+            )
+        # 服务器支持流的 CREDIT/CANCEL
+        self.flow_control = bool(reply.data.get("flow_control"))
+        # 服务器支持 STATS 消息
+        self.server_stats = bool(reply.data.get("stats"))
+        # 服务器支持 register/resize/unregister_shared_array
+        self.server_shared_arrays = bool(reply.data.get("shared_arrays"))
+        self.channel.metrics = self.metrics
+
+        self.pending = PendingRequests()
+        self._reader = threading.Thread(
+            target=_read_loop, args=(self.channel, self.pending), daemon=True
+        )
+        self._reader.start()
+
+    def _cache_key(
+        self, kind: str, request: Dict[str, Any], tmp_shm: Union[ShmArrayInfo, None] = None
+    ) -> str:
+        return cache_key(
+            self.cache_namespace, kind, request, tmp_shm, self.shm_arrs, self.cache_shared_arrays
+        )
 
     @overload
     def send_request(self, request: Dict[str, Any]) -> Dict[str, Any]: ...
 
     @overload
     def send_request(
-        self, request: Dict[str, Any], tmp_shm: ShmArrayInfo
+        self, request: Dict[str, Any], tmp_shm: ShmArrayInfo, copy: bool = True
     ) -> Tuple[Dict[str, Any], np.ndarray]: ...
 
     def send_request(
-        self, request: Dict[str, Any], tmp_shm: Union[ShmArrayInfo, None] = None
+        self,
+        request: Dict[str, Any],
+        tmp_shm: Union[ShmArrayInfo, None] = None,
+        copy: bool = True,
+        slots: Sequence[ShmSlot] = (),
+        use_cache: bool = True,
+        priority: int = 0,
+        timeout: Union[float, None] = None,
     ):
-        tmp_shm_arr = None
-        if tmp_shm is not None:
-            tmp_name = uuid.uuid4().hex
-            tmp_shm_arr = ShmArray(
-                info=tmp_shm,
-                name=generate_shm_name(self.id, tmp_name),
-                create=True,
-            )
-            send_str(self.socket, IPCMessageType.TMP_SHARED_ARRAY.value)
-            send_str(
-                self.socket,
-                json.dumps(
-                    {
-                        "info": tmp_shm.to_json(),
-                        "name": tmp_name,
-                    }
-                ),
-            )
+        """
+        request 和响应中任意位置的 NumPy 数组会自动传输，较大的数组经过共享内存，
+        接收方得到只读零拷贝视图
+        copy: 为 False 时 tmp_shm 的结果以只读零拷贝视图返回，
+              视图存活期间临时共享内存不会被释放
+        slots: 该请求使用的多槽共享数组的槽，收到响应后归还；槽的下标需要由 request 告诉服务器
+        use_cache: 为 False 时绕过 cache，既不读取也不写入；使用 slots 的请求总是绕过
+        priority: 服务器上同时排队的请求中优先级大的先处理
+        timeout: 发出请求后超过 timeout 秒服务器仍未开始处理时不再处理，抛出 DeadlineExceededError
+        """
+        return self.submit(
+            request,
+            tmp_shm=tmp_shm,
+            copy=copy,
+            slots=slots,
+            use_cache=use_cache,
+            priority=priority,
+            timeout=timeout,
+        ).result()
 
-        send_str(self.socket, json.dumps(request))
-        response_data = recv_str(self.socket)
-        if response_data == "ERROR":
-            raise RuntimeError("服务器处理请求时出错")
-        if tmp_shm is not None:
-            tmp_shm_arr = cast(ShmArray, tmp_shm_arr)
-            tmp_data = tmp_shm_arr.read()
-            tmp_shm_arr.close()
-            return json.loads(response_data), tmp_data
+    def submit(
+        self,
+        request: Dict[str, Any],
+        tmp_shm: Union[ShmArrayInfo, None] = None,
+        copy: bool = True,
+        slots: Sequence[ShmSlot] = (),
+        use_cache: bool = True,
+        priority: int = 0,
+        timeout: Union[float, None] = None,
+    ) -> Future:
+        """
+        发送请求但不等待响应，返回的 Future 的结果与 send_request 的返回值相同
+        同一个客户端可以同时提交多个请求，服务器可能乱序返回响应
+        """
+        result: Future = Future()
+        cache = self.cache if use_cache and not slots else None
+        key = None
+        if cache is not None:
+            key = self._cache_key("request", request, tmp_shm)
+            found, response = cache.get(key)
+            if found:
+                result.set_result(response)
+                return result
+        if self.remote and tmp_shm is not None:
+            # 服务器在自己的共享内存中准备 tmp_shm，结果随响应发回
+            tmp_shm_arr, meta = None, {"tmp_shm": {"info": tmp_shm.to_json()}}
         else:
-            return json.loads(response_data)
+            tmp_shm_arr, meta = prepare_tmp_shm(self.tmp_shm_pool, tmp_shm)
+        meta = schedule_meta(meta, priority, timeout)
+        tmp_shm_pool = self.tmp_shm_pool
+        metrics = self.metrics
+        start = time.perf_counter_ns()
+
+        def on_response(raw: Future):
+            for slot in slots:
+                slot.release()
+            try:
+                msg = cast(IPCMessage, raw.result())
+                response = unpack_response(msg, tmp_shm_arr, tmp_shm_pool, copy, metrics)
+            except Exception as e:
+                result.set_exception(e)
+                return
+            finally:
+                if metrics is not None:
+                    metrics.observe("round_trip", start, id=req_id)
+            if cache is not None:
+                cache.put(cast(str, key), response)
+            result.set_result(response)
+
+        raw: Future = Future()
+        raw.add_done_callback(on_response)
+        req_id = self.pending.register(raw)
+        try:
+            if self.remote:
+                self._sync_shared_arrays()
+            self.channel.send(IPCMessage(IPCMessageType.REQUEST, req_id, request, meta))
+        except BaseException:
+            # 请求没有发出：不再等待它的响应，归还 tmp_shm 使用的段
+            if self.pending.discard(req_id):
+                # 否则连接断开时 on_response 已经释放了 slots
+                for slot in slots:
+                    slot.release()
+            if tmp_shm_arr is not None:
+                tmp_shm_arr.writing = False
+                tmp_shm_pool.release(tmp_shm_arr)
+            raise
+        return result
 
     def send_stream_request(
-        self, request: Dict[str, Any]
-    ) -> Iterable[Dict[str, Any]]:
-        """发送流式请求，返回一个迭代器，每次迭代返回一个响应"""
-        send_str(self.socket, IPCMessageType.STREAM_REQUEST.value)
-        send_str(self.socket, json.dumps(request))
-        
-        while True:
-            response_type = recv_str(self.socket)
-            if response_type == IPCMessageType.STREAM_END.value:
-                break
-            elif response_type == IPCMessageType.ERROR.value:
-                raise RuntimeError("服务器处理流式请求时出错")
-            elif response_type == IPCMessageType.STREAM_DATA.value:
-                response_data = recv_str(self.socket)
-                yield json.loads(response_data)
-            else:
-                raise RuntimeError(f"未知的响应类型: {response_type}")
+        self,
+        request: Dict[str, Any],
+        ring_bytes: Union[int, None] = None,
+        window: Union[int, None] = 64,
+        use_cache: bool = True,
+        priority: int = 0,
+        timeout: Union[float, None] = None,
+    ) -> Iterator[Any]:
+        """
+        发送流式请求，返回一个迭代器，每次迭代返回一个响应
+        请求在调用时立即发出，因此可以同时进行多个流和普通请求
+        提前结束迭代（break 或关闭迭代器）时通知服务器停止生成器，连接可以继续使用
+        ring_bytes: 设置后服务器把流数据写入该大小的共享内存环形缓冲区，每个数据不再需要系统调用；
+                    NumPy 数组以只读零拷贝视图、bytes 以 memoryview 返回，它们只在取下一个数据之前有效；
+                    服务器不支持时自动退回普通方式
+        window: 服务器最多领先客户端消费的数据个数，None 表示不限；使用环形缓冲区时由缓冲区大小限制
+        use_cache: 设置了 cache 时，命中则重放缓存的流而不发送请求，否则完整迭代结束后缓存整个流
+        priority, timeout: 见 send_request；timeout 只限制流开始生成之前的排队时间
+        """
+        meta = schedule_meta(None, priority, timeout)
+        if self.cache is None or not use_cache:
+            return self._send_stream_request(request, ring_bytes, window, meta)
+        key = self._cache_key("stream", request)
+        replay = self.cache.replay_stream(key)
+        if replay is not None:
+            return replay
+        responses = self._send_stream_request(request, ring_bytes, window, meta)
+        return self.cache.record_stream(key, responses)
+
+    def _send_stream_request(
+        self,
+        request: Dict[str, Any],
+        ring_bytes: Union[int, None],
+        window: Union[int, None],
+        meta: Union[Dict[str, Any], None] = None,
+    ) -> Iterator[Any]:
+        responses: "queue.Queue[IPCMessage]" = queue.Queue()
+        req_id = self.pending.register(responses)
+        if self.remote:
+            # 远程连接不能使用共享内存环形缓冲区
+            ring_bytes = None
+            self._sync_shared_arrays()
+        if ring_bytes is None:
+            if self.flow_control and window is not None:
+                meta = {**(meta or {}), "window": window}
+            self.channel.send(IPCMessage(IPCMessageType.STREAM_REQUEST, req_id, request, meta))
+            return self._iter_stream(req_id, responses, window)
+        ring = ShmRing(
+            generate_shm_name(self.id, f"ring_{req_id}"), size=ring_bytes, create=True
+        )
+        try:
+            self.channel.send(
+                IPCMessage(
+                    IPCMessageType.STREAM_REQUEST,
+                    req_id,
+                    request,
+                    {**(meta or {}), "ring": {"name": ring.name}},
+                )
+            )
+        except BaseException:
+            self.pending.discard(req_id)
+            ring.close()
+            raise
+        return self._iter_ring_stream(req_id, responses, ring)
+
+    def _iter_stream(
+        self, req_id: int, responses: "queue.Queue[IPCMessage]", window: Union[int, None]
+    ) -> Iterator[Dict[str, Any]]:
+        ended = False
+        # 攒够半个窗口再补充额度，减少 CREDIT 消息
+        consumed, credit_batch = 0, max(1, (window or 0) // 2)
+        try:
+            while True:
+                msg = responses.get()
+                if msg.type == IPCMessageType.STREAM_END:
+                    ended = True
+                    break
+                elif msg.type == IPCMessageType.ERROR:
+                    ended = True
+                    raise_for_error(msg, "流式请求")
+                elif msg.type == IPCMessageType.STREAM_DATA:
+                    if self.metrics is not None:
+                        self.metrics.add("stream_items")
+                    yield msg.data
+                    consumed += 1
+                    if self.flow_control and window is not None and consumed >= credit_batch:
+                        self.channel.send(IPCMessage(IPCMessageType.CREDIT, req_id, consumed))
+                        consumed = 0
+                else:
+                    raise RuntimeError(f"未知的响应类型: {msg.type}")
+        finally:
+            # 提前结束迭代时，之后到达的该流的消息会被接收线程丢弃
+            self.pending.discard(req_id)
+            if not ended and self.flow_control:
+                try:
+                    self.channel.send(IPCMessage(IPCMessageType.CANCEL, req_id))
+                except OSError:
+                    pass
+
+    def _iter_ring_stream(
+        self, req_id: int, responses: "queue.Queue[IPCMessage]", ring: ShmRing
+    ) -> Iterator[Any]:
+        codec = self.channel.codec
+        assert codec is not None
+        ended = False
+        try:
+            while True:
+                found, item = ring.get(codec)
+                if found:
+                    if self.metrics is not None:
+                        self.metrics.add("stream_items")
+                    yield item
+                    continue
+                if ended:
+                    break
+                # 缓冲区为空：先短暂自旋，再登记等待并阻塞到服务器唤醒
+                for _ in range(200):
+                    if ring.has_data():
+                        break
+                else:
+                    if ring.begin_wait():
+                        continue
+                    try:
+                        # 设置超时以防唤醒丢失（生产者和消费者之间没有内存屏障）
+                        msg = responses.get(timeout=0.01)
+                    except queue.Empty:
+                        continue
+                    if msg.type == IPCMessageType.STREAM_END:
+                        # STREAM_END 之前写入的数据都已可见，读完后结束
+                        ended = True
+                    elif msg.type == IPCMessageType.ERROR:
+                        raise_for_error(msg, "流式请求")
+                    elif msg.type == IPCMessageType.STREAM_DATA:
+                        if not (msg.meta and "ring" in msg.meta):
+                            # 服务器不支持环形缓冲区，流数据仍通过 socket 发送
+                            if self.metrics is not None:
+                                self.metrics.add("stream_items")
+                            yield msg.data
+                    else:
+                        raise RuntimeError(f"未知的响应类型: {msg.type}")
+        finally:
+            ring.abandon()
+            self.pending.discard(req_id)
+            if not ended and self.flow_control:
+                # 服务器不支持环形缓冲区、退回普通方式时，同样需要通知它停止生成器
+                try:
+                    self.channel.send(IPCMessage(IPCMessageType.CANCEL, req_id))
+                except OSError:
+                    pass
+            ring.close()
 
     def get_shared_array(self, name: str = "default") -> ShmArray:
         return self.shm_arrs[name]
 
+    def register_shared_array(
+        self,
+        name: str,
+        info: ShmArrayInfo,
+        capacity: Union[int, None] = None,  # 预留的字节数，默认向上取整到 2 的幂
+    ) -> ShmArray:
+        """在连接过程中新增共享数组，返回后服务器已完成映射"""
+        self._check_shared_arrays()
+        try:
+            self._update_shared_array("register", name, info, capacity)
+        except RuntimeError:
+            self.shm_arrs.pop(name).close()
+            raise
+        return self.shm_arrs[name]
+
+    def resize_shared_array(self, name: str, info: ShmArrayInfo) -> ShmArray:
+        """
+        改变共享数组的形状或类型，不超过容量时双方都不需要重新映射，之前的内容保持不变；
+        超过容量时换用更大的共享内存段，原内容不会被复制
+        已有的 ShmArray 引用继续有效；调用期间不应有请求正在使用该数组
+        """
+        self._check_shared_arrays()
+        self._update_shared_array("resize", name, info)
+        return self.shm_arrs[name]
+
+    def unregister_shared_array(self, name: str):
+        """注销共享数组，双方解除映射"""
+        self._check_shared_arrays()
+        self._update_shared_array("unregister", name)
+
+    def _check_shared_arrays(self):
+        if not self.server_shared_arrays:
+            raise RuntimeError("服务器不支持在连接过程中更新共享数组")
+
+    def _update_shared_array(
+        self,
+        op: str,
+        name: str,
+        info: Union[ShmArrayInfo, None] = None,
+        capacity: Union[int, None] = None,
+    ):
+        # 与 _sync_shared_arrays 互斥：服务器先收到数组的更新，再收到它的内容
+        with self._sync_lock:
+            update = prepare_shm_update(
+                self.id, self.shm_arrs, op, name, info, capacity, self.memfd
+            )
+            fds = [cast(int, self.shm_arrs[name].fd)] if "fd" in update else []
+            if self.remote:
+                # 服务器按 size 创建自己的副本，内容在下一个请求之前推送
+                fds = []
+                update.pop("fd", None)
+                if op != "unregister":
+                    update["size"] = self.shm_arrs[name].shm.size
+                    self.shm_arrs[name].mark_dirty()
+            raw: Future = Future()
+            req_id = self.pending.register(raw)
+            self.channel.send(IPCMessage(IPCMessageType.SHM_UPDATE, req_id, update), fds)
+        msg = cast(IPCMessage, raw.result())
+        if msg.type == IPCMessageType.ERROR:
+            raise RuntimeError(f"服务器更新共享数组时出错: {msg.data}")
+
+    def _sync_shared_arrays(self):
+        """
+        远程连接：把上次推送之后被改写的字节范围（见 ShmArray.mark_dirty）通过 SHM_UPDATE 发给服务器
+        按 SHM_SYNC_CHUNK_BYTES 分块，直接引用共享内存而不拷贝
+        """
+        with self._sync_lock:
+            for name, shm_arr in list(self.shm_arrs.items()):
+                dirty = shm_arr.take_dirty()
+                if dirty is None:
+                    continue
+                start, end = dirty
+                buf = np.frombuffer(shm_arr.shm.buf, np.uint8)
+                for offset in range(start, end, SHM_SYNC_CHUNK_BYTES):
+                    data = buf[offset : min(end, offset + SHM_SYNC_CHUNK_BYTES)]
+                    update = {"op": "sync", "name": name, "offset": offset, "data": data}
+                    self.channel.send(IPCMessage(IPCMessageType.SHM_UPDATE, 0, update))
+                    del data
+                del buf
+
+    def get_stats(self, reset: bool = False) -> Dict[str, Any]:
+        """
+        客户端的性能统计，见 Metrics.snapshot
+        阶段：serialize、send、deserialize（编解码和收发，含数组的自动传输）、
+              round_trip（请求发出到收到响应）、shm_copy（拷贝 tmp_shm 的结果）
+        计数器：messages_sent/received、bytes_sent/received、stream_items、shm_copy_bytes
+        """
+        assert self.metrics is not None, "未开启性能统计"
+        return self.metrics.snapshot(reset)
+
+    def get_server_stats(self, reset: bool = False) -> Dict[str, Any]:
+        """通过 STATS 消息读取服务器的性能统计，见 IPCServer.get_stats"""
+        return self._query_stats({"reset": reset})["stats"]
+
+    def start_trace(self, max_events: int = 1 << 20, server: bool = True):
+        """开始记录 trace 事件（每个阶段一个事件），server 时服务器同时开始记录"""
+        assert self.metrics is not None, "未开启性能统计"
+        if server:
+            self._query_stats({"trace": "start", "max_events": max_events})
+        self.metrics.start_trace(max_events)
+
+    def export_trace(self, path: str, server: bool = True) -> int:
+        """
+        停止记录，把客户端（以及 server 时服务器）的 trace 事件合并写入 path，返回事件数
+        写入的是 Chrome trace 格式，可以用 Perfetto 或 chrome://tracing 打开，客户端和服务器各占一行进程
+        """
+        assert self.metrics is not None, "未开启性能统计"
+        events = self.metrics.stop_trace()
+        if server:
+            events += self._query_stats({"trace": "stop"})["trace"]
+        write_trace(path, events)
+        return len(events)
+
+    def _query_stats(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        if not self.server_stats:
+            raise RuntimeError("服务器不支持 STATS 消息")
+        raw: Future = Future()
+        req_id = self.pending.register(raw)
+        self.channel.send(IPCMessage(IPCMessageType.STATS, req_id, data))
+        msg = cast(IPCMessage, raw.result())
+        if msg.type == IPCMessageType.ERROR:
+            raise RuntimeError(f"服务器读取性能统计时出错: {msg.data}")
+        return msg.data
+
+    def is_alive(self) -> bool:
+        """连接未断开，且（由本客户端启动时）服务器进程仍在运行"""
+        if hasattr(self, "process") and self.process.poll() is not None:
+            return False
+        return self._reader.is_alive()
+
     def close(self):
-        if hasattr(self, "socket"):
+        if hasattr(self, "channel"):
             try:
-                send_str(self.socket, "QUIT")
+                self.channel.send(IPCMessage(IPCMessageType.QUIT))
             except Exception:
                 pass
+        if hasattr(self, "socket"):
+            try:
+                # 唤醒接收线程
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.socket.close()
+        if hasattr(self, "_reader") and self._reader is not threading.current_thread():
+            self._reader.join()
+        if hasattr(self, "channel") and self.channel.arrays is not None:
+            self.channel.arrays.close()
         if hasattr(self, "process"):
             try:
                 self.process.wait(timeout=5)
@@ -146,6 +740,10 @@ class IPCClient:
         if hasattr(self, "shm_arrs"):
             for shm_arr in self.shm_arrs.values():
                 shm_arr.close()
+        if hasattr(self, "tmp_shm_pool"):
+            self.tmp_shm_pool.close()
+        if hasattr(self, "array_cache"):
+            self.array_cache.close()
 
     def __del__(self):
         self.close()
@@ -0,0 +1,441 @@
+import asyncio
+import itertools
+import os
+import traceback
+from typing import Any, AsyncIterator, Dict, Iterator, Sequence, Union, overload, Tuple
+import uuid
+
+import numpy as np
+from my_ipc.ipc_client import cache_key, prepare_shm_update, prepare_tmp_shm, unpack_response
+from my_ipc.ipc_client_cache import ResponseCache
+from my_ipc.public import (
+    ArrayTransport,
+    CODECS,
+    READY_FD_ENV,
+    DEFAULT_CODECS,
+    Codec,
+    IPCMessage,
+    IPCMessageType,
+    ShmArrayInfo,
+    ShmArray,
+    ShmArrayPool,
+    ShmAttachCache,
+    ShmSlot,
+    ServerStartError,
+    async_recv_message,
+    async_send_message,
+    generate_socket_path,
+    generate_shm_name,
+    connect_when_ready,
+    open_shm_array,
+    raise_for_error,
+    schedule_meta,
+)
+
+
+class AsyncIPCClient:
+    """
+    基于 asyncio 的 IPCClient，协议与 IPCClient 相同
+    使用前需要 await start()（或 async with / await AsyncIPCClient.create(...)），使用后 await close()
+    """
+
+    def __init__(
+        self,
+        server_cmd: Union[str, None],  # 启动服务器的命令，需包含 {id} 占位符
+        shm_arrs: Union[Dict[str, ShmArrayInfo], ShmArrayInfo] = {},
+        max_wait: int = 60,
+        tmp_shm_pool_bytes: int = 1 << 30,  # 空闲临时共享内存的缓存上限，0 表示不复用
+        server_id: Union[str, None] = None,  # server_cmd 为 None 时，连接该 id 的已有服务器
+        codecs: Sequence[str] = DEFAULT_CODECS,  # 按优先级提供给服务器选择的消息编解码器
+        cache: Union[ResponseCache, None] = None,  # 见 IPCClient
+        cache_shared_arrays: Sequence[str] = (),
+    ):
+        assert server_cmd is not None or server_id is not None, (
+            "server_cmd 和 server_id 至少需要提供一个"
+        )
+        self.id = uuid.uuid4().hex
+        self.server_cmd = server_cmd
+        self.max_wait = max_wait
+        self.codecs = list(codecs)
+        self.codec: Union[Codec, None] = None
+        self.cache = cache
+        self.cache_shared_arrays = list(cache_shared_arrays)
+        self.cache_namespace = server_cmd if server_cmd is not None else server_id
+        self.socket_path = generate_socket_path(
+            self.id if server_id is None else server_id
+        )
+        if isinstance(shm_arrs, ShmArrayInfo):
+            shm_arrs = {"default": shm_arrs}
+        self.shm_arrs: Dict[str, ShmArray] = {
+            name: open_shm_array(shm_arr, generate_shm_name(self.id, name), create=True)
+            for name, shm_arr in shm_arrs.items()
+        }
+        self.tmp_shm_pool = ShmArrayPool(self.id, max_bytes=tmp_shm_pool_bytes)
+        self.array_cache = ShmAttachCache(max_bytes=tmp_shm_pool_bytes)
+        self.arrays: Union[ArrayTransport, None] = None
+        # 请求 id -> 等待响应的 Future（普通请求）或 Queue（流式请求）
+        self._pending: Dict[int, Union[asyncio.Future, "asyncio.Queue[IPCMessage]"]] = {}
+        self._next_id = itertools.count(1)
+        self._closed = False
+
+    @classmethod
+    async def create(cls, *args, **kwargs) -> "AsyncIPCClient":
+        client = cls(*args, **kwargs)
+        await client.start()
+        return client
+
+    async def start(self):
+        if self.server_cmd is not None:
+            # 启动服务器进程，服务器 listen 后通过管道通知，无需轮询 socket 文件
+            cmd = self.server_cmd.format(id=self.id)
+            ready_r, ready_w = os.pipe()
+            try:
+                self.process = await asyncio.create_subprocess_shell(
+                    cmd,
+                    executable="/bin/bash",
+                    pass_fds=(ready_w,),
+                    env={**os.environ, READY_FD_ENV: str(ready_w)},
+                )
+            except BaseException:
+                os.close(ready_r)
+                raise
+            finally:
+                os.close(ready_w)
+            try:
+                sock = await asyncio.get_running_loop().run_in_executor(
+                    None, connect_when_ready, ready_r, self.socket_path, self.max_wait
+                )
+            except ServerStartError as e:
+                if self.process.returncode is None:
+                    self.process.terminate()
+                raise ServerStartError(f"{e}，返回码 {await self.process.wait()}") from None
+            self.reader, self.writer = await asyncio.open_unix_connection(sock=sock)
+        else:
+            self.reader, self.writer = await asyncio.open_unix_connection(self.socket_path)
+
+        shm_infos = {
+            name: {"info": shm_arr.get_info().to_json(), "name": shm_arr.name}
+            for name, shm_arr in self.shm_arrs.items()
+        }
+        async_send_message(
+            self.writer,
+            IPCMessage(
+                IPCMessageType.INIT,
+                data={"shm_arrs": shm_infos, "codecs": self.codecs, "arrays": True},
+            ),
+        )
+        await self.writer.drain()
+        # 服务器回复选定的编解码器，之后的消息都使用二进制帧
+        reply = await async_recv_message(self.reader)
+        self.codec = CODECS[reply.data["codec"]]
+        if reply.data.get("arrays"):
+            self.arrays = ArrayTransport(self.tmp_shm_pool, self.array_cache)
+        # 服务器支持流的 CREDIT/CANCEL
+        self.flow_control = bool(reply.data.get("flow_control"))
+        # 服务器支持 register/resize/unregister_shared_array
+        self.server_shared_arrays = bool(reply.data.get("shared_arrays"))
+        self._read_task = asyncio.ensure_future(self._read_loop())
+
+    async def __aenter__(self) -> "AsyncIPCClient":
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def _read_loop(self):
+        """按请求 id 把响应分发给对应的等待者"""
+        try:
+            while True:
+                msg = await async_recv_message(self.reader, self.codec, self.arrays)
+                waiter = self._pending.get(msg.id)
+                if waiter is None:
+                    # 已经被放弃的流的剩余消息
+                    continue
+                if isinstance(waiter, asyncio.Future):
+                    del self._pending[msg.id]
+                    if not waiter.done():
+                        waiter.set_result(msg)
+                else:
+                    waiter.put_nowait(msg)
+        except (ConnectionError, OSError) as e:
+            exc: Exception = ConnectionError(f"连接已断开: {e}")
+        except Exception as e:
+            # 例如消息无法解码：之后的数据无法再按帧解析，关闭连接，使后续请求立即失败
+            traceback.print_exc()
+            exc = e
+            self.writer.close()
+        waiters, self._pending = list(self._pending.values()), {}
+        for waiter in waiters:
+            if isinstance(waiter, asyncio.Future):
+                if not waiter.done():
+                    waiter.set_exception(exc)
+            else:
+                waiter.put_nowait(IPCMessage(IPCMessageType.ERROR, data=str(exc)))
+
+    def _cache_key(
+        self, kind: str, request: Dict[str, Any], tmp_shm: Union[ShmArrayInfo, None] = None
+    ) -> str:
+        return cache_key(
+            self.cache_namespace, kind, request, tmp_shm, self.shm_arrs, self.cache_shared_arrays
+        )
+
+    @overload
+    async def send_request(self, request: Dict[str, Any]) -> Dict[str, Any]: ...
+
+    @overload
+    async def send_request(
+        self, request: Dict[str, Any], tmp_shm: ShmArrayInfo, copy: bool = True
+    ) -> Tuple[Dict[str, Any], np.ndarray]: ...
+
+    async def send_request(
+        self,
+        request: Dict[str, Any],
+        tmp_shm: Union[ShmArrayInfo, None] = None,
+        copy: bool = True,
+        slots: Sequence[ShmSlot] = (),
+        use_cache: bool = True,
+        priority: int = 0,
+        timeout: Union[float, None] = None,
+    ):
+        """与 IPCClient.send_request 相同，等待期间不阻塞事件循环"""
+        cache = self.cache if use_cache and not slots else None
+        if cache is not None:
+            key = self._cache_key("request", request, tmp_shm)
+            found, cached = cache.get(key)
+            if found:
+                return cached
+        tmp_shm_arr, meta = prepare_tmp_shm(self.tmp_shm_pool, tmp_shm)
+        meta = schedule_meta(meta, priority, timeout)
+        req_id = next(self._next_id)
+        response: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._pending[req_id] = response
+        sent = False
+        try:
+            async_send_message(
+                self.writer,
+                IPCMessage(IPCMessageType.REQUEST, req_id, request, meta),
+                self.codec,
+                self.arrays,
+            )
+            sent = True
+            await self.writer.drain()
+            msg = await response
+        except BaseException:
+            # 发送失败或等待被取消（例如 asyncio.wait_for 超时）
+            self._abandon_request(req_id, tmp_shm_arr, sent)
+            raise
+        finally:
+            for slot in slots:
+                slot.release()
+        result = unpack_response(msg, tmp_shm_arr, self.tmp_shm_pool, copy)
+        if cache is not None:
+            cache.put(key, result)
+        return result
+
+    def _abandon_request(self, req_id: int, tmp_shm_arr: Union[ShmArray, None], sent: bool):
+        """
+        放弃等待请求的响应：不再记录它的等待者，并把 tmp_shm 使用的段归还到池中
+        请求已经发出时服务器可能仍在写入该段，等它的响应到达（或连接断开）之后再归还
+        """
+        if tmp_shm_arr is None or not sent:
+            self._pending.pop(req_id, None)
+            if tmp_shm_arr is not None:
+                tmp_shm_arr.writing = False
+                self.tmp_shm_pool.release(tmp_shm_arr)
+            return
+        late: asyncio.Future = asyncio.get_running_loop().create_future()
+
+        def release(_):
+            tmp_shm_arr.writing = False
+            self.tmp_shm_pool.release(tmp_shm_arr)
+
+        late.add_done_callback(release)
+        if req_id in self._pending:
+            self._pending[req_id] = late
+        else:
+            # 连接已经断开，不会再收到响应
+            late.cancel()
+
+    def send_stream_request(
+        self,
+        request: Dict[str, Any],
+        window: Union[int, None] = 64,
+        use_cache: bool = True,
+        priority: int = 0,
+        timeout: Union[float, None] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        发送流式请求，返回一个异步迭代器，使用 async for 遍历响应
+        请求在调用时立即写入发送缓冲区；window、use_cache、priority、timeout
+        以及提前结束迭代时的取消与 IPCClient.send_stream_request 相同
+        """
+        meta = schedule_meta(None, priority, timeout)
+        if self.cache is None or not use_cache:
+            return self._send_stream_request(request, window, meta)
+        key = self._cache_key("stream", request)
+        replay = self.cache.replay_stream(key)
+        if replay is not None:
+            return _replay(replay)
+        return self.cache.record_stream_async(
+            key, self._send_stream_request(request, window, meta)
+        )
+
+    def _send_stream_request(
+        self,
+        request: Dict[str, Any],
+        window: Union[int, None],
+        meta: Union[Dict[str, Any], None] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        req_id = next(self._next_id)
+        responses: "asyncio.Queue[IPCMessage]" = asyncio.Queue()
+        self._pending[req_id] = responses
+        if self.flow_control and window is not None:
+            meta = {**(meta or {}), "window": window}
+        async_send_message(
+            self.writer,
+            IPCMessage(IPCMessageType.STREAM_REQUEST, req_id, request, meta),
+            self.codec,
+            self.arrays,
+        )
+        return self._iter_stream(req_id, responses, window)
+
+    async def _iter_stream(
+        self,
+        req_id: int,
+        responses: "asyncio.Queue[IPCMessage]",
+        window: Union[int, None],
+    ) -> AsyncIterator[Dict[str, Any]]:
+        ended = False
+        # 攒够半个窗口再补充额度，减少 CREDIT 消息
+        consumed, credit_batch = 0, max(1, (window or 0) // 2)
+        try:
+            await self.writer.drain()
+            while True:
+                msg = await responses.get()
+                if msg.type == IPCMessageType.STREAM_END:
+                    ended = True
+                    break
+                elif msg.type == IPCMessageType.ERROR:
+                    ended = True
+                    raise_for_error(msg, "流式请求")
+                elif msg.type == IPCMessageType.STREAM_DATA:
+                    yield msg.data
+                    consumed += 1
+                    if self.flow_control and window is not None and consumed >= credit_batch:
+                        async_send_message(
+                            self.writer,
+                            IPCMessage(IPCMessageType.CREDIT, req_id, consumed),
+                            self.codec,
+                            self.arrays,
+                        )
+                        consumed = 0
+                else:
+                    raise RuntimeError(f"未知的响应类型: {msg.type}")
+        finally:
+            # 提前结束迭代时，之后到达的该流的消息会被丢弃
+            self._pending.pop(req_id, None)
+            if not ended and self.flow_control and not self.writer.is_closing():
+                async_send_message(
+                    self.writer,
+                    IPCMessage(IPCMessageType.CANCEL, req_id),
+                    self.codec,
+                    self.arrays,
+                )
+
+    def get_shared_array(self, name: str = "default") -> ShmArray:
+        return self.shm_arrs[name]
+
+    async def register_shared_array(
+        self, name: str, info: ShmArrayInfo, capacity: Union[int, None] = None
+    ) -> ShmArray:
+        """与 IPCClient.register_shared_array 相同"""
+        self._check_shared_arrays()
+        try:
+            await self._update_shared_array("register", name, info, capacity)
+        except RuntimeError:
+            self.shm_arrs.pop(name).close()
+            raise
+        return self.shm_arrs[name]
+
+    async def resize_shared_array(self, name: str, info: ShmArrayInfo) -> ShmArray:
+        """与 IPCClient.resize_shared_array 相同"""
+        self._check_shared_arrays()
+        await self._update_shared_array("resize", name, info)
+        return self.shm_arrs[name]
+
+    async def unregister_shared_array(self, name: str):
+        """与 IPCClient.unregister_shared_array 相同"""
+        self._check_shared_arrays()
+        await self._update_shared_array("unregister", name)
+
+    def _check_shared_arrays(self):
+        if not self.server_shared_arrays:
+            raise RuntimeError("服务器不支持在连接过程中更新共享数组")
+
+    async def _update_shared_array(
+        self,
+        op: str,
+        name: str,
+        info: Union[ShmArrayInfo, None] = None,
+        capacity: Union[int, None] = None,
+    ):
+        update = prepare_shm_update(self.id, self.shm_arrs, op, name, info, capacity)
+        req_id = next(self._next_id)
+        response: asyncio.Future = asyncio.get_running_loop().create_future()
+        self._pending[req_id] = response
+        async_send_message(
+            self.writer,
+            IPCMessage(IPCMessageType.SHM_UPDATE, req_id, update),
+            self.codec,
+            self.arrays,
+        )
+        await self.writer.drain()
+        msg = await response
+        if msg.type == IPCMessageType.ERROR:
+            raise RuntimeError(f"服务器更新共享数组时出错: {msg.data}")
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if hasattr(self, "writer"):
+            try:
+                async_send_message(
+                    self.writer, IPCMessage(IPCMessageType.QUIT), self.codec, self.arrays
+                )
+                await self.writer.drain()
+            except Exception:
+                pass
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+        if hasattr(self, "_read_task"):
+            await self._read_task
+        if hasattr(self, "process"):
+            try:
+                await asyncio.wait_for(self.process.wait(), timeout=5)
+            except asyncio.TimeoutError:
+                self.process.terminate()
+                await asyncio.wait_for(self.process.wait(), timeout=5)
+        self._close_shm()
+
+    def _close_shm(self):
+        for shm_arr in self.shm_arrs.values():
+            shm_arr.close()
+        if self.arrays is not None:
+            self.arrays.close()
+        self.tmp_shm_pool.close()
+        self.array_cache.close()
+
+    def __del__(self):
+        # 无法在这里等待事件循环，只释放共享内存
+        if hasattr(self, "tmp_shm_pool"):
+            self._close_shm()
+
+
+async def _replay(responses: Iterator[Any]) -> AsyncIterator[Any]:
+    for response in responses:
+        yield response
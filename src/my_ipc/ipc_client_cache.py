@@ -0,0 +1,297 @@
+from collections import OrderedDict
+import hashlib
+import os
+import pickle
+import re
+import struct
+import threading
+import time
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Tuple, Union
+import uuid
+
+import numpy as np
+
+# 磁盘缓存文件的后缀；clear 和容量淘汰只处理符合 _DISK_FILE 的文件（包括写了一半的临时文件），
+# disk_dir 中的其他文件不受影响
+_DISK_SUFFIX = ".respcache"
+_DISK_FILE = re.compile(r".+\.respcache(\.[0-9a-f]{32}\.tmp)?")
+
+
+def _update_hash(h: "hashlib._Hash", obj: Any):
+    """把 obj 按规范形式写入 h：dict 与键的顺序无关，list 与 tuple 相同（编码后服务器看到的也相同）"""
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        # repr 区分 1、1.0、True 和 "1"
+        data = repr(obj).encode()
+        h.update(b"s" + struct.pack("!Q", len(data)) + data)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        data = memoryview(obj).cast("B")
+        h.update(b"b" + struct.pack("!Q", data.nbytes))
+        h.update(data)
+    elif isinstance(obj, dict):
+        h.update(b"d" + struct.pack("!Q", len(obj)))
+        for key, value in sorted(obj.items(), key=lambda kv: repr(kv[0])):
+            _update_hash(h, key)
+            _update_hash(h, value)
+    elif isinstance(obj, (list, tuple)):
+        h.update(b"l" + struct.pack("!Q", len(obj)))
+        for value in obj:
+            _update_hash(h, value)
+    elif isinstance(obj, (np.ndarray, np.generic)):
+        arr = np.ascontiguousarray(obj)
+        header = f"{arr.dtype.str}{arr.shape}".encode()
+        h.update(b"a" + struct.pack("!Q", len(header)) + header)
+        h.update(memoryview(arr).cast("B"))
+    else:
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        h.update(b"p" + struct.pack("!Q", len(data)) + data)
+
+
+def request_key(*parts: Any) -> str:
+    """请求的规范哈希，相同内容的请求（包括其中的数组）得到相同的键"""
+    h = hashlib.blake2b(digest_size=20)
+    for part in parts:
+        _update_hash(h, part)
+    return h.hexdigest()
+
+
+class ResponseCache:
+    """
+    客户端的响应缓存，相同的请求直接返回之前的响应，不再发给服务器
+    内存中按 LRU 淘汰，使缓存的字节数不超过 max_bytes；超过 ttl 秒的响应视为过期
+    设置 disk_dir 后同时写入该目录，内存中没有时从磁盘读取，重启后仍然有效；
+    磁盘上按 ttl 过期，总字节数超过 max_disk_bytes 时删除最早写入的文件
+    响应以 pickle 的形式保存，每次命中都得到一份新的拷贝，调用方修改返回值不会影响缓存
+    同一个 ResponseCache 可以被多个客户端（例如 IPCClientPool 的所有进程）共享
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 1 << 30,
+        ttl: Union[float, None] = None,  # 秒，None 表示不过期
+        disk_dir: Union[str, None] = None,
+        max_disk_bytes: int = 4 << 30,  # disk_dir 中缓存文件的总字节数上限
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.max_disk_bytes = max_disk_bytes
+        # 磁盘缓存的总字节数；目录可能被多个进程共用，这里只是估计，淘汰时按实际文件重新统计
+        self._disk_bytes = 0
+        self._disk_lock = threading.Lock()
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._trim_disk()
+        # 键 -> (写入时间, pickle 后的响应)
+        self._entries: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def _expired(self, created_at: float) -> bool:
+        return self.ttl is not None and time.time() - created_at > self.ttl
+
+    def _load(self, key: str) -> Union[bytes, None]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[0]):
+                    self._entries.move_to_end(key)
+                    return entry[1]
+                self._drop(key)
+        if self.disk_dir is None:
+            return None
+        path = self._disk_path(key)
+        try:
+            created_at = os.path.getmtime(path)
+            if self._expired(created_at):
+                os.unlink(path)
+                return None
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return None
+        with self._lock:
+            self._insert(key, created_at, data)
+        return data
+
+    def _drop(self, key: str):
+        _, data = self._entries.pop(key)
+        self._bytes -= len(data)
+
+    def _insert(self, key: str, created_at: float, data: bytes):
+        if key in self._entries:
+            self._drop(key)
+        if len(data) > self.max_bytes:
+            return
+        self._entries[key] = (created_at, data)
+        self._bytes += len(data)
+        while self._bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        """返回 (是否命中, 响应)"""
+        data = self._load(key)
+        with self._lock:
+            if data is None:
+                self._misses += 1
+                return False, None
+            self._hits += 1
+        return True, pickle.loads(data)
+
+    def put(self, key: str, response: Any):
+        """缓存响应；无法 pickle 的响应（例如 ShmHandle）不缓存"""
+        try:
+            data = pickle.dumps(response, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return
+        now = time.time()
+        with self._lock:
+            self._insert(key, now, data)
+        if self.disk_dir is not None:
+            # 先写临时文件再重命名，其他进程不会读到写了一半的文件
+            path = self._disk_path(key)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError:
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+                return
+            with self._disk_lock:
+                self._disk_bytes += len(data)
+                over = self._disk_bytes > self.max_disk_bytes
+            if over:
+                self._trim_disk()
+
+    def _disk_path(self, key: str) -> str:
+        assert self.disk_dir is not None
+        return os.path.join(self.disk_dir, key + _DISK_SUFFIX)
+
+    def _disk_files(self) -> List[Tuple[float, int, str]]:
+        """disk_dir 中本缓存写入的文件：(修改时间, 字节数, 路径)，不包括临时文件"""
+        assert self.disk_dir is not None
+        files = []
+        try:
+            entries = list(os.scandir(self.disk_dir))
+        except OSError:
+            return files
+        for entry in entries:
+            if not entry.name.endswith(_DISK_SUFFIX):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                # 已被其他进程删除
+                continue
+            files.append((st.st_mtime, st.st_size, entry.path))
+        return files
+
+    def _trim_disk(self):
+        """按实际文件重新统计磁盘缓存的字节数，超过 max_disk_bytes 时从最早写入的文件开始删除"""
+        with self._disk_lock:
+            files = sorted(self._disk_files())
+            total = sum(size for _, size, _ in files)
+            for _, size, path in files:
+                if total <= self.max_disk_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+                total -= size
+            self._disk_bytes = total
+
+    def record_stream(self, key: str, responses: Iterable[Any]) -> Iterator[Any]:
+        """
+        透传 responses，完整迭代结束后缓存整个流，提前结束或出错时不缓存
+        流数据在产生时就 pickle，因此只在下一个数据之前有效的零拷贝视图也能被缓存
+        """
+        items: Union[List[bytes], None] = []
+        try:
+            for response in responses:
+                items = _record_item(items, response)
+                yield response
+        finally:
+            # 提前结束时立即关闭底层的流，让服务器停止生成
+            close = getattr(responses, "close", None)
+            if close is not None:
+                close()
+        if items is not None:
+            self.put(key, _StreamRecord(items))
+
+    async def record_stream_async(
+        self, key: str, responses: AsyncIterator[Any]
+    ) -> AsyncIterator[Any]:
+        """record_stream 的异步版本"""
+        items: Union[List[bytes], None] = []
+        try:
+            async for response in responses:
+                items = _record_item(items, response)
+                yield response
+        finally:
+            aclose = getattr(responses, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        if items is not None:
+            self.put(key, _StreamRecord(items))
+
+    def replay_stream(self, key: str) -> Union[Iterator[Any], None]:
+        """命中时返回重放缓存的流的迭代器，否则返回 None"""
+        found, record = self.get(key)
+        if not found:
+            return None
+        return (pickle.loads(item) for item in record.items)
+
+    def clear(self):
+        """清空内存和磁盘中的缓存；磁盘上只删除本缓存写入的文件"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        if self.disk_dir is not None:
+            with self._disk_lock:
+                for name in os.listdir(self.disk_dir):
+                    if not _DISK_FILE.fullmatch(name):
+                        continue
+                    try:
+                        os.unlink(os.path.join(self.disk_dir, name))
+                    except OSError:
+                        pass
+                self._disk_bytes = 0
+
+    def stats(self, reset: bool = False) -> Dict[str, float]:
+        """命中数、未命中数、命中率、内存中的条目数和字节数；reset 时清零命中计数"""
+        with self._lock:
+            total = self._hits + self._misses
+            stats = {
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / total if total else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+            if reset:
+                self._hits = self._misses = 0
+        return stats
+
+
+def _record_item(items: Union[List[bytes], None], response: Any) -> Union[List[bytes], None]:
+    """把流数据 pickle 后加入 items，无法 pickle 时返回 None 表示放弃缓存该流"""
+    if items is None:
+        return None
+    try:
+        items.append(pickle.dumps(response, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return None
+    return items
+
+
+class _StreamRecord:
+    """缓存的一个完整的流，每个数据单独 pickle，重放时逐个还原"""
+
+    def __init__(self, items: List[bytes]):
+        self.items = items
@@ -1,53 +1,879 @@
 # 参考 /mnt/ssd/home/zhaozy/my_ipc/src/my_ipc/ipc_client.py 的实现
-# 去掉了所有共享内存相关的逻辑，用于直接嵌入到其他 Python 文件中使用
+# 去掉了 NumPy 和共享数组等逻辑，只依赖标准库（msgpack 可选），用于直接嵌入到其他 Python 文件中使用
+# 较大的 bytes/memoryview/array.array 经过共享内存传输，见 BufferTransport
+# 协议部分复制自 my_ipc.ipc_protocol，性能统计复制自 my_ipc.ipc_metrics，修改时需保持一致
 
-import subprocess as sp
+import array
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+import enum
 import json
+import math
+import mmap
+from multiprocessing import shared_memory
 import os
+import pickle
+import select
 import socket
+import struct
+import subprocess as sp
+import sys
+import threading
 import time
-from typing import Any, Dict
+from typing import Any, Deque, Dict, List, Sequence, Set, Tuple, Union, cast
 import uuid
-import enum
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 class IPCMessageType(enum.Enum):
+    INIT = "INIT"
     QUIT = "QUIT"
     ERROR = "ERROR"
+    REQUEST = "REQUEST"
+    RESPONSE = "RESPONSE"
     STREAM_REQUEST = "STREAM_REQUEST"
     STREAM_DATA = "STREAM_DATA"
     STREAM_END = "STREAM_END"
+    # 客户端在连接过程中注册、调整大小或注销共享数组，服务器以 RESPONSE 确认
+    SHM_UPDATE = "SHM_UPDATE"
+    # 客户端消费了 data 个流数据，服务器可以再发送这么多
+    CREDIT = "CREDIT"
+    # 客户端放弃该流，服务器停止生成器，不再发送该流的任何消息
+    CANCEL = "CANCEL"
+    # 客户端读取服务器的性能统计（以及 trace 事件），服务器以 RESPONSE 回复
+    STATS = "STATS"
+
+
+@dataclass
+class IPCMessage:
+    """
+    一条协议消息，一个消息对应一个帧
+    id: 请求 id，同一请求（或流）的所有响应消息都带有相同的 id，
+        因此一个连接上可以同时有多个请求在处理，响应可以乱序返回
+    meta: 附加字段，例如 REQUEST 消息的 tmp_shm
+    """
+
+    type: IPCMessageType
+    id: int = 0
+    data: Any = None
+    meta: Union[Dict[str, Any], None] = None
+
+    def to_json(self) -> str:
+        obj = {"type": self.type.value, "id": self.id, "data": self.data}
+        if self.meta is not None:
+            obj["meta"] = self.meta
+        return json.dumps(obj)
+
+    @staticmethod
+    def from_json(data: str) -> "IPCMessage":
+        obj = json.loads(data)
+        return IPCMessage(
+            type=IPCMessageType(obj["type"]),
+            id=obj["id"],
+            data=obj.get("data"),
+            meta=obj.get("meta"),
+        )
+
+
+def _size_class(nbytes: int) -> int:
+    """向上取整到 2 的幂（至少一页），同一尺寸级别的共享内存段可以互相复用"""
+    return max(4096, 1 << max(nbytes - 1, 0).bit_length())
 
 
 def generate_socket_path(id: str) -> str:
     return f"/tmp/ipc_socket_{id}"
 
 
-def recv_exactly(sock: socket.socket, n: int) -> bytes:
-    """接收确切的 n 个字节"""
-    data = b""
-    while len(data) < n:
-        chunk = sock.recv(n - len(data))
-        if not chunk:
+def generate_shm_name(id: str, name: str) -> str:
+    return f"ipc_shm_{id}_{name}"
+
+
+# 客户端通过该环境变量把就绪管道的写端传给服务器进程
+READY_FD_ENV = "IPC_READY_FD"
+
+
+class ServerStartError(RuntimeError):
+    """服务器进程在就绪前退出或启动超时"""
+
+
+class DeadlineExceededError(RuntimeError):
+    """请求在服务器开始处理之前已经超过了客户端给出的截止时间，服务器没有调用处理函数"""
+
+
+# 服务器因截止时间跳过请求时，ERROR 消息的 meta 为 {"code": DEADLINE_EXCEEDED}
+DEADLINE_EXCEEDED = "deadline_exceeded"
+
+
+def schedule_meta(
+    meta: Union[Dict[str, Any], None], priority: int, timeout: Union[float, None]
+) -> Union[Dict[str, Any], None]:
+    """
+    在 REQUEST/STREAM_REQUEST 的 meta 中加入调度信息，取默认值时不加，旧版本的服务器会忽略它们
+    priority: 越大越先处理；timeout: 从发出请求起算的截止时间（秒）
+    """
+    if priority:
+        meta = {**(meta or {}), "priority": priority}
+    if timeout is not None:
+        meta = {**(meta or {}), "deadline": timeout, "sent_at": time.perf_counter_ns()}
+    return meta
+
+
+def raise_for_error(msg: IPCMessage, what: str):
+    """把 ERROR 消息转换为异常：因截止时间被跳过的请求为 DeadlineExceededError，其他为 RuntimeError"""
+    if (msg.meta or {}).get("code") == DEADLINE_EXCEEDED:
+        raise DeadlineExceededError(f"{what}超过截止时间: {msg.data}")
+    raise RuntimeError(f"服务器处理{what}时出错: {msg.data}")
+
+
+def spawn_server(cmd: str) -> Tuple[sp.Popen, int]:
+    """
+    启动服务器进程，返回 (进程, 就绪管道读端)
+    服务器 listen 之后向管道写入一个字节；服务器退出时管道写端随之关闭，读端读到 EOF
+    """
+    ready_r, ready_w = os.pipe()
+    try:
+        process = sp.Popen(
+            cmd,
+            shell=True,
+            executable="/bin/bash",
+            pass_fds=(ready_w,),
+            env={**os.environ, READY_FD_ENV: str(ready_w)},
+        )
+    except BaseException:
+        os.close(ready_r)
+        raise
+    finally:
+        os.close(ready_w)
+    return process, ready_r
+
+
+def connect_when_ready(ready_r: int, socket_path: str, max_wait: float) -> socket.socket:
+    """
+    等待服务器就绪并连接，返回连接好的 socket；关闭 ready_r
+    对于不支持就绪通知的服务器（例如嵌入到其他文件中的旧版本），退化为检查 socket 文件并尝试连接
+    """
+    deadline = time.monotonic() + max_wait
+    timeout = 0.01
+    try:
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ServerStartError("服务器启动超时")
+            readable, _, _ = select.select([ready_r], [], [], min(timeout, remaining))
+            if readable:
+                if not os.read(ready_r, 1):
+                    raise ServerStartError("服务器进程意外退出")
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(socket_path)
+                return sock
+            if os.path.exists(socket_path):
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.connect(socket_path)
+                    return sock
+                except ConnectionRefusedError:
+                    # 已经 bind 但还没有 listen
+                    sock.close()
+            timeout = min(timeout * 2, 0.5)
+    finally:
+        os.close(ready_r)
+
+
+def recv_exactly_into(sock: socket.socket, buffer: memoryview):
+    """用 recv_into 把 buffer 填满，不产生中间对象"""
+    received = 0
+    n = buffer.nbytes
+    while received < n:
+        got = sock.recv_into(buffer[received:])
+        if got == 0:
             raise ConnectionError("连接已关闭，数据不完整")
-        data += chunk
-    return data
+        received += got
+
+
+def sendmsg_all(sock: socket.socket, parts: List[Any], fds: Sequence[int] = ()):
+    """
+    用 sendmsg 把多个缓冲区合并为一次系统调用发送，处理部分发送的情况
+    fds: 通过 SCM_RIGHTS 随第一个字节一起发送的文件描述符
+    """
+    views = [memoryview(part).cast("B") for part in parts if len(part)]
+    ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))] if fds else []
+    while views:
+        # IOV_MAX 在 Linux 上为 1024
+        sent = sock.sendmsg(views[:1024], ancdata)
+        ancdata = []
+        while views and sent >= views[0].nbytes:
+            sent -= views[0].nbytes
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+
+
+# 一次最多接收的文件描述符数量（Linux 的 SCM_MAX_FD）
+_FDS_ANCBUFSIZE = socket.CMSG_SPACE(253 * array.array("i").itemsize)
+
 
+class SocketReader:
+    """
+    带缓冲的 socket 读取器
+    recv_into 到可复用的 bytearray，一次 recv 读到的多个帧直接在缓冲区中解析，不再产生系统调用；
+    大于缓冲区的数据直接 recv_into 到目标内存
+    """
 
-def recv_str(sock: socket.socket) -> str:
-    # 先接受一个数字作为 bufsize
-    bufsize_bytes = sock.recv(4)
-    bufsize = int.from_bytes(bufsize_bytes, byteorder="big")
-    data = recv_exactly(sock, bufsize).decode("utf-8")
-    return data
+    def __init__(self, sock: socket.socket, bufsize: int = 256 * 1024):
+        self.sock = sock
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._start = 0  # 未消费数据的起点
+        self._end = 0  # 已接收数据的终点
+        self.consumed = 0  # 已消费的总字节数
+        # 通过 SCM_RIGHTS 收到、尚未被取走的文件描述符
+        self.fds: Deque[int] = deque()
 
+    def _recv(self) -> int:
+        # 对端只在帧的开头附带文件描述符，帧头总是经过这里接收
+        got, ancdata, flags, _ = self.sock.recvmsg_into([self._view[self._end :]], _FDS_ANCBUFSIZE)
+        for level, type, data in ancdata:
+            if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                fds = array.array("i")
+                fds.frombytes(data[: len(data) - len(data) % fds.itemsize])
+                self.fds.extend(fds)
+        if flags & socket.MSG_CTRUNC:
+            raise RuntimeError("收到的文件描述符过多，部分已被丢弃")
+        return got
 
-def send_str(sock: socket.socket, data: str):
+    def _fill(self, n: int, eof_ok: bool = False) -> bool:
+        """保证缓冲区中至少有 n 个未消费的字节；eof_ok 时在帧边界上连接关闭返回 False"""
+        if self._end - self._start >= n:
+            return True
+        if self._start + n > len(self._buf):
+            # 把未消费的数据移到缓冲区开头，腾出空间
+            remaining = self._end - self._start
+            if n > len(self._buf):
+                buf = bytearray(max(n, 2 * len(self._buf)))
+                buf[:remaining] = self._view[self._start : self._end]
+                self._buf, self._view = buf, memoryview(buf)
+            else:
+                self._view[:remaining] = self._view[self._start : self._end]
+            self._start, self._end = 0, remaining
+        while self._end - self._start < n:
+            got = self._recv()
+            if got == 0:
+                if eof_ok and self._end == self._start:
+                    return False
+                raise ConnectionError("连接已关闭，数据不完整")
+            self._end += got
+        return True
+
+    def peek(self, n: int, eof_ok: bool = False) -> Union[memoryview, None]:
+        """返回接下来 n 个字节的视图但不消费；视图只在下一次读取之前有效"""
+        if not self._fill(n, eof_ok):
+            return None
+        return self._view[self._start : self._start + n]
+
+    def skip(self, n: int):
+        self._start += n
+        self.consumed += n
+
+    def read(self, n: int) -> memoryview:
+        """读取 n 个字节，返回的视图只在下一次读取之前有效"""
+        if n > len(self._buf):
+            # 大块数据单独分配，避免撑大复用缓冲区
+            data = bytearray(n)
+            self.read_into(memoryview(data))
+            return memoryview(data)
+        view = self.peek(n)
+        self.skip(n)
+        return cast(memoryview, view)
+
+    def buffered(self) -> int:
+        """缓冲区中已接收、尚未消费的字节数"""
+        return self._end - self._start
+
+    def read_into(self, target: memoryview):
+        """读取 target.nbytes 个字节到 target，先取缓冲区中已有的数据，剩余部分直接 recv_into"""
+        n = target.nbytes
+        buffered = min(n, self._end - self._start)
+        target[:buffered] = self._view[self._start : self._start + buffered]
+        self._start += buffered
+        self.consumed += n
+        if buffered < n:
+            recv_exactly_into(self.sock, target[buffered:])
+
+
+def encode_str(data: str) -> bytes:
+    """编码为与 send_str 相同格式的帧"""
     data_bytes = data.encode("utf-8")
-    bufsize = len(data_bytes)
-    bufsize_bytes = bufsize.to_bytes(4, byteorder="big")
-    sock.sendall(bufsize_bytes)
-    sock.sendall(data_bytes)
+    return len(data_bytes).to_bytes(4, byteorder="big") + data_bytes
+
+
+class Codec:
+    """
+    消息体编解码器
+    encode 返回 (payload, 带外缓冲区列表)，带外缓冲区紧跟 payload 原样发送，不做拷贝或序列化
+    """
+
+    name = ""
+
+    def encode(self, obj: Any) -> Tuple[bytes, List[memoryview]]:
+        raise NotImplementedError
+
+    def decode(self, payload: memoryview, buffers: List[bytearray]) -> Any:
+        """payload 可能是复用缓冲区的视图，解码结果不能引用它"""
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    name = "json"
+
+    def encode(self, obj: Any) -> Tuple[bytes, List[memoryview]]:
+        return json.dumps(obj).encode("utf-8"), []
+
+    def decode(self, payload: memoryview, buffers: List[bytearray]) -> Any:
+        return json.loads(str(payload, "utf-8"))
+
+
+class PickleCodec(Codec):
+    """pickle protocol 5，bytes 以外的大块缓冲区（如 numpy 数组）走带外传输；只用于互相信任的进程之间"""
+
+    name = "pickle"
+
+    def encode(self, obj: Any) -> Tuple[bytes, List[memoryview]]:
+        buffers: List[pickle.PickleBuffer] = []
+        payload = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        return payload, [buffer.raw() for buffer in buffers]
+
+    def decode(self, payload: memoryview, buffers: List[bytearray]) -> Any:
+        return pickle.loads(payload, buffers=buffers)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+
+    def encode(self, obj: Any) -> Tuple[bytes, List[memoryview]]:
+        return msgpack.packb(obj, use_bin_type=True), []
+
+    def decode(self, payload: memoryview, buffers: List[bytearray]) -> Any:
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+
+
+# 可用的编解码器，可以通过 register_codec 添加自定义实现
+CODECS: Dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec):
+    CODECS[codec.name] = codec
+
+
+register_codec(JsonCodec())
+register_codec(PickleCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+
+# 客户端在 INIT 消息中按此顺序提供编解码器，服务器选择其中第一个自己支持的
+DEFAULT_CODECS = ("msgpack", "pickle", "json")
+
+# 二进制帧头：消息类型、标志位、带外缓冲区数量、请求 id、payload 长度
+FRAME_HEADER = struct.Struct("!BBHQI")
+FLAG_META = 1  # payload 为 [data, meta]
+FLAG_ARRAYS = 2  # payload 为 [obj, 数组缓冲区数量]，数组缓冲区位于带外缓冲区的末尾
+
+MESSAGE_TYPE_CODES: Dict[IPCMessageType, int] = {
+    msg_type: code for code, msg_type in enumerate(IPCMessageType)
+}
+MESSAGE_TYPES: List[IPCMessageType] = list(IPCMessageType)
+
+ARRAY_KEY = "__ndarray__"
+SHM_ARRAY_THRESHOLD = 1 << 16  # 自动传输时大于该字节数的数组放入共享内存
+
+# memoryview 的格式字符对应的 NumPy dtype 种类，数组描述与 my_ipc.public.pack_arrays 的相同
+_FORMAT_KINDS = dict(zip("bBhHiIlLqQnNefd?", "iuiuiuiuiuiufffb"))
+_NATIVE_ORDER = "<" if sys.byteorder == "little" else ">"
+# (dtype 种类, 字节数) -> 格式字符，用于把收到的数组解释为 memoryview
+_KIND_FORMATS = {
+    (kind, str(struct.calcsize(fmt))): fmt for fmt, kind in reversed(_FORMAT_KINDS.items())
+}
+
+
+def _dtype_of(view: memoryview) -> Union[str, None]:
+    """memoryview 元素类型对应的 NumPy dtype 字符串，没有对应的类型时为 None"""
+    kind = _FORMAT_KINDS.get(view.format[1:] if view.format[:1] == "@" else view.format)
+    if kind is None:
+        return None
+    return f"{'|' if view.itemsize == 1 else _NATIVE_ORDER}{kind}{view.itemsize}"
+
+
+def _nbytes(spec: Dict[str, Any], available: int) -> int:
+    """
+    数组描述对应的字节数；dtype 不在 _KIND_FORMATS 中时（复数、字符串等）无法得知元素大小，
+    取共享内存中从数组起点开始的全部 available 字节
+    """
+    fmt = _KIND_FORMATS.get((spec["dtype"][1:2], spec["dtype"][2:]))
+    if fmt is None:
+        return available
+    return math.prod(spec["shape"]) * struct.calcsize(fmt)
+
+
+def _typed_view(buffer: Any, dtype: str, shape: List[int]) -> memoryview:
+    """按 dtype 和 shape 解释字节缓冲区；memoryview 不支持的类型（复数、非本机字节序等）返回一维字节视图"""
+    view = memoryview(buffer).cast("B")
+    fmt = _KIND_FORMATS.get((dtype[1:2], dtype[2:]))
+    if fmt is None or dtype[0] not in ("|", "=", _NATIVE_ORDER):
+        return view
+    return view.cast(fmt, shape) if view.nbytes else view.cast(fmt)
+
+
+def _map_shm(name: str, writable: bool = False) -> mmap.mmap:
+    """映射对端的具名共享内存段，不经过 resource_tracker"""
+    fd = os.open(os.path.join("/dev/shm", name), os.O_RDWR if writable else os.O_RDONLY)
+    try:
+        return mmap.mmap(
+            fd,
+            0,
+            flags=mmap.MAP_SHARED | getattr(mmap, "MAP_POPULATE", 0),
+            prot=mmap.PROT_READ | (mmap.PROT_WRITE if writable else 0),
+        )
+    finally:
+        os.close(fd)
+
+
+class BufferTransport:
+    """
+    不依赖 NumPy 的大块数据传输状态，与 my_ipc.public.ArrayTransport 的协议兼容
+    发送的数据写入本端的共享内存段借给对端，对端归还后复用；
+    收到的共享内存数据以零拷贝的 memoryview 使用，映射按段名缓存，
+    某个段上的视图全部被回收后，随下一条消息归还该段（或释放其中的 arena 块）
+    """
+
+    def __init__(self, id: str, max_bytes: int = 1 << 30, bytes_as_views: bool = False):
+        self.id = id
+        # 对端发送的较大 bytes/bytearray 默认拷贝还原为 bytes，为 True 时同其他数据一样返回 memoryview
+        self.bytes_as_views = bytes_as_views
+        # 空闲共享内存段、以及缓存的对端段映射各自的总字节数上限
+        self.max_bytes = max_bytes
+        self._free: "OrderedDict[str, shared_memory.SharedMemory]" = OrderedDict()
+        self._free_bytes = 0
+        # 借给对端、尚未归还的段
+        self._lent: Dict[str, shared_memory.SharedMemory] = {}
+        # 对端段的映射，按最近使用排序；视图通过 memoryview 引用映射，引用计数即可判断是否仍在使用
+        self._maps: "OrderedDict[str, mmap.mmap]" = OrderedDict()
+        self._map_bytes = 0
+        # 视图仍可能存活的对端段：借来的段，以及 arena 段中已交出的块
+        self._borrowed: Set[str] = set()
+        self._blocks: Dict[str, List[List[Any]]] = {}
+        # 等待随下一条消息发给对端的淘汰通知
+        self._evicted: List[str] = []
+        self._lock = threading.Lock()
+
+    def lend(self, view: memoryview, dtype: str) -> Dict[str, Any]:
+        size = _size_class(view.nbytes)
+        with self._lock:
+            shm = next((s for s in reversed(self._free.values()) if s.size == size), None)
+            if shm is not None:
+                del self._free[shm.name]
+                self._free_bytes -= size
+        if shm is None:
+            name = generate_shm_name(self.id, "tmp_" + uuid.uuid4().hex)
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        shm.buf[: view.nbytes] = view.cast("B") if view.c_contiguous else view.tobytes()
+        with self._lock:
+            self._lent[shm.name] = shm
+        return {"dtype": dtype, "shape": list(view.shape), "shm": shm.name}
+
+    def borrow(self, spec: Dict[str, Any]) -> memoryview:
+        """对端借来的段映射为只读 memoryview"""
+        name = spec["shm"]
+        with self._lock:
+            mm = self._map(name, writable=False)
+            self._borrowed.add(name)
+        nbytes = _nbytes(spec, len(mm))
+        return _typed_view(memoryview(mm)[:nbytes], spec["dtype"], spec["shape"])
+
+    def map_block(self, spec: Dict[str, Any]) -> memoryview:
+        """服务器在 arena 中分配的输出数组映射为可写 memoryview，视图全部被回收后通知服务器释放"""
+        name, offset = spec["arena"], spec["offset"]
+        with self._lock:
+            mm = self._map(name, writable=True)
+            self._blocks.setdefault(name, []).append([name, offset])
+        nbytes = _nbytes(spec, len(mm) - offset)
+        return _typed_view(
+            memoryview(mm)[offset : offset + nbytes], spec["dtype"], spec["shape"]
+        )
+
+    def _map(self, name: str, writable: bool) -> mmap.mmap:
+        mm = self._maps.get(name)
+        if mm is None:
+            mm = self._maps[name] = _map_shm(name, writable)
+            self._map_bytes += len(mm)
+        else:
+            self._maps.move_to_end(name)
+        return mm
+
+    def _in_use(self, name: str) -> bool:
+        # 缓存和 getrefcount 的参数之外的引用都来自仍然存活的视图
+        return sys.getrefcount(self._maps[name]) > 2
+
+    def outgoing(self) -> Union[Dict[str, List[Any]], None]:
+        """随下一条消息发给对端的归还、淘汰和释放通知"""
+        with self._lock:
+            released = [name for name in self._borrowed if not self._in_use(name)]
+            self._borrowed.difference_update(released)
+            freed = []
+            for name in [name for name in self._blocks if not self._in_use(name)]:
+                freed += self._blocks.pop(name)
+            # 超出上限时解除最久未使用、且没有视图的映射
+            for name in list(self._maps):
+                if self._map_bytes <= self.max_bytes:
+                    break
+                if name not in self._borrowed and name not in self._blocks:
+                    self._map_bytes -= len(self._maps.pop(name))
+            evicted, self._evicted = self._evicted, []
+        if not released and not evicted and not freed:
+            return None
+        return {"released": released, "evicted": evicted, "freed": freed}
+
+    def incoming(self, notice: Dict[str, List[Any]]):
+        """处理对端的归还通知，以及对端已删除的段的淘汰通知"""
+        with self._lock:
+            for name in notice.get("released", []):
+                shm = self._lent.pop(name, None)
+                if shm is None:
+                    continue
+                self._free[name] = shm
+                self._free_bytes += shm.size
+            while self._free_bytes > self.max_bytes and self._free:
+                name, shm = self._free.popitem(last=False)
+                self._free_bytes -= shm.size
+                shm.close()
+                shm.unlink()
+                self._evicted.append(name)
+            for name in notice.get("evicted", []):
+                # 对端只淘汰已归还的段，映射在最后一个视图被回收时解除
+                mm = self._maps.pop(name, None)
+                if mm is not None:
+                    self._map_bytes -= len(mm)
+                    self._borrowed.discard(name)
+
+    def close(self):
+        with self._lock:
+            segments = list(self._lent.values()) + list(self._free.values())
+            self._lent, self._free, self._free_bytes = {}, OrderedDict(), 0
+            self._maps, self._map_bytes = OrderedDict(), 0
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+
+
+def pack_buffers(obj: Any, buffers: List[memoryview], transport: BufferTransport) -> Any:
+    """
+    把 obj（dict/list/tuple 的任意嵌套）中的 bytes/bytearray/memoryview/array.array 替换为 {ARRAY_KEY: 描述} 标记，
+    对端为 my_ipc 的完整版本时还原为 NumPy 数组：
+    大于 SHM_ARRAY_THRESHOLD 字节的数据写入共享内存借给对端，较小的 memoryview/array.array 追加到 buffers，
+    较小的 bytes/bytearray 仍交给编解码器；较大的 bytes/bytearray 在描述中标记 "bytes"，对端据此还原为 bytes；
+    没有需要替换的值时原样返回 obj 本身
+    """
+    if isinstance(obj, (bytes, bytearray, memoryview, array.array)):
+        if isinstance(obj, (bytes, bytearray)) and len(obj) <= SHM_ARRAY_THRESHOLD:
+            return obj
+        view = memoryview(obj)
+        dtype = _dtype_of(view)
+        if dtype is None:
+            return obj
+        if view.nbytes > SHM_ARRAY_THRESHOLD:
+            spec = transport.lend(view, dtype)
+            if isinstance(obj, (bytes, bytearray)):
+                spec["bytes"] = True
+            return {ARRAY_KEY: spec}
+        contiguous = view.c_contiguous and view.nbytes
+        buffers.append(view.cast("B") if contiguous else memoryview(view.tobytes()))
+        return {ARRAY_KEY: {"dtype": dtype, "shape": list(view.shape), "buf": len(buffers) - 1}}
+    if isinstance(obj, dict):
+        packed = None
+        for key, value in obj.items():
+            new = pack_buffers(value, buffers, transport)
+            if new is not value:
+                if packed is None:
+                    packed = dict(obj)
+                packed[key] = new
+        return obj if packed is None else packed
+    if isinstance(obj, (list, tuple)):
+        packed_list = None
+        for i, value in enumerate(obj):
+            new = pack_buffers(value, buffers, transport)
+            if new is not value:
+                if packed_list is None:
+                    packed_list = list(obj)
+                packed_list[i] = new
+        return obj if packed_list is None else packed_list
+    return obj
+
+
+def unpack_buffers(obj: Any, buffers: List[bytearray], transport: BufferTransport) -> Any:
+    """
+    pack_buffers（以及 my_ipc.public.pack_arrays）的逆操作，数组还原为直接指向接收缓冲区或共享内存的 memoryview；
+    标记了 "bytes" 的数据拷贝为 bytes，保持发送方的类型（transport.bytes_as_views 为 True 时同样返回 memoryview）
+    """
+    if isinstance(obj, dict):
+        spec = obj.get(ARRAY_KEY) if len(obj) == 1 else None
+        if spec is not None:
+            if "shm" in spec:
+                view = transport.borrow(spec)
+            elif "arena" in spec:
+                view = transport.map_block(spec)
+            else:
+                view = _typed_view(buffers[spec["buf"]], spec["dtype"], spec["shape"])
+            if spec.get("bytes") and not transport.bytes_as_views:
+                # 拷贝后视图随即回收，共享内存段随下一条消息归还
+                return view.tobytes()
+            return view
+        for key, value in obj.items():
+            obj[key] = unpack_buffers(value, buffers, transport)
+        return obj
+    if isinstance(obj, list):
+        for i, value in enumerate(obj):
+            obj[i] = unpack_buffers(value, buffers, transport)
+        return obj
+    if isinstance(obj, tuple):
+        return tuple(unpack_buffers(value, buffers, transport) for value in obj)
+    return obj
+
+
+def send_message(
+    sock: socket.socket,
+    msg: IPCMessage,
+    codec: Union[Codec, None] = None,
+    arrays: Union[BufferTransport, None] = None,
+) -> int:
+    """
+    codec 为 None 时使用 JSON 字符串帧，用于还未协商编解码器的 INIT 消息；返回帧的字节数
+    arrays 不为 None 时 data 中的 bytes/memoryview/array.array 见 pack_buffers
+    """
+    if codec is None:
+        frame = encode_str(msg.to_json())
+        sock.sendall(frame)
+        return len(frame)
+    flags = 0
+    obj = msg.data
+    meta = msg.meta
+    array_buffers: List[memoryview] = []
+    has_arrays = False
+    if arrays is not None:
+        obj = pack_buffers(obj, array_buffers, arrays)
+        has_arrays = obj is not msg.data
+        notice = arrays.outgoing()
+        if notice is not None:
+            meta = {**(meta or {}), "arrays": notice}
+    if meta is not None:
+        flags |= FLAG_META
+        obj = [obj, meta]
+    if has_arrays:
+        flags |= FLAG_ARRAYS
+        obj = [obj, len(array_buffers)]
+    payload, buffers = codec.encode(obj)
+    buffers = buffers + array_buffers
+    header = FRAME_HEADER.pack(
+        MESSAGE_TYPE_CODES[msg.type], flags, len(buffers), msg.id, len(payload)
+    )
+    if buffers:
+        header += struct.pack(f"!{len(buffers)}Q", *(buffer.nbytes for buffer in buffers))
+    sendmsg_all(sock, [header, payload, *buffers])
+    return len(header) + len(payload) + sum(buffer.nbytes for buffer in buffers)
+
+
+def recv_message(
+    reader: SocketReader,
+    codec: Union[Codec, None] = None,
+    arrays: Union[BufferTransport, None] = None,
+) -> IPCMessage:
+    """接收一个帧，连接关闭时抛出 ConnectionError；arrays 见 send_message"""
+    if codec is None:
+        bufsize_bytes = reader.peek(4, eof_ok=True)
+        if bufsize_bytes is None:
+            raise ConnectionError("连接已关闭")
+        bufsize = int.from_bytes(bufsize_bytes, byteorder="big")
+        reader.skip(4)
+        return IPCMessage.from_json(str(reader.read(bufsize), "utf-8"))
+    header_bytes = reader.peek(FRAME_HEADER.size, eof_ok=True)
+    if header_bytes is None:
+        raise ConnectionError("连接已关闭")
+    type_code, flags, nbufs, req_id, length = FRAME_HEADER.unpack(header_bytes)
+    reader.skip(FRAME_HEADER.size)
+    lengths = struct.unpack(f"!{nbufs}Q", reader.read(8 * nbufs)) if nbufs else ()
+    if length > 64 * 1024 or nbufs:
+        payload = bytearray(length)
+        reader.read_into(memoryview(payload))
+    else:
+        payload = bytes(reader.read(length))
+    buffers = []
+    for n in lengths:
+        buffer = bytearray(n)
+        reader.read_into(memoryview(buffer))
+        buffers.append(buffer)
+    obj = codec.decode(payload, buffers)
+    array_buffers: List[bytearray] = []
+    if flags & FLAG_ARRAYS:
+        obj, n = obj
+        array_buffers = buffers[len(buffers) - n :]
+    meta = None
+    if flags & FLAG_META:
+        obj, meta = obj
+        if arrays is not None and "arrays" in meta:
+            arrays.incoming(meta.pop("arrays"))
+    if flags & FLAG_ARRAYS and arrays is not None:
+        obj = unpack_buffers(obj, array_buffers, arrays)
+    return IPCMessage(type=MESSAGE_TYPES[type_code], id=req_id, data=obj, meta=meta)
+
+
+# 每个 2 倍区间分成的桶数（2 的幂），分位数的相对误差不超过 1 / _SUB_BUCKETS
+_SUB_BUCKETS = 8
+_SUB_BITS = _SUB_BUCKETS.bit_length() - 1
+
+
+def _bucket(ns: int) -> int:
+    """对数线性分桶：小于 2 * _SUB_BUCKETS 的值各占一个桶，之后每个 2 倍区间 _SUB_BUCKETS 个桶"""
+    if ns < 2 * _SUB_BUCKETS:
+        return max(ns, 0)
+    shift = ns.bit_length() - _SUB_BITS - 1
+    return shift * _SUB_BUCKETS + (ns >> shift)
+
+
+def _bucket_midpoint(bucket: int) -> float:
+    if bucket < 2 * _SUB_BUCKETS:
+        return float(bucket)
+    shift = bucket // _SUB_BUCKETS - 1
+    return ((bucket % _SUB_BUCKETS + _SUB_BUCKETS) << shift) + (1 << shift) / 2
+
+
+class Histogram:
+    """耗时直方图（纳秒），记录一次只需一次分桶计算和几次加法"""
+
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets: Dict[int, int] = {}
+
+    def record(self, ns: int):
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+        bucket = _bucket(ns)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, q: float) -> float:
+        """第 q（0~1）分位数的估计值（纳秒），取所在桶的中点"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(_bucket_midpoint(bucket), float(self.max))
+        return float(self.max)
+
+    def summary(self) -> Dict[str, float]:
+        """次数，以及以秒为单位的总耗时、平均值、p50/p90/p99 和最大值"""
+        return {
+            "count": self.count,
+            "total": self.total / 1e9,
+            "mean": self.total / self.count / 1e9 if self.count else 0.0,
+            "p50": self.percentile(0.5) / 1e9,
+            "p90": self.percentile(0.9) / 1e9,
+            "p99": self.percentile(0.99) / 1e9,
+            "max": self.max / 1e9,
+        }
+
+
+class Metrics:
+    """
+    客户端或服务器的性能统计：各阶段耗时的直方图、字节数和消息数等计数器，以及可选的 trace 事件
+    时间戳使用 time.perf_counter_ns（Linux 上为 CLOCK_MONOTONIC），同一台机器上各进程的事件可以合并到一条时间线
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases: Dict[str, Histogram] = {}
+        self._counters: Dict[str, int] = {}
+        self._since = time.perf_counter_ns()
+        # 开启 trace 后保存最近的事件，超过上限时丢弃最早的
+        self._trace: Union[Deque[Dict[str, Any]], None] = None
+        self._pid = os.getpid()
+
+    def observe(self, phase: str, start_ns: int, end_ns: Union[int, None] = None, id: int = 0):
+        """记录阶段 phase 从 start_ns 到 end_ns（默认为现在）的耗时；id 为请求 id，写入 trace 事件"""
+        if end_ns is None:
+            end_ns = time.perf_counter_ns()
+        with self._lock:
+            histogram = self._phases.get(phase)
+            if histogram is None:
+                histogram = self._phases[phase] = Histogram()
+            histogram.record(end_ns - start_ns)
+            if self._trace is not None:
+                self._trace.append(
+                    {
+                        "name": phase,
+                        "ph": "X",
+                        "ts": start_ns / 1000,
+                        "dur": (end_ns - start_ns) / 1000,
+                        "pid": self._pid,
+                        "tid": threading.get_ident(),
+                        "args": {"id": id},
+                    }
+                )
+
+    def add(self, counter: str, n: int = 1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + n
+
+    def snapshot(self, reset: bool = False) -> Dict[str, Any]:
+        """
+        返回统计窗口（上次 reset 以来）的秒数、各阶段的 Histogram.summary、计数器及其每秒速率
+        reset: 读取后清零，便于按时间段统计
+        """
+        now = time.perf_counter_ns()
+        with self._lock:
+            elapsed = (now - self._since) / 1e9
+            stats = {
+                "elapsed": elapsed,
+                "phases": {name: h.summary() for name, h in self._phases.items()},
+                "counters": dict(self._counters),
+                "rates": {
+                    name: n / elapsed if elapsed > 0 else 0.0
+                    for name, n in self._counters.items()
+                },
+            }
+            if reset:
+                self._phases = {}
+                self._counters = {}
+                self._since = now
+        return stats
+
+    def start_trace(self, max_events: int = 1 << 20):
+        """开始记录 trace 事件，最多保留最近的 max_events 个"""
+        with self._lock:
+            # zygote 模式下 fork 出的子进程继承了父进程的 Metrics
+            self._pid = os.getpid()
+            self._trace = deque(maxlen=max_events)
+
+    def stop_trace(self) -> List[Dict[str, Any]]:
+        """停止记录并取走已记录的 trace 事件"""
+        with self._lock:
+            events, self._trace = self._trace, None
+        return list(events or ())
+
+
+def write_trace(path: str, events: List[Dict[str, Any]]):
+    """把 trace 事件写为 Chrome trace 格式的 JSON，可以用 Perfetto 或 chrome://tracing 打开"""
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
 
 
 class IPCClient:
@@ -56,66 +882,159 @@ class IPCClient:
         self,
         server_cmd: str,  # 启动服务器的命令，需包含 {id} 占位符
         max_wait: int = 60,
+        codecs: Tuple[str, ...] = DEFAULT_CODECS,  # 按优先级提供给服务器选择的消息编解码器
+        metrics: bool = False,  # 记录各阶段耗时和收发的字节数，见 get_stats；每次收发都有额外开销
+        bytes_as_views: bool = False,  # 响应中较大的 bytes 以 memoryview 返回，不拷贝
     ):
         self.id = uuid.uuid4().hex
+        self.metrics = Metrics() if metrics else None
         self.socket_path = generate_socket_path(self.id)
 
-        # 启动服务器进程
-        cmd = server_cmd.format(id=self.id)
-        self.process = sp.Popen(cmd, shell=True, executable="/bin/bash")
+        # 启动服务器进程，服务器 listen 后通过管道通知
+        self.process, ready_r = spawn_server(server_cmd.format(id=self.id))
+        try:
+            self.socket = connect_when_ready(ready_r, self.socket_path, max_wait)
+        except RuntimeError as e:
+            if self.process.poll() is None:
+                self.process.terminate()
+            raise RuntimeError(f"{e}，返回码 {self.process.wait()}") from None
 
-        # 等待服务器就绪
-        wait_time = 0
-        while wait_time < max_wait:
-            if os.path.exists(self.socket_path):
-                break
-            if self.process.poll() is not None:
-                raise RuntimeError("服务器进程意外退出")
-            time.sleep(1)
-            wait_time += 1
-
-        if not os.path.exists(self.socket_path):
-            self.process.terminate()
-            raise RuntimeError("服务器启动超时")
-
-        # 连接socket
-        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.socket.connect(self.socket_path)
-
-        # 发送初始化信息（不包含共享内存信息）
-        send_str(self.socket, json.dumps({}))
-
-    def send_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
-        send_str(self.socket, json.dumps(request))
-        response_data = recv_str(self.socket)
-        if response_data == IPCMessageType.ERROR.value:
-            raise RuntimeError("服务器处理请求时出错")
-        return json.loads(response_data)
-
-    def send_stream_request(self, request: Dict[str, Any]):
+        # 发送初始化信息（不包含共享数组信息）
+        send_message(
+            self.socket,
+            IPCMessage(IPCMessageType.INIT, data={"codecs": list(codecs), "arrays": True}),
+        )
+        # 服务器回复选定的编解码器，之后的消息都使用二进制帧
+        self.reader = SocketReader(self.socket)
+        reply = recv_message(self.reader)
+        self.codec = CODECS[reply.data["codec"]]
+        # 服务器支持 STATS 消息
+        self.server_stats = bool(reply.data.get("stats"))
+        # 服务器支持时，请求和响应中较大的 bytes/memoryview/array.array 经过共享内存传输
+        self.arrays = (
+            BufferTransport(self.id, bytes_as_views=bytes_as_views)
+            if reply.data.get("arrays")
+            else None
+        )
+        self.next_id = 1
+
+    def _send(
+        self, msg_type: IPCMessageType, data: Any, meta: Union[Dict[str, Any], None] = None
+    ) -> int:
+        req_id = self.next_id
+        self.next_id += 1
+        msg = IPCMessage(msg_type, req_id, data, meta)
+        if self.metrics is None:
+            send_message(self.socket, msg, self.codec, self.arrays)
+            return req_id
+        # 编码和发送在同一个函数中完成，一起记为 send
+        start = time.perf_counter_ns()
+        nbytes = send_message(self.socket, msg, self.codec, self.arrays)
+        self.metrics.observe("send", start, id=req_id)
+        self.metrics.add("messages_sent")
+        self.metrics.add("bytes_sent", nbytes)
+        return req_id
+
+    def _recv_for(self, req_id: int) -> IPCMessage:
+        """接收属于 req_id 的下一条消息，跳过此前被放弃的流的剩余消息"""
+        while True:
+            if self.metrics is None:
+                msg = recv_message(self.reader, self.codec, self.arrays)
+            else:
+                # 只统计帧到达之后的接收和解码，不包括等待服务器的时间
+                self.reader.peek(FRAME_HEADER.size, eof_ok=True)
+                start, consumed = time.perf_counter_ns(), self.reader.consumed
+                msg = recv_message(self.reader, self.codec, self.arrays)
+                self.metrics.observe("deserialize", start, id=msg.id)
+                self.metrics.add("messages_received")
+                self.metrics.add("bytes_received", self.reader.consumed - consumed)
+            if msg.id == req_id:
+                return msg
+
+    def send_request(
+        self, request: Dict[str, Any], priority: int = 0, timeout: Union[float, None] = None
+    ) -> Dict[str, Any]:
+        """
+        priority、timeout 见 my_ipc.ipc_client.IPCClient.send_request
+        响应中的 memoryview/array.array 还原为 memoryview，bytes 仍为 bytes（bytes_as_views 时为 memoryview），
+        见 unpack_buffers
+        """
+        start = time.perf_counter_ns()
+        meta = schedule_meta(None, priority, timeout)
+        req_id = self._send(IPCMessageType.REQUEST, request, meta)
+        msg = self._recv_for(req_id)
+        if self.metrics is not None:
+            self.metrics.observe("round_trip", start, id=req_id)
+        if msg.type == IPCMessageType.ERROR:
+            raise_for_error(msg, "请求")
+        return msg.data
+
+    def send_stream_request(
+        self, request: Dict[str, Any], priority: int = 0, timeout: Union[float, None] = None
+    ):
         """发送流式请求，返回一个迭代器，每次迭代返回一个响应"""
-        send_str(self.socket, IPCMessageType.STREAM_REQUEST.value)
-        send_str(self.socket, json.dumps(request))
-        
+        req_id = self._send(
+            IPCMessageType.STREAM_REQUEST, request, schedule_meta(None, priority, timeout)
+        )
+
         while True:
-            response_type = recv_str(self.socket)
-            if response_type == IPCMessageType.STREAM_END.value:
+            msg = self._recv_for(req_id)
+            if msg.type == IPCMessageType.STREAM_END:
                 break
-            elif response_type == IPCMessageType.ERROR.value:
-                raise RuntimeError("服务器处理流式请求时出错")
-            elif response_type == IPCMessageType.STREAM_DATA.value:
-                response_data = recv_str(self.socket)
-                yield json.loads(response_data)
+            elif msg.type == IPCMessageType.ERROR:
+                raise_for_error(msg, "流式请求")
+            elif msg.type == IPCMessageType.STREAM_DATA:
+                if self.metrics is not None:
+                    self.metrics.add("stream_items")
+                yield msg.data
             else:
-                raise RuntimeError(f"未知的响应类型: {response_type}")
+                raise RuntimeError(f"未知的响应类型: {msg.type}")
+
+    def get_stats(self, reset: bool = False) -> Dict[str, Any]:
+        """
+        客户端的性能统计，格式与 my_ipc.ipc_client.IPCClient.get_stats 相同
+        阶段：send（编码并发送）、deserialize、round_trip；计数器：messages_sent/received、bytes_sent/received、stream_items
+        """
+        assert self.metrics is not None, "未开启性能统计"
+        return self.metrics.snapshot(reset)
+
+    def get_server_stats(self, reset: bool = False) -> Dict[str, Any]:
+        """通过 STATS 消息读取服务器的性能统计"""
+        return self._query_stats({"reset": reset})["stats"]
+
+    def start_trace(self, max_events: int = 1 << 20, server: bool = True):
+        """开始记录 trace 事件，server 时服务器同时开始记录"""
+        assert self.metrics is not None, "未开启性能统计"
+        if server:
+            self._query_stats({"trace": "start", "max_events": max_events})
+        self.metrics.start_trace(max_events)
+
+    def export_trace(self, path: str, server: bool = True) -> int:
+        """停止记录，把客户端（以及 server 时服务器）的 trace 事件以 Chrome trace 格式写入 path，返回事件数"""
+        assert self.metrics is not None, "未开启性能统计"
+        events = self.metrics.stop_trace()
+        if server:
+            events += self._query_stats({"trace": "stop"})["trace"]
+        write_trace(path, events)
+        return len(events)
+
+    def _query_stats(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        if not self.server_stats:
+            raise RuntimeError("服务器不支持 STATS 消息")
+        msg = self._recv_for(self._send(IPCMessageType.STATS, data))
+        if msg.type == IPCMessageType.ERROR:
+            raise RuntimeError(f"服务器读取性能统计时出错: {msg.data}")
+        return msg.data
 
     def close(self):
         if hasattr(self, "socket"):
             try:
-                send_str(self.socket, IPCMessageType.QUIT.value)
+                send_message(self.socket, IPCMessage(IPCMessageType.QUIT), self.codec)
             except Exception:
                 pass
             self.socket.close()
+        if getattr(self, "arrays", None) is not None:
+            self.arrays.close()
         if hasattr(self, "process"):
             try:
                 self.process.wait(timeout=5)
@@ -0,0 +1,399 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import itertools
+import threading
+import time
+import traceback
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Sequence,
+    Union,
+)
+
+from my_ipc.ipc_client import IPCClient
+from my_ipc.ipc_client_cache import ResponseCache
+from my_ipc.public import DEFAULT_CODECS, ShmArray, ShmArrayInfo
+
+
+class PoolWorker:
+    """IPCClientPool 中的一个服务器进程及其客户端"""
+
+    def __init__(self, index: int, client: IPCClient):
+        self.index = index
+        self.client = client
+        # 已发出但尚未完成的请求数（包括流式请求）
+        self.inflight = 0
+        # 后台替换该进程的线程；替换失败后 retry_at（time.monotonic）之前不再重试
+        self.replacing: Union[threading.Thread, None] = None
+        self.retry_at = 0.0
+
+
+class IPCClientPool:
+    """
+    用同一个 server_cmd 启动多个服务器进程，把请求分发给负载最小（或轮流）的进程
+    每个进程都有自己的 shm_arrs；进程退出或连接断开后在后台线程中替换，期间请求发给其他进程；
+    分发时跳过已退出的进程，另外每隔 health_check_interval 秒（请求以 ConnectionError 失败后立即）检查所有进程
+    """
+
+    def __init__(
+        self,
+        server_cmd: Union[str, None],  # 启动服务器的命令，需包含 {id} 占位符
+        num_workers: int,
+        shm_arrs: Union[Dict[str, ShmArrayInfo], ShmArrayInfo] = {},
+        max_wait: int = 60,
+        tmp_shm_pool_bytes: int = 1 << 30,  # 每个进程的空闲临时共享内存缓存上限
+        server_id: Union[str, None] = None,  # server_cmd 为 None 时，每个进程都连接该 id 的服务器（例如 zygote）
+        codecs: Sequence[str] = DEFAULT_CODECS,
+        strategy: str = "least_loaded",  # "least_loaded" 或 "round_robin"
+        on_worker_started: Union[Callable[[IPCClient], None], None] = None,  # 进程启动（包括替换）后调用，例如填充共享数组
+        shm_backend: str = "posix",  # 见 IPCClient
+        cache: Union[ResponseCache, None] = None,  # 所有进程共享的响应缓存，见 IPCClient
+        cache_shared_arrays: Sequence[str] = (),
+        health_check_interval: float = 1.0,  # 分发请求时检查进程状态的最小间隔（秒）
+    ):
+        assert num_workers > 0, "num_workers 必须大于 0"
+        assert strategy in ("least_loaded", "round_robin"), f"未知的分发策略: {strategy}"
+        self._client_kwargs: Dict[str, Any] = dict(
+            server_cmd=server_cmd,
+            shm_arrs=shm_arrs,
+            max_wait=max_wait,
+            tmp_shm_pool_bytes=tmp_shm_pool_bytes,
+            server_id=server_id,
+            codecs=codecs,
+            shm_backend=shm_backend,
+            cache=cache,
+            cache_shared_arrays=cache_shared_arrays,
+        )
+        self.strategy = strategy
+        self.on_worker_started = on_worker_started
+        self.health_check_interval = health_check_interval
+        # 下一次分发请求时检查进程状态的时间；置 0 表示立即检查
+        self._next_health_check = time.monotonic() + health_check_interval
+        self._lock = threading.Lock()
+        # 有进程替换完成时通知，所有进程都不可用时 _acquire 在此等待
+        self._replaced = threading.Condition(self._lock)
+        # 串行执行 register/resize/unregister_shared_array；每次修改 shm_arrs 后 _shm_version 加 1
+        self._shm_lock = threading.Lock()
+        self._shm_version = 0
+        self._round_robin = itertools.count()
+        self._closed = False
+
+        # 并行启动所有进程
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                executor.submit(self._start_client, self._client_kwargs)
+                for _ in range(num_workers)
+            ]
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            for f in futures:
+                if f.exception() is None:
+                    f.result().close()
+            raise errors[0]
+        self.workers: List[PoolWorker] = [
+            PoolWorker(i, f.result()) for i, f in enumerate(futures)
+        ]
+
+    def _start_client(self, client_kwargs: Dict[str, Any]) -> IPCClient:
+        client = IPCClient(**client_kwargs)
+        if self.on_worker_started is not None:
+            try:
+                self.on_worker_started(client)
+            except BaseException:
+                client.close()
+                raise
+        return client
+
+    def check_health(self, wait: bool = False) -> int:
+        """
+        在后台线程中替换所有已退出或断开的进程，返回正在替换的进程数
+        wait: 等待这些替换结束（启动失败的进程之后会再次尝试）
+        """
+        with self._lock:
+            for worker in self.workers:
+                if not worker.client.is_alive():
+                    self._start_replacing(worker)
+            threads = [w.replacing for w in self.workers if w.replacing is not None]
+        if wait:
+            for thread in threads:
+                thread.join()
+        return len(threads)
+
+    def _start_replacing(self, worker: PoolWorker):
+        """调用时持有 _lock；正在替换或还在重试间隔内时什么也不做"""
+        if self._closed or worker.replacing is not None or time.monotonic() < worker.retry_at:
+            return
+        worker.replacing = threading.Thread(target=self._replace, args=(worker,), daemon=True)
+        worker.replacing.start()
+
+    def _replace(self, worker: PoolWorker):
+        """在后台线程中启动新进程替换 worker，出错时只记录，不影响分发请求的线程"""
+        old = worker.client
+        with self._lock:
+            client_kwargs, version = self._client_kwargs, self._shm_version
+        client: Union[IPCClient, None] = None
+        try:
+            client = self._start_client(client_kwargs)
+        except Exception:
+            traceback.print_exc()
+        with self._lock:
+            worker.replacing = None
+            installed = (
+                client is not None
+                and not self._closed
+                and worker.client is old
+                # 启动期间共享数组被修改时，新进程不在修改的范围内，不能使用
+                and version == self._shm_version
+            )
+            if installed:
+                worker.client = client
+                # 旧进程上未完成的请求会以 ConnectionError 结束，不再计入新进程的负载
+                worker.inflight = 0
+            elif client is None:
+                worker.retry_at = time.monotonic() + self.health_check_interval
+            else:
+                # 按新的 shm_arrs 尽快重新启动
+                self._next_health_check = 0.0
+            self._replaced.notify_all()
+        if installed:
+            old.close()
+        elif client is not None:
+            client.close()
+
+    def _acquire(self) -> PoolWorker:
+        """选择一个可用的进程并增加其负载计数；所有进程都不可用时最多等待 max_wait 秒"""
+        now = time.monotonic()
+        if now >= self._next_health_check:
+            self._next_health_check = now + self.health_check_interval
+            self.check_health()
+        deadline = now + self._client_kwargs["max_wait"]
+        with self._lock:
+            while True:
+                assert not self._closed, "连接池已关闭"
+                worker = self._pick()
+                if worker is not None:
+                    worker.inflight += 1
+                    return worker
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ConnectionError("连接池中没有可用的进程")
+                # 替换失败的进程过了重试间隔后在 _pick 中再次替换
+                self._replaced.wait(min(remaining, self.health_check_interval))
+
+    def _pick(self) -> Union[PoolWorker, None]:
+        """按分发策略选择进程，跳过正在替换和已退出的进程（并开始替换后者）；调用时持有 _lock"""
+        workers = [w for w in self.workers if w.replacing is None]
+        if self.strategy == "round_robin":
+            start = next(self._round_robin)
+            n = len(self.workers)
+            workers.sort(key=lambda w: (w.index - start) % n)
+        else:
+            workers.sort(key=lambda w: w.inflight)
+        for worker in workers:
+            if worker.client.is_alive():
+                return worker
+            self._start_replacing(worker)
+        return None
+
+    def _release(
+        self, worker: PoolWorker, client: IPCClient, error: Union[BaseException, None] = None
+    ):
+        if isinstance(error, ConnectionError):
+            # 连接断开，下一次分发请求时检查并替换进程
+            self._next_health_check = 0.0
+        with self._lock:
+            if worker.client is client:
+                worker.inflight -= 1
+
+    def submit(
+        self,
+        request: Dict[str, Any],
+        tmp_shm: Union[ShmArrayInfo, None] = None,
+        copy: bool = True,
+        use_cache: bool = True,
+        priority: int = 0,
+        timeout: Union[float, None] = None,
+    ) -> Future:
+        """与 IPCClient.submit 相同，请求被发给负载最小（或轮流选中）的进程"""
+        worker = self._acquire()
+        client = worker.client
+        try:
+            future = client.submit(
+                request,
+                tmp_shm=tmp_shm,
+                copy=copy,
+                use_cache=use_cache,
+                priority=priority,
+                timeout=timeout,
+            )
+        except BaseException as e:
+            self._release(worker, client, e)
+            raise
+        future.add_done_callback(
+            lambda f: self._release(worker, client, None if f.cancelled() else f.exception())
+        )
+        return future
+
+    def send_request(
+        self,
+        request: Dict[str, Any],
+        tmp_shm: Union[ShmArrayInfo, None] = None,
+        copy: bool = True,
+        use_cache: bool = True,
+        priority: int = 0,
+        timeout: Union[float, None] = None,
+    ):
+        """与 IPCClient.send_request 相同"""
+        return self.submit(
+            request,
+            tmp_shm=tmp_shm,
+            copy=copy,
+            use_cache=use_cache,
+            priority=priority,
+            timeout=timeout,
+        ).result()
+
+    def send_stream_request(
+        self,
+        request: Dict[str, Any],
+        window: Union[int, None] = 64,
+        use_cache: bool = True,
+        priority: int = 0,
+        timeout: Union[float, None] = None,
+    ) -> Iterator[Dict[str, Any]]:
+        """与 IPCClient.send_stream_request 相同，迭代结束（或提前放弃）前该流计入进程的负载"""
+        worker = self._acquire()
+        client = worker.client
+        try:
+            responses = client.send_stream_request(
+                request, window=window, use_cache=use_cache, priority=priority, timeout=timeout
+            )
+        except BaseException as e:
+            self._release(worker, client, e)
+            raise
+        return self._iter_stream(worker, client, responses)
+
+    def _iter_stream(
+        self, worker: PoolWorker, client: IPCClient, responses: Iterator[Dict[str, Any]]
+    ) -> Iterator[Dict[str, Any]]:
+        error = None
+        try:
+            yield from responses
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            self._release(worker, client, error)
+
+    def map(
+        self,
+        requests: Iterable[Dict[str, Any]],
+        tmp_shm: Union[ShmArrayInfo, None] = None,
+        copy: bool = True,
+        max_inflight: Union[int, None] = None,  # 同时未完成的请求数上限，默认为进程数的 2 倍
+    ) -> Iterator[Any]:
+        """
+        把 requests 分发给所有进程并行处理，按 requests 的顺序返回结果
+        请求按需从 requests 中取出，因此可以传入很长的生成器
+        """
+        if max_inflight is None:
+            max_inflight = 2 * len(self.workers)
+        futures: Deque[Future] = deque()
+        for request in requests:
+            if len(futures) >= max_inflight:
+                yield futures.popleft().result()
+            futures.append(self.submit(request, tmp_shm=tmp_shm, copy=copy))
+        while futures:
+            yield futures.popleft().result()
+
+    def get_shared_arrays(self, name: str = "default") -> List[ShmArray]:
+        """返回每个进程的同名共享数组，例如需要向所有进程写入相同的数据时使用"""
+        with self._lock:
+            return [w.client.get_shared_array(name) for w in self.workers]
+
+    def register_shared_array(
+        self, name: str, info: ShmArrayInfo, capacity: Union[int, None] = None
+    ) -> List[ShmArray]:
+        """
+        在所有进程上注册共享数组，之后替换的进程也会带有该数组
+        返回各进程的共享数组；已退出的进程不在其中，替换它的进程启动时即带有该数组
+        """
+        return self._update_shared_array(
+            name, info, lambda c: c.register_shared_array(name, info, capacity)
+        )
+
+    def resize_shared_array(self, name: str, info: ShmArrayInfo) -> List[ShmArray]:
+        """在所有进程上调整共享数组的大小，见 IPCClient.resize_shared_array"""
+        return self._update_shared_array(
+            name, info, lambda c: c.resize_shared_array(name, info)
+        )
+
+    def unregister_shared_array(self, name: str):
+        """在所有进程上注销共享数组"""
+        self._update_shared_array(name, None, lambda c: c.unregister_shared_array(name))
+
+    def _update_shared_array(
+        self,
+        name: str,
+        info: Union[ShmArrayInfo, None],
+        update: Callable[[IPCClient], Any],
+    ) -> List[Any]:
+        with self._shm_lock:
+            results = []
+            for client in self._set_shm_info(name, info):
+                try:
+                    results.append(update(client))
+                except Exception:
+                    if client.is_alive():
+                        raise
+                    # 进程已退出：替换它的进程按更新后的 shm_arrs 启动
+                    self._next_health_check = 0.0
+            return results
+
+    def _set_shm_info(self, name: str, info: Union[ShmArrayInfo, None]) -> List[IPCClient]:
+        """
+        更新启动新进程时使用的 shm_arrs，返回当前所有进程的客户端
+        此后完成替换的进程都使用新的 shm_arrs，见 _replace
+        """
+        with self._lock:
+            shm_arrs = self._client_kwargs["shm_arrs"]
+            if isinstance(shm_arrs, ShmArrayInfo):
+                shm_arrs = {"default": shm_arrs}
+            shm_arrs = dict(shm_arrs)
+            if info is None:
+                shm_arrs.pop(name, None)
+            else:
+                shm_arrs[name] = info
+            # 复制后再修改，正在启动的进程读到的 _client_kwargs 保持不变
+            self._client_kwargs = dict(self._client_kwargs, shm_arrs=shm_arrs)
+            self._shm_version += 1
+            return [w.client for w in self.workers]
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            workers = list(getattr(self, "workers", []))
+            replacing = [w.replacing for w in workers if w.replacing is not None]
+        for worker in workers:
+            worker.client.close()
+        # 正在启动的替换进程在启动完成后自行关闭，等待它们以免留下孤儿进程
+        for thread in replacing:
+            thread.join()
+
+    def __enter__(self) -> "IPCClientPool":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        if hasattr(self, "_lock"):
+            self.close()
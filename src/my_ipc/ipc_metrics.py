@@ -0,0 +1,153 @@
+from collections import deque
+import json
+import os
+import threading
+import time
+from typing import Any, Deque, Dict, List, Union
+
+# 每个 2 倍区间分成的桶数（2 的幂），分位数的相对误差不超过 1 / _SUB_BUCKETS
+_SUB_BUCKETS = 8
+_SUB_BITS = _SUB_BUCKETS.bit_length() - 1
+
+
+def _bucket(ns: int) -> int:
+    """对数线性分桶：小于 2 * _SUB_BUCKETS 的值各占一个桶，之后每个 2 倍区间 _SUB_BUCKETS 个桶"""
+    if ns < 2 * _SUB_BUCKETS:
+        return max(ns, 0)
+    shift = ns.bit_length() - _SUB_BITS - 1
+    return shift * _SUB_BUCKETS + (ns >> shift)
+
+
+def _bucket_midpoint(bucket: int) -> float:
+    if bucket < 2 * _SUB_BUCKETS:
+        return float(bucket)
+    shift = bucket // _SUB_BUCKETS - 1
+    return ((bucket % _SUB_BUCKETS + _SUB_BUCKETS) << shift) + (1 << shift) / 2
+
+
+class Histogram:
+    """耗时直方图（纳秒），记录一次只需一次分桶计算和几次加法"""
+
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets: Dict[int, int] = {}
+
+    def record(self, ns: int):
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+        bucket = _bucket(ns)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, q: float) -> float:
+        """第 q（0~1）分位数的估计值（纳秒），取所在桶的中点"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(_bucket_midpoint(bucket), float(self.max))
+        return float(self.max)
+
+    def summary(self) -> Dict[str, float]:
+        """次数，以及以秒为单位的总耗时、平均值、p50/p90/p99 和最大值"""
+        return {
+            "count": self.count,
+            "total": self.total / 1e9,
+            "mean": self.total / self.count / 1e9 if self.count else 0.0,
+            "p50": self.percentile(0.5) / 1e9,
+            "p90": self.percentile(0.9) / 1e9,
+            "p99": self.percentile(0.99) / 1e9,
+            "max": self.max / 1e9,
+        }
+
+
+class Metrics:
+    """
+    客户端或服务器的性能统计：各阶段耗时的直方图、字节数和消息数等计数器，以及可选的 trace 事件
+    时间戳使用 time.perf_counter_ns（Linux 上为 CLOCK_MONOTONIC），同一台机器上各进程的事件可以合并到一条时间线
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases: Dict[str, Histogram] = {}
+        self._counters: Dict[str, int] = {}
+        self._since = time.perf_counter_ns()
+        # 开启 trace 后保存最近的事件，超过上限时丢弃最早的
+        self._trace: Union[Deque[Dict[str, Any]], None] = None
+        self._pid = os.getpid()
+
+    def observe(self, phase: str, start_ns: int, end_ns: Union[int, None] = None, id: int = 0):
+        """记录阶段 phase 从 start_ns 到 end_ns（默认为现在）的耗时；id 为请求 id，写入 trace 事件"""
+        if end_ns is None:
+            end_ns = time.perf_counter_ns()
+        with self._lock:
+            histogram = self._phases.get(phase)
+            if histogram is None:
+                histogram = self._phases[phase] = Histogram()
+            histogram.record(end_ns - start_ns)
+            if self._trace is not None:
+                self._trace.append(
+                    {
+                        "name": phase,
+                        "ph": "X",
+                        "ts": start_ns / 1000,
+                        "dur": (end_ns - start_ns) / 1000,
+                        "pid": self._pid,
+                        "tid": threading.get_ident(),
+                        "args": {"id": id},
+                    }
+                )
+
+    def add(self, counter: str, n: int = 1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + n
+
+    def snapshot(self, reset: bool = False) -> Dict[str, Any]:
+        """
+        返回统计窗口（上次 reset 以来）的秒数、各阶段的 Histogram.summary、计数器及其每秒速率
+        reset: 读取后清零，便于按时间段统计
+        """
+        now = time.perf_counter_ns()
+        with self._lock:
+            elapsed = (now - self._since) / 1e9
+            stats = {
+                "elapsed": elapsed,
+                "phases": {name: h.summary() for name, h in self._phases.items()},
+                "counters": dict(self._counters),
+                "rates": {
+                    name: n / elapsed if elapsed > 0 else 0.0
+                    for name, n in self._counters.items()
+                },
+            }
+            if reset:
+                self._phases = {}
+                self._counters = {}
+                self._since = now
+        return stats
+
+    def start_trace(self, max_events: int = 1 << 20):
+        """开始记录 trace 事件，最多保留最近的 max_events 个"""
+        with self._lock:
+            # zygote 模式下 fork 出的子进程继承了父进程的 Metrics
+            self._pid = os.getpid()
+            self._trace = deque(maxlen=max_events)
+
+    def stop_trace(self) -> List[Dict[str, Any]]:
+        """停止记录并取走已记录的 trace 事件"""
+        with self._lock:
+            events, self._trace = self._trace, None
+        return list(events or ())
+
+
+def write_trace(path: str, events: List[Dict[str, Any]]):
+    """把 trace 事件写为 Chrome trace 格式的 JSON，可以用 Perfetto 或 chrome://tracing 打开"""
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -1,90 +1,1102 @@
-import json
-from multiprocessing import resource_tracker, shared_memory
+from collections import deque
+from concurrent.futures import Executor, Future, wait
+import contextvars
+import heapq
+import itertools
 import os
+import select
+import selectors
 import socket
-from typing import Any, Dict, Iterable, Union
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Callable, Deque, Dict, Iterable, List, Sequence, Set, Tuple, Union
 
 import numpy as np
+from my_ipc.ipc_metrics import Metrics
 from my_ipc.public import (
+    ArrayTransport,
+    DEADLINE_EXCEEDED,
+    IPCChannel,
+    apply_shm_update,
+    choose_codec,
+    IPCMessage,
     IPCMessageType,
     ShmArrayInfo,
     ShmArray,
+    ShmArena,
+    ShmArrayPool,
+    ShmAttachCache,
+    ShmRing,
+    RingClosedError,
     generate_socket_path,
-    generate_shm_name,
-    recv_str,
-    send_str,
+    notify_ready,
+    open_shm_array,
+    request_deadline,
+    schedule_key,
+    set_nodelay,
+    tcp_listen,
 )
 
+# 可以被调度器重新排序的消息类型，其他消息（SHM_UPDATE 等）之后的请求不会被提到它之前
+_SCHEDULABLE = (IPCMessageType.REQUEST, IPCMessageType.STREAM_REQUEST)
+_CONTROL = (IPCMessageType.CREDIT, IPCMessageType.CANCEL)
+
+
+class IPCConnection:
+    """服务器端的一个客户端连接，持有该客户端独占的共享内存映射"""
+
+    def __init__(self, sock: socket.socket, tmp_shm_cache_bytes: int):
+        self.sock = sock
+        # 通过 TCP 连接的客户端可能在另一台机器上，不能映射双方的共享内存：
+        # 数组随消息发送，共享数组和 tmp_shm 使用服务器自己的副本
+        self.remote = sock.family != socket.AF_UNIX
+        set_nodelay(sock)
+        self.channel = IPCChannel(sock)
+        self.shm_arrs: Dict[str, ShmArray] = {}
+        # 缓存客户端临时共享内存的映射，客户端复用同一段时无需重新 attach
+        self.tmp_shm_cache = ShmAttachCache(max_bytes=tmp_shm_cache_bytes)
+        # 向客户端发送大数组使用的共享内存池，协商启用数组自动传输后创建
+        self.array_pool: Union[ShmArrayPool, None] = None
+        # allocate_output 使用的 arena，协商启用数组自动传输后创建
+        self.arena: Union[ShmArena, None] = None
+        # 在执行器中尚未完成的请求，关闭连接前需要等待它们结束
+        self.inflight: Set[Future] = set()
+        self.inflight_lock = threading.Lock()
+        # 客户端已断开，正在等待写入的流可以放弃
+        self.closed = False
+        # 正在执行的流式请求的发送额度，按请求 id 索引
+        self.streams: Dict[int, StreamCredit] = {}
+        # 已接收、尚未处理的消息及其到达时间（time.perf_counter_ns），
+        # 未配置执行器时从中选出优先级最高的请求处理
+        self.backlog: Deque[Tuple[IPCMessage, int]] = deque()
+
+    def close(self):
+        self.channel.close()
+        for shm_arr in self.shm_arrs.values():
+            shm_arr.close()
+        self.tmp_shm_cache.close()
+        if self.array_pool is not None:
+            self.array_pool.close()
+        if self.arena is not None:
+            self.arena.close()
+
+
+# 当前线程正在服务的连接，供 get_shared_array 等方法定位该连接的共享内存
+_current_connection: "contextvars.ContextVar[IPCConnection]" = contextvars.ContextVar(
+    "_current_connection"
+)
+
+
+class StreamCredit:
+    """
+    一个流式请求的发送额度
+    客户端在 STREAM_REQUEST 中给出窗口大小，之后每消费一部分数据就用 CREDIT 补充额度；
+    额度用完时服务器暂停生成器，客户端发送 CANCEL（或断开连接）时停止它
+    """
+
+    def __init__(self, window: Union[int, None], priority: int = 0):
+        self.credits = window  # None 表示不限
+        self.cancelled = False
+        self.cond = threading.Condition()
+        # 未配置执行器时，流在两个数据之间先处理优先级更高的请求
+        self.priority = priority
+
+    def grant(self, n: int):
+        with self.cond:
+            if self.credits is not None:
+                self.credits += n
+            self.cond.notify()
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify()
+
+    def take(self, block: bool = True) -> bool:
+        """取得发送一个数据的额度；block 为 False 时额度不足立即返回 False"""
+        with self.cond:
+            if block:
+                self.cond.wait_for(lambda: self.cancelled or self.credits != 0)
+            if self.cancelled or self.credits == 0:
+                return False
+            if self.credits is not None:
+                self.credits -= 1
+            return True
+
+
+class BatchItem:
+    """等待被合并处理的一个请求"""
+
+    __slots__ = ("conn", "msg", "tmp_shm_arr", "future", "enqueued_at", "received_at")
+
+    def __init__(
+        self,
+        conn: IPCConnection,
+        msg: IPCMessage,
+        tmp_shm_arr: Union[ShmArray, None],
+        received_at: int,
+    ):
+        self.conn = conn
+        self.msg = msg
+        self.tmp_shm_arr = tmp_shm_arr
+        # 响应发出后完成，连接关闭前需要等待
+        self.future: Future = Future()
+        self.enqueued_at = time.monotonic()
+        self.received_at = received_at  # time.perf_counter_ns()
+
+    def key(self) -> Tuple[int, float, int, int]:
+        return schedule_key(self.msg, self.received_at)
+
+
+class RequestBatcher:
+    """
+    收集并发到达的请求（来自流水线请求或多个客户端），
+    凑满 max_batch_size 个或最早的请求已等待 max_wait 秒时，把这一批交给 handler
+    """
+
+    def __init__(
+        self,
+        handler: Callable[[List[BatchItem]], None],
+        max_batch_size: int,
+        max_wait: float,
+    ):
+        assert max_batch_size > 0, "max_batch_size 必须大于 0"
+        self.handler = handler
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: Deque[BatchItem] = deque()
+        self._cond = threading.Condition()
+        self._thread: Union[threading.Thread, None] = None
+        self._closed = False
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._batches = 0
+        self._requests = 0
+        self._max_batch_size = 0
+        self._total_delay = 0.0
+        self._max_delay = 0.0
+
+    def submit(self, item: BatchItem):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._queue.append(item)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                deadline = self._queue[0].enqueued_at + self.max_wait
+                while len(self._queue) < self.max_batch_size and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                n = min(self.max_batch_size, len(self._queue))
+                if n == len(self._queue):
+                    batch = list(self._queue)
+                    self._queue.clear()
+                else:
+                    # 排队的请求多于一批时，先处理优先级高、截止时间早的
+                    batch = heapq.nsmallest(n, self._queue, key=BatchItem.key)
+                    chosen = set(map(id, batch))
+                    self._queue = deque(
+                        item for item in self._queue if id(item) not in chosen
+                    )
+                now = time.monotonic()
+                delays = [now - item.enqueued_at for item in batch]
+                self._batches += 1
+                self._requests += n
+                self._max_batch_size = max(self._max_batch_size, n)
+                self._total_delay += sum(delays)
+                self._max_delay = max(self._max_delay, max(delays))
+            try:
+                self.handler(batch)
+            except Exception:
+                # 一批出错不能让批处理线程退出，否则之后的请求都得不到响应
+                traceback.print_exc()
+
+    def stats(self, reset: bool = False) -> Dict[str, float]:
+        """
+        批处理统计：批数、请求数、平均/最大批大小、平均/最大排队延迟（秒）
+        reset: 读取后清零，便于按时间段统计
+        """
+        with self._cond:
+            stats = {
+                "batches": self._batches,
+                "requests": self._requests,
+                "mean_batch_size": self._requests / self._batches if self._batches else 0.0,
+                "max_batch_size": self._max_batch_size,
+                "mean_queue_delay": self._total_delay / self._requests if self._requests else 0.0,
+                "max_queue_delay": self._max_delay,
+                "queued": len(self._queue),
+            }
+            if reset:
+                self._reset_stats()
+        return stats
+
+    def close(self):
+        """处理完已排队的请求后停止批处理线程，之后仍可继续 submit"""
+        with self._cond:
+            self._closed = True
+            thread, self._thread = self._thread, None
+            self._cond.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        with self._cond:
+            self._closed = False
+
+
+class RequestScheduler:
+    """
+    配置了执行器和 max_concurrency 时按优先级把请求交给执行器：同时执行的请求不超过 max_concurrency 个，
+    其余的在这里排队，每当有请求结束就取出优先级最高（相同时截止时间最早）的一个执行
+    """
+
+    def __init__(self, executor: Executor, max_concurrency: int):
+        assert max_concurrency > 0, "max_concurrency 必须大于 0"
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        self._heap: List[Tuple[Tuple[int, float, int, int], int, Any, Future]] = []
+        self._counter = itertools.count()
+        self._running = 0
+        self._lock = threading.Lock()
+
+    def submit(
+        self, key: Tuple[int, float, int, int], fn: Callable[..., None], *args
+    ) -> Future:
+        """在当前上下文中排队执行 fn(*args)，返回其完成时完成的 Future"""
+        future: Future = Future()
+        ctx = contextvars.copy_context()
+        with self._lock:
+            heapq.heappush(
+                self._heap, (key, next(self._counter), (ctx, fn, args), future)
+            )
+        self._pump()
+        return future
+
+    def _pump(self):
+        while True:
+            with self._lock:
+                if self._running >= self.max_concurrency or not self._heap:
+                    return
+                _, _, (ctx, fn, args), future = heapq.heappop(self._heap)
+                self._running += 1
+            inner = self.executor.submit(ctx.run, fn, *args)
+            inner.add_done_callback(lambda inner, f=future: self._finished(inner, f))
+
+    def _finished(self, inner: Future, future: Future):
+        with self._lock:
+            self._running -= 1
+        if inner.exception() is not None:
+            future.set_exception(inner.exception())
+        else:
+            future.set_result(inner.result())
+        self._pump()
+
 
 class IPCServer:
     """IPC服务器基类"""
 
-    def __init__(self, id: str):
+    def __init__(
+        self,
+        id: str,
+        tmp_shm_cache_bytes: int = 1 << 30,
+        executor: Union[Executor, None] = None,  # 执行 handle_* 的执行器，默认在连接线程中直接执行
+        max_batch_size: Union[int, None] = None,  # 设置后启用批处理，普通请求合并后交给 handle_batch
+        max_batch_wait: float = 0.002,  # 批中最早的请求最多等待的秒数
+        metrics: bool = False,  # 记录各阶段耗时和收发的字节数，见 get_stats；每次收发都有额外开销
+        max_concurrency: Union[int, None] = None,  # 执行器中同时执行的请求数，默认不限，直接交给执行器
+        address: Union[str, None] = None,  # 设置后在该 TCP 地址（host:port）上监听，而不是 Unix socket
+    ):
         self.id = id
+        self.address = address
         self.socket_path = generate_socket_path(self.id)
         self.shm_arrs: Dict[str, ShmArray] = {}
+        self.tmp_shm_cache_bytes = tmp_shm_cache_bytes
+        self.executor = executor
+        # 配置了执行器和 max_concurrency 时，超出的请求按优先级和截止时间排队
+        self.scheduler: Union[RequestScheduler, None] = None
+        if executor is not None and max_concurrency is not None:
+            self.scheduler = RequestScheduler(executor, max_concurrency)
+        self.batcher: Union[RequestBatcher, None] = None
+        if max_batch_size is not None:
+            self.batcher = RequestBatcher(
+                self._dispatch_batch, max_batch_size, max_batch_wait
+            )
+        self._stop_event = threading.Event()
+        self._stop_w: Union[int, None] = None
+        # 所有连接共用
+        self.metrics = Metrics() if metrics else None
 
-    def start_server(self):
-        """启动服务器监听"""
-        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    def start_server(self, max_clients: Union[int, None] = 1, exit_when_idle: bool = True):
+        """
+        启动服务器监听
+        max_clients: 同时服务的客户端数量上限，None 表示不限；为 1 时只服务第一个连接的客户端
+        exit_when_idle: 多客户端模式下，最后一个客户端断开后是否退出
+        """
+        server_socket = self._listen(1 if max_clients == 1 else socket.SOMAXCONN)
+        try:
+            notify_ready()
+            if max_clients == 1:
+                client_socket, _ = server_socket.accept()
+                self._serve_single(client_socket)
+            else:
+                self._serve_forever(server_socket, max_clients, exit_when_idle)
+        finally:
+            self._close_listener(server_socket)
+            if self.batcher is not None:
+                self.batcher.close()
+
+    def start_zygote(self):
+        """
+        以 zygote 模式启动：先调用一次 warmup 预加载模型等资源，然后为每个连接 fork 一个子进程
+        子进程以写时复制的方式共享 warmup 中加载的数据，直接服务该连接，客户端断开后退出；
+        客户端以 server_id 连接本服务器即可，协议与普通服务器相同
+        zygote 进程本身一直运行到 stop 或收到信号，已 fork 的子进程不受影响
+        """
+        self.warmup()
+        server_socket = self._listen(socket.SOMAXCONN)
+        stop_r, self._stop_w = os.pipe()
+        selector = selectors.DefaultSelector()
+        children: Set[int] = set()
 
+        try:
+            selector.register(server_socket, selectors.EVENT_READ)
+            selector.register(stop_r, selectors.EVENT_READ)
+            notify_ready()
+            while not self._stop_event.is_set():
+                # 定期回收已退出的子进程
+                events = selector.select(timeout=1)
+                self._reap_children(children)
+                for key, _ in events:
+                    if key.fileobj is not server_socket:
+                        continue
+                    client_socket, _ = server_socket.accept()
+                    # 避免缓冲区中尚未输出的内容在子进程中再输出一次
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    pid = os.fork()
+                    if pid == 0:
+                        code = 0
+                        try:
+                            selector.close()
+                            server_socket.close()
+                            os.close(stop_r)
+                            os.close(self._stop_w)
+                            self._stop_w = None
+                            self.after_fork()
+                            self._serve_single(client_socket)
+                        except BaseException:
+                            traceback.print_exc()
+                            code = 1
+                        finally:
+                            sys.stdout.flush()
+                            sys.stderr.flush()
+                            # 不执行 zygote 的清理逻辑（例如删除 socket 文件）
+                            os._exit(code)
+                    children.add(pid)
+                    client_socket.close()
+        finally:
+            selector.close()
+            self._close_listener(server_socket)
+            os.close(stop_r)
+            os.close(self._stop_w)
+            self._stop_w = None
+            self._stop_event.clear()
+            self._reap_children(children)
+
+    def _listen(self, backlog: int) -> socket.socket:
+        """在 Unix socket（默认）或 address 指定的 TCP 地址上监听"""
+        if self.address is not None:
+            server_socket = tcp_listen(self.address, backlog)
+            # 端口为 0 时由系统分配，记录实际监听的地址
+            host, port = server_socket.getsockname()[:2]
+            self.address = f"[{host}]:{port}" if ":" in host else f"{host}:{port}"
+            return server_socket
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         try:
             server_socket.bind(self.socket_path)
-            server_socket.listen(1)
+            server_socket.listen(backlog)
+        except BaseException:
+            server_socket.close()
+            raise
+        return server_socket
+
+    def _close_listener(self, server_socket: socket.socket):
+        server_socket.close()
+        if self.address is None:
+            os.unlink(self.socket_path)
+
+    @staticmethod
+    def _reap_children(children: Set[int]):
+        for pid in list(children):
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except ChildProcessError:
+                done = pid
+            if done != 0:
+                children.discard(pid)
+
+    def _serve_single(self, client_socket: socket.socket):
+        """在当前线程中服务唯一的客户端，直到其断开"""
+        conn = IPCConnection(client_socket, self.tmp_shm_cache_bytes)
+        self.shm_arrs = conn.shm_arrs
+        try:
+            _current_connection.set(conn)
+            self._serve_connection(conn)
+        finally:
+            conn.close()
+
+    def stop(self):
+        """通知多客户端模式或 zygote 模式的服务器退出，可以在任意线程中调用"""
+        self._stop_event.set()
+        if self._stop_w is not None:
+            try:
+                os.write(self._stop_w, b"x")
+            except OSError:
+                pass
+
+    def _serve_forever(
+        self,
+        server_socket: socket.socket,
+        max_clients: Union[int, None],
+        exit_when_idle: bool,
+    ):
+        stop_r, self._stop_w = os.pipe()
+        selector = selectors.DefaultSelector()
+        selector.register(server_socket, selectors.EVENT_READ)
+        selector.register(stop_r, selectors.EVENT_READ)
+        conns: Dict[IPCConnection, threading.Thread] = {}
+        lock = threading.Lock()
+
+        def serve(conn: IPCConnection):
+            _current_connection.set(conn)
+            try:
+                self._serve_connection(conn)
+            except Exception:
+                # 单个客户端出错只断开该连接，不影响其他客户端
+                traceback.print_exc()
+            finally:
+                conn.close()
+                with lock:
+                    del conns[conn]
+                    idle = len(conns) == 0
+                if idle and exit_when_idle:
+                    self.stop()
+
+        try:
+            while not self._stop_event.is_set():
+                for key, _ in selector.select():
+                    if key.fileobj is not server_socket:
+                        continue
+                    client_socket, _ = server_socket.accept()
+                    with lock:
+                        if max_clients is not None and len(conns) >= max_clients:
+                            client_socket.close()
+                            continue
+                        conn = IPCConnection(client_socket, self.tmp_shm_cache_bytes)
+                        thread = threading.Thread(target=serve, args=(conn,), daemon=True)
+                        conns[conn] = thread
+                    thread.start()
+        finally:
+            with lock:
+                remaining = list(conns.items())
+            for conn, thread in remaining:
+                try:
+                    # 唤醒阻塞在 recv 上的连接线程
+                    conn.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            for conn, thread in remaining:
+                thread.join()
+            selector.close()
+            os.close(stop_r)
+            os.close(self._stop_w)
+            self._stop_w = None
+            self._stop_event.clear()
+
+    def _call_handler(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """在执行器中调用 fn 并等待其完成，保留当前连接的上下文"""
+        if self.executor is None:
+            return fn(*args, **kwargs)
+        ctx = contextvars.copy_context()
+        return self.executor.submit(ctx.run, fn, *args, **kwargs).result()
+
+    def _dispatch(
+        self,
+        conn: IPCConnection,
+        key: Tuple[int, float, int, int],
+        fn: Callable[..., None],
+        *args,
+    ):
+        """
+        执行一个请求的处理函数
+        未配置执行器时直接执行，请求由接收循环按优先级依次选出；
+        配置了执行器时异步执行，同一连接上的多个请求可以并发处理、乱序返回；
+        设置了 max_concurrency 时，超出的请求按 key（见 schedule_key）排队
+        """
+        if self.executor is None:
+            fn(*args)
+            return
+        if self.scheduler is not None:
+            future = self.scheduler.submit(key, fn, *args)
+        else:
+            ctx = contextvars.copy_context()
+            future = self.executor.submit(ctx.run, fn, *args)
+        with conn.inflight_lock:
+            conn.inflight.add(future)
+
+        def on_done(future: Future):
+            with conn.inflight_lock:
+                conn.inflight.discard(future)
+            if future.exception() is not None:
+                # 错误已经以 ERROR 消息通知客户端，这里只记录
+                traceback.print_exception(
+                    type(future.exception()), future.exception(), None
+                )
+
+        future.add_done_callback(on_done)
+
+    def _process_request(
+        self,
+        conn: IPCConnection,
+        msg: IPCMessage,
+        tmp_shm_arr: Union[ShmArray, None],
+        received_at: int,
+    ):
+        metrics = self.metrics
+        if self._deadline_exceeded(conn, msg, received_at):
+            if tmp_shm_arr is not None:
+                tmp_shm_arr._lease_finished()
+            return
+        start = time.perf_counter_ns()
+        try:
+            response = self.handle_request(msg.data, tmp_shm=tmp_shm_arr)
+        except Exception as e:
+            if tmp_shm_arr is not None:
+                tmp_shm_arr._lease_finished()
+            conn.channel.send(IPCMessage(IPCMessageType.ERROR, msg.id, repr(e)))
+            raise
+        finally:
+            if metrics is not None:
+                # 从收到请求到开始处理（等待执行器或前面的请求）、处理请求
+                metrics.observe("queue", received_at, start, msg.id)
+                metrics.observe("handler", start, id=msg.id)
+        start = time.perf_counter_ns()
+        try:
+            conn.channel.send(self._response(conn, msg.id, response, tmp_shm_arr))
+        except OSError:
+            raise
+        except Exception as e:
+            # 例如响应无法用协商的编解码器编码：只有该请求失败，连接继续服务
+            traceback.print_exc()
+            self._send_error(conn, msg.id, e)
+        finally:
+            if tmp_shm_arr is not None:
+                tmp_shm_arr._lease_finished()
+        if metrics is not None:
+            metrics.observe("reply", start, id=msg.id)
+
+    @staticmethod
+    def _response(
+        conn: IPCConnection, msg_id: int, response: Any, tmp_shm_arr: Union[ShmArray, None]
+    ) -> IPCMessage:
+        """RESPONSE 消息；远程连接的 tmp_shm 结果在服务器自己的共享内存中，随响应一起发送"""
+        if tmp_shm_arr is None or not conn.remote:
+            return IPCMessage(IPCMessageType.RESPONSE, msg_id, response)
+        info = tmp_shm_arr.get_info()
+        result = np.ndarray(info.shape, dtype=info.dtype, buffer=tmp_shm_arr.shm.buf)
+        return IPCMessage(
+            IPCMessageType.RESPONSE, msg_id, [response, result], {"tmp_shm": "inline"}
+        )
+
+    @staticmethod
+    def _send_error(conn: IPCConnection, msg_id: int, error: Exception):
+        """以 ERROR 消息通知客户端请求失败；客户端已断开时忽略"""
+        try:
+            conn.channel.send(IPCMessage(IPCMessageType.ERROR, msg_id, repr(error)))
+        except OSError:
+            pass
+
+    def _deadline_exceeded(self, conn: IPCConnection, msg: IPCMessage, received_at: int) -> bool:
+        """请求已超过截止时间时回复 DEADLINE_EXCEEDED 错误并返回 True，不再调用处理函数"""
+        now = time.perf_counter_ns()
+        deadline = request_deadline(msg, received_at)
+        if now <= deadline:
+            return False
+        if self.metrics is not None:
+            self.metrics.add("deadline_exceeded")
+        try:
+            conn.channel.send(
+                IPCMessage(
+                    IPCMessageType.ERROR,
+                    msg.id,
+                    f"截止时间已过 {(now - deadline) / 1e6:.1f} ms",
+                    {"code": DEADLINE_EXCEEDED},
+                )
+            )
+        except OSError:
+            pass
+        return True
 
-            client_socket, _ = server_socket.accept()
+    def _dispatch_batch(self, batch: List[BatchItem]):
+        """在批处理线程中调用；配置了执行器时在执行器中处理，以便同时收集下一批"""
+        if self.executor is None:
+            self._process_batch(batch)
+        else:
+            self.executor.submit(self._process_batch, batch)
 
-            data = recv_str(client_socket)
-            shm_infos = json.loads(data)
-            for name, info_json in shm_infos.items():
-                info = ShmArrayInfo.from_json(info_json)
-                self.shm_arrs[name] = ShmArray(
-                    info=info, name=generate_shm_name(self.id, name), create=False
+    def _process_batch(self, batch: List[BatchItem]):
+        expired = [
+            item for item in batch
+            if self._deadline_exceeded(item.conn, item.msg, item.received_at)
+        ]
+        for item in expired:
+            if item.tmp_shm_arr is not None:
+                item.tmp_shm_arr._lease_finished()
+            item.future.set_result(None)
+        batch = [item for item in batch if item not in expired]
+        if not batch:
+            return
+        metrics = self.metrics
+        start = time.perf_counter_ns()
+        if metrics is not None:
+            for item in batch:
+                metrics.observe("queue", item.received_at, start, item.msg.id)
+        # 整批来自同一个连接时，handle_batch 中可以使用 get_shared_array
+        token = None
+        if all(item.conn is batch[0].conn for item in batch):
+            token = _current_connection.set(batch[0].conn)
+        try:
+            responses = self.handle_batch(
+                [item.msg.data for item in batch],
+                [item.tmp_shm_arr for item in batch],
+            )
+            assert len(responses) == len(batch), (
+                f"handle_batch 返回了 {len(responses)} 个响应，期望 {len(batch)} 个"
+            )
+        except Exception as e:
+            responses = [e] * len(batch)
+        finally:
+            if token is not None:
+                _current_connection.reset(token)
+            if metrics is not None:
+                metrics.observe("handler", start, id=batch[0].msg.id)
+        for error in {id(r): r for r in responses if isinstance(r, Exception)}.values():
+            # 错误会以 ERROR 消息通知客户端，这里只记录
+            traceback.print_exception(type(error), error, error.__traceback__)
+        for item, response in zip(batch, responses):
+            start = time.perf_counter_ns()
+            try:
+                if isinstance(response, Exception):
+                    item.conn.channel.send(
+                        IPCMessage(IPCMessageType.ERROR, item.msg.id, repr(response))
+                    )
+                else:
+                    item.conn.channel.send(
+                        self._response(item.conn, item.msg.id, response, item.tmp_shm_arr)
+                    )
+            except OSError:
+                # 该客户端已断开，不影响同一批中的其他请求
+                pass
+            except Exception as e:
+                # 例如响应无法用协商的编解码器编码
+                traceback.print_exc()
+                self._send_error(item.conn, item.msg.id, e)
+            finally:
+                if item.tmp_shm_arr is not None:
+                    item.tmp_shm_arr._lease_finished()
+                if metrics is not None:
+                    metrics.observe("reply", start, id=item.msg.id)
+                item.future.set_result(None)
+
+    def _process_stream_request(
+        self, conn: IPCConnection, msg: IPCMessage, received_at: int
+    ):
+        stream = conn.streams[msg.id]
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.observe("queue", received_at, id=msg.id)
+        if self._deadline_exceeded(conn, msg, received_at):
+            del conn.streams[msg.id]
+            return
+        if msg.meta and "ring" in msg.meta:
+            try:
+                self._process_ring_stream_request(conn, msg, msg.meta["ring"]["name"], stream)
+            finally:
+                del conn.streams[msg.id]
+            return
+        responses = iter(self.handle_stream_request(msg.data))
+        try:
+            # 先取得额度再生成下一个数据，客户端取消后不再多计算
+            while self._take_credit(conn, stream):
+                start = time.perf_counter_ns()
+                try:
+                    response = next(responses)
+                except StopIteration:
+                    break
+                if metrics is not None:
+                    # 生成一个流数据的耗时
+                    metrics.observe("stream_item", start, id=msg.id)
+                    metrics.add("stream_items")
+                conn.channel.send(
+                    IPCMessage(IPCMessageType.STREAM_DATA, msg.id, response)
                 )
+            else:
+                # 客户端已取消该流或断开连接
+                return
+        except Exception as e:
+            conn.channel.send(IPCMessage(IPCMessageType.ERROR, msg.id, repr(e)))
+            raise
+        finally:
+            del conn.streams[msg.id]
+            if hasattr(responses, "close"):
+                responses.close()
+        conn.channel.send(IPCMessage(IPCMessageType.STREAM_END, msg.id))
+
+    def _take_credit(self, conn: IPCConnection, stream: StreamCredit) -> bool:
+        """等待发送下一个流数据的额度，返回 False 表示客户端已取消该流"""
+        if self.executor is not None:
+            return stream.take()
+        # 流在接收线程中执行：自己接收控制消息，优先级更高的请求先处理，其他消息留到流结束后再处理
+        self._receive_control(conn, block=False)
+        self._serve_urgent(conn, stream.priority)
+        while not stream.take(block=False):
+            if stream.cancelled:
+                return False
+            self._receive_control(conn, block=True)
+            self._serve_urgent(conn, stream.priority)
+        return True
+
+    def _serve_urgent(self, conn: IPCConnection, priority: int):
+        """处理 backlog 中优先级高于 priority 的普通请求（不越过 SHM_UPDATE 等消息）"""
+        i = 0
+        while i < len(conn.backlog):
+            msg, received_at = conn.backlog[i]
+            if msg.type in _CONTROL:
+                i += 1
+                continue
+            if msg.type not in _SCHEDULABLE:
+                return
+            if (
+                msg.type == IPCMessageType.REQUEST
+                and (msg.meta or {}).get("priority", 0) > priority
+            ):
+                del conn.backlog[i]
+                self._handle_request(conn, msg, received_at)
+            else:
+                i += 1
+
+    def _receive_pending(self, conn: IPCConnection):
+        """把已到达的消息全部放入 backlog，以便从中选出优先级最高的请求"""
+        try:
+            while conn.channel.reader.buffered() or select.select([conn.sock], [], [], 0)[0]:
+                conn.backlog.append((conn.channel.recv(), time.perf_counter_ns()))
+        except (ConnectionError, OSError):
+            # 先处理已收到的消息，主循环之后会再次读到连接关闭
+            pass
+
+    def _next_message(self, conn: IPCConnection) -> Tuple[IPCMessage, int]:
+        """
+        返回下一条要处理的消息及其到达时间
+        未配置执行器时请求依次在接收线程中处理，从已到达的请求中选出 schedule_key 最小的；
+        请求不会越过 SHM_UPDATE、STATS 等消息，这些消息仍按到达顺序处理
+        """
+        if self.executor is not None:
+            # 执行器模式下由 RequestScheduler 排序
+            msg = conn.channel.recv()
+            return msg, time.perf_counter_ns()
+        if not conn.backlog:
+            msg = conn.channel.recv()
+            conn.backlog.append((msg, time.perf_counter_ns()))
+        self._receive_pending(conn)
+        best = 0
+        best_key = None
+        for i, (msg, received_at) in enumerate(conn.backlog):
+            if msg.type in _CONTROL:
+                continue
+            if msg.type not in _SCHEDULABLE:
+                break
+            key = schedule_key(msg, received_at)
+            if best_key is None or key < best_key:
+                best, best_key = i, key
+        item = conn.backlog[best]
+        del conn.backlog[best]
+        return item
+
+    def _receive_control(self, conn: IPCConnection, block: bool):
+        """接收一条消息（block 为 False 时只接收已到达的），处理 CREDIT/CANCEL，其他消息放入 backlog"""
+        try:
+            while block or conn.channel.reader.buffered() or select.select(
+                [conn.sock], [], [], 0
+            )[0]:
+                msg = conn.channel.recv()
+                # 尚未登记的流（其 STREAM_REQUEST 还在 backlog 中）的控制消息也要按顺序留到之后处理
+                if msg.id not in conn.streams or not self._handle_control(conn, msg):
+                    conn.backlog.append((msg, time.perf_counter_ns()))
+                block = False
+        except (ConnectionError, OSError):
+            # 连接已断开：取消所有流，主循环之后会再次读到连接关闭
+            for stream in list(conn.streams.values()):
+                stream.cancel()
+
+    def _handle_control(self, conn: IPCConnection, msg: IPCMessage) -> bool:
+        """处理流的控制消息，返回 msg 是否为控制消息；已结束的流的控制消息被忽略"""
+        if msg.type == IPCMessageType.CREDIT:
+            stream = conn.streams.get(msg.id)
+            if stream is not None:
+                stream.grant(msg.data)
+            return True
+        if msg.type == IPCMessageType.CANCEL:
+            stream = conn.streams.get(msg.id)
+            if stream is not None:
+                stream.cancel()
+            return True
+        return False
+
+    def _process_ring_stream_request(
+        self, conn: IPCConnection, msg: IPCMessage, name: str, stream: StreamCredit
+    ):
+        """把流数据写入客户端创建的环形缓冲区，只在客户端等待时通过 socket 唤醒它"""
+        ring = ShmRing(name)
+        codec = conn.channel.codec
+        assert codec is not None
+        metrics = self.metrics
+
+        def cancelled() -> bool:
+            if self.executor is None:
+                # 流在接收线程中执行，没有其他线程读取 socket：自己接收已到达的 CANCEL
+                self._receive_control(conn, block=False)
+            return conn.closed or stream.cancelled
+
+        responses = iter(self.handle_stream_request(msg.data))
+        try:
+            # 生成下一个数据之前检查是否已取消，客户端取消后不再多计算
+            while not cancelled():
+                try:
+                    response = next(responses)
+                except StopIteration:
+                    break
+                if metrics is not None:
+                    metrics.add("stream_items")
+                if ring.put(response, codec, cancelled=cancelled):
+                    conn.channel.send(
+                        IPCMessage(IPCMessageType.STREAM_DATA, msg.id, None, {"ring": "wakeup"})
+                    )
+            else:
+                return
+        except RingClosedError:
+            # 客户端已放弃该流
+            return
+        except Exception as e:
+            conn.channel.send(IPCMessage(IPCMessageType.ERROR, msg.id, repr(e)))
+            raise
+        finally:
+            ring.close()
+            if hasattr(responses, "close"):
+                responses.close()
+        conn.channel.send(IPCMessage(IPCMessageType.STREAM_END, msg.id))
+
+    def _attach_tmp_shm(self, conn: IPCConnection, shm_json: Dict[str, Any]) -> ShmArray:
+        if conn.remote:
+            # 远程客户端：结果先写入服务器自己的段，随响应发送后（租约结束时）归还到池中
+            assert conn.array_pool is not None
+            tmp_shm_arr = conn.array_pool.acquire(ShmArrayInfo.from_json(shm_json["info"]))
+            tmp_shm_arr._lease_started()
+            conn.array_pool.release(tmp_shm_arr)
+            return tmp_shm_arr
+        for name in shm_json.get("evicted", []):
+            conn.tmp_shm_cache.discard(name)
+        tmp_shm_arr = conn.tmp_shm_cache.attach(
+            ShmArrayInfo.from_json(shm_json["info"]), shm_json["name"]
+        )
+        # 请求处理完之前不允许缓存淘汰时关闭这段映射
+        tmp_shm_arr._lease_started()
+        return tmp_shm_arr
+
+    def _handle_request(self, conn: IPCConnection, msg: IPCMessage, received_at: int):
+        meta = msg.meta or {}
+        tmp_shm_arr = None
+        if "tmp_shm" in meta:
+            tmp_shm_arr = self._attach_tmp_shm(conn, meta["tmp_shm"])
+        if self.batcher is not None:
+            self._enqueue_batch_item(conn, msg, tmp_shm_arr, received_at)
+        else:
+            self._dispatch(
+                conn,
+                schedule_key(msg, received_at),
+                self._process_request,
+                conn,
+                msg,
+                tmp_shm_arr,
+                received_at,
+            )
+
+    def _enqueue_batch_item(
+        self,
+        conn: IPCConnection,
+        msg: IPCMessage,
+        tmp_shm_arr: Union[ShmArray, None],
+        received_at: int,
+    ):
+        assert self.batcher is not None
+        item = BatchItem(conn, msg, tmp_shm_arr, received_at)
+        with conn.inflight_lock:
+            conn.inflight.add(item.future)
+
+        def on_done(future: Future):
+            with conn.inflight_lock:
+                conn.inflight.discard(future)
 
-            self.after_shm_created()
+        item.future.add_done_callback(on_done)
+        self.batcher.submit(item)
 
+    def _serve_connection(self, conn: IPCConnection):
+        msg = conn.channel.recv()
+        assert msg.type == IPCMessageType.INIT, f"期望 INIT 消息，但收到 {msg.type}"
+        if "codecs" in msg.data:
+            # 协商编解码器；旧版本客户端不提供 codecs，继续使用 JSON 字符串帧
+            codec = choose_codec(msg.data["codecs"])
+            reply: Dict[str, Any] = {"codec": codec.name}
+            if msg.data.get("arrays"):
+                reply["arrays"] = True
+            # 支持流的 CREDIT/CANCEL、STATS 消息和连接过程中的共享数组更新（SHM_UPDATE）
+            reply["flow_control"] = True
+            reply["stats"] = True
+            reply["shared_arrays"] = True
+            conn.channel.send(IPCMessage(IPCMessageType.INIT, data=reply))
+            conn.channel.codec = codec
+            conn.channel.metrics = self.metrics
+            if msg.data.get("arrays") and conn.remote:
+                # 远程连接的数组都放在帧中，由 sendmsg/recv_into 直接收发
+                conn.array_pool = ShmArrayPool(self.id, max_bytes=self.tmp_shm_cache_bytes)
+                conn.channel.arrays = ArrayTransport(
+                    conn.array_pool, conn.tmp_shm_cache, threshold=None
+                )
+            elif msg.data.get("arrays"):
+                # 自动传输请求和响应中的 NumPy 数组
+                conn.array_pool = ShmArrayPool(self.id, max_bytes=self.tmp_shm_cache_bytes)
+                conn.arena = ShmArena(self.id)
+                conn.channel.arrays = ArrayTransport(
+                    conn.array_pool, conn.tmp_shm_cache, arena=conn.arena
+                )
+        if conn.remote and conn.array_pool is None:
+            # 远程连接的 tmp_shm 结果先写入服务器自己的共享内存
+            conn.array_pool = ShmArrayPool(self.id, max_bytes=self.tmp_shm_cache_bytes)
+        shm_jsons = msg.data.get("shm_arrs", {})
+        # 使用 memfd 的共享数组的文件描述符随 INIT 消息传来
+        fds = conn.channel.take_fds(sum("fd" in j for j in shm_jsons.values()))
+        for name, shm_json in shm_jsons.items():
+            if conn.remote:
+                # 远程客户端的共享数组在服务器上保存一份副本，客户端在请求之前推送变化的内容
+                conn.shm_arrs[name] = open_shm_array(
+                    ShmArrayInfo.from_json(shm_json["info"]),
+                    shm_json["name"],
+                    create=True,
+                    size=shm_json["size"],
+                    memfd=True,
+                )
+                continue
+            conn.shm_arrs[name] = open_shm_array(
+                ShmArrayInfo.from_json(shm_json["info"]),
+                shm_json["name"],
+                fd=fds[shm_json["fd"]] if "fd" in shm_json else None,
+            )
+
+        self._call_handler(self.after_shm_created)
+
+        try:
             while True:
-                data = recv_str(client_socket)
-                if not data or data.strip() == IPCMessageType.QUIT.value:
+                try:
+                    msg, received_at = self._next_message(conn)
+                except ConnectionError:
                     break
-                if data.strip() == IPCMessageType.STREAM_REQUEST.value:
-                    # 处理流式请求
-                    request = json.loads(recv_str(client_socket))
-                    try:
-                        for response in self.handle_stream_request(request):
-                            send_str(client_socket, IPCMessageType.STREAM_DATA.value)
-                            send_str(client_socket, json.dumps(response))
-                        send_str(client_socket, IPCMessageType.STREAM_END.value)
-                    except Exception:
-                        send_str(client_socket, IPCMessageType.ERROR.value)
-                        raise
-                else:
-                    if data.strip() == IPCMessageType.TMP_SHARED_ARRAY.value:
-                        shm_json = json.loads(recv_str(client_socket))
-                        tmp_shm_arr = ShmArray(
-                            info=ShmArrayInfo.from_json(shm_json["info"]),
-                            name=generate_shm_name(self.id, shm_json["name"]),
-                            create=False,
+                if self._handle_control(conn, msg):
+                    continue
+                if msg.type == IPCMessageType.QUIT:
+                    break
+                elif msg.type == IPCMessageType.STREAM_REQUEST:
+                    # 在接收线程中登记，之后到达的 CREDIT/CANCEL 才能找到该流
+                    meta = msg.meta or {}
+                    conn.streams[msg.id] = StreamCredit(
+                        meta.get("window"), meta.get("priority", 0)
+                    )
+                    # 该流被提到前面处理时，backlog 中已有它的控制消息
+                    if conn.backlog:
+                        conn.backlog = deque(
+                            (m, t) for m, t in conn.backlog
+                            if m.id != msg.id or not self._handle_control(conn, m)
                         )
-                        request = json.loads(recv_str(client_socket))
+                    self._dispatch(
+                        conn,
+                        schedule_key(msg, received_at),
+                        self._process_stream_request,
+                        conn,
+                        msg,
+                        received_at,
+                    )
+                elif msg.type == IPCMessageType.REQUEST:
+                    self._handle_request(conn, msg, received_at)
+                elif msg.type == IPCMessageType.SHM_UPDATE and msg.data["op"] == "sync":
+                    # 远程客户端在请求之前推送的共享数组内容，不回复
+                    apply_shm_update(conn.shm_arrs, msg.data, remote=True)
+                elif msg.type == IPCMessageType.SHM_UPDATE:
+                    # 在接收线程中按顺序处理，之后收到的请求都能看到更新后的共享数组
+                    try:
+                        fds = conn.channel.take_fds(1 if "fd" in msg.data else 0)
+                        name = apply_shm_update(conn.shm_arrs, msg.data, fds, conn.remote)
+                        self._call_handler(self.after_shm_updated, name)
+                    except Exception as e:
+                        conn.channel.send(IPCMessage(IPCMessageType.ERROR, msg.id, repr(e)))
                     else:
-                        tmp_shm_arr = None
-                        request = json.loads(data)
+                        conn.channel.send(IPCMessage(IPCMessageType.RESPONSE, msg.id))
+                elif msg.type == IPCMessageType.STATS:
                     try:
-                        response = self.handle_request(request, tmp_shm=tmp_shm_arr)
-                    except Exception:
-                        send_str(client_socket, IPCMessageType.ERROR.value)
-                        raise
-                    send_str(client_socket, json.dumps(response))
+                        stats = self._query_stats(msg.data)
+                    except Exception as e:
+                        conn.channel.send(IPCMessage(IPCMessageType.ERROR, msg.id, repr(e)))
+                    else:
+                        conn.channel.send(IPCMessage(IPCMessageType.RESPONSE, msg.id, stats))
+                else:
+                    raise RuntimeError(f"未知的消息类型: {msg.type}")
+        finally:
+            conn.closed = True
+            for stream in list(conn.streams.values()):
+                stream.cancel()
+            with conn.inflight_lock:
+                inflight = list(conn.inflight)
+            wait(inflight)
 
-            client_socket.close()
+    def _query_stats(self, query: Dict[str, Any]) -> Dict[str, Any]:
+        """处理客户端的 STATS 消息"""
+        if self.metrics is None:
+            raise RuntimeError("服务器未开启性能统计")
+        reply: Dict[str, Any] = {"stats": self.get_stats(query.get("reset", False))}
+        if query.get("trace") == "start":
+            self.metrics.start_trace(query.get("max_events", 1 << 20))
+        elif query.get("trace") == "stop":
+            reply["trace"] = self.metrics.stop_trace()
+        return reply
 
-        finally:
-            server_socket.close()
-            os.unlink(self.socket_path)
-            for shm_arr in self.shm_arrs.values():
-                shm_arr.close()
+    def get_stats(self, reset: bool = False) -> Dict[str, Any]:
+        """
+        服务器的性能统计（所有连接合计），见 Metrics.snapshot
+        阶段：deserialize、serialize、send（编解码和收发，含数组的自动传输）、
+              queue（收到请求到开始处理）、handler（handle_request，批处理时为整批的 handle_batch）、
+              reply（发送响应）、stream_item（流式请求生成一个数据）
+        计数器：messages_sent/received、bytes_sent/received、stream_items
+        """
+        assert self.metrics is not None, "未开启性能统计"
+        return self.metrics.snapshot(reset)
 
     def handle_request(
         self, request: Dict[str, Any], tmp_shm: Union[ShmArray, None]
@@ -92,9 +1104,30 @@ class IPCServer:
         """
         处理请求的抽象方法，子类需要实现
         tmp_shm: 只可以写入，不可以读取
+        多客户端模式或配置了执行器时会被多个线程并发调用
         """
         raise NotImplementedError
 
+    def handle_batch(
+        self, requests: List[Dict[str, Any]], tmp_shms: List[Union[ShmArray, None]]
+    ) -> List[Union[Dict[str, Any], Exception]]:
+        """
+        启用批处理时处理一批请求，返回与 requests 一一对应的响应，可以用 Exception 表示单个请求出错
+        同一批中的请求可能来自不同的客户端；默认实现逐个调用 handle_request
+        """
+        responses: List[Union[Dict[str, Any], Exception]] = []
+        for request, tmp_shm in zip(requests, tmp_shms):
+            try:
+                responses.append(self.handle_request(request, tmp_shm=tmp_shm))
+            except Exception as e:
+                responses.append(e)
+        return responses
+
+    def get_batch_stats(self, reset: bool = False) -> Dict[str, float]:
+        """返回批处理的统计信息，见 RequestBatcher.stats"""
+        assert self.batcher is not None, "未启用批处理"
+        return self.batcher.stats(reset)
+
     def handle_stream_request(
         self, request: Dict[str, Any]
     ) -> Iterable[Dict[str, Any]]:
@@ -103,9 +1136,41 @@ class IPCServer:
         """
         raise NotImplementedError
 
+    def warmup(self):
+        """zygote 模式下在 fork 之前调用一次的钩子方法，用于加载之后所有子进程共享的资源"""
+        pass
+
+    def after_fork(self):
+        """
+        zygote 模式下在子进程中、开始服务客户端之前调用的钩子方法
+        fork 之后线程不会被复制，需要在这里重新创建线程池、随机数种子等进程相关的状态
+        """
+        pass
+
     def after_shm_created(self):
-        """在共享内存创建后调用的钩子方法，子类可选实现"""
+        """在共享内存创建后调用的钩子方法，子类可选实现；多客户端模式下每个连接调用一次"""
+        pass
+
+    def after_shm_updated(self, name: str):
+        """
+        客户端在连接过程中注册、调整大小或注销共享数组 name 后调用的钩子方法，子类可选实现
+        调用完成前不会开始处理之后收到的请求
+        """
         pass
 
+    def allocate_output(self, shape: Sequence[int], dtype: Any) -> np.ndarray:
+        """
+        在当前客户端的 arena 中分配输出数组，放入响应后以 ShmHandle 的形式零拷贝交给客户端，
+        客户端 release 之后空间被回收；可以先按最大长度分配，再返回其开头的切片
+        客户端不支持数组自动传输时退化为普通数组
+        """
+        conn = _current_connection.get(None)
+        if conn is None or conn.arena is None:
+            return np.empty(shape, dtype)
+        return conn.arena.allocate(shape, dtype)
+
     def get_shared_array(self, name: str = "default") -> ShmArray:
-        return self.shm_arrs[name]
+        """返回当前正在服务的客户端的共享数组"""
+        conn = _current_connection.get(None)
+        shm_arrs = self.shm_arrs if conn is None else conn.shm_arrs
+        return shm_arrs[name]
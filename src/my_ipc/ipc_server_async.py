@@ -0,0 +1,369 @@
+import asyncio
+import contextvars
+import os
+import time
+import traceback
+from typing import Any, AsyncIterator, Dict, Sequence, Set, Union
+
+import numpy as np
+from my_ipc.public import (
+    ArrayTransport,
+    Codec,
+    DEADLINE_EXCEEDED,
+    IPCMessage,
+    IPCMessageType,
+    ShmArrayInfo,
+    ShmArray,
+    ShmArena,
+    ShmArrayPool,
+    ShmAttachCache,
+    async_recv_message,
+    async_send_message,
+    apply_shm_update,
+    choose_codec,
+    generate_socket_path,
+    notify_ready,
+    open_shm_array,
+    request_deadline,
+)
+
+
+class AsyncIPCConnection:
+    """AsyncIPCServer 的一个客户端连接，持有该客户端独占的共享内存映射"""
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        tmp_shm_cache_bytes: int,
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.shm_arrs: Dict[str, ShmArray] = {}
+        self.tmp_shm_cache = ShmAttachCache(max_bytes=tmp_shm_cache_bytes)
+        self.codec: Union[Codec, None] = None
+        self.arrays: Union[ArrayTransport, None] = None
+        self.array_pool: Union[ShmArrayPool, None] = None
+        # allocate_output 使用的 arena，协商启用数组自动传输后创建
+        self.arena: Union[ShmArena, None] = None
+        # 尚未完成的请求，关闭连接前需要等待它们结束
+        self.tasks: Set[asyncio.Task] = set()
+        # 正在执行的流式请求的发送额度，按请求 id 索引
+        self.streams: Dict[int, "AsyncStreamCredit"] = {}
+
+    async def send(self, msg: IPCMessage):
+        async_send_message(self.writer, msg, self.codec, self.arrays)
+        await self.writer.drain()
+
+    def close(self):
+        self.writer.close()
+        for shm_arr in self.shm_arrs.values():
+            shm_arr.close()
+        self.tmp_shm_cache.close()
+        if self.arrays is not None:
+            self.arrays.close()
+        if self.array_pool is not None:
+            self.array_pool.close()
+        if self.arena is not None:
+            self.arena.close()
+
+
+class AsyncStreamCredit:
+    """StreamCredit 的 asyncio 版本"""
+
+    def __init__(self, window: Union[int, None]):
+        self.credits = window  # None 表示不限
+        self.cancelled = False
+        self._changed = asyncio.Event()
+
+    def grant(self, n: int):
+        if self.credits is not None:
+            self.credits += n
+        self._changed.set()
+
+    def cancel(self):
+        self.cancelled = True
+        self._changed.set()
+
+    async def take(self) -> bool:
+        """取得发送一个数据的额度，返回 False 表示客户端已取消该流"""
+        while not self.cancelled and self.credits == 0:
+            self._changed.clear()
+            await self._changed.wait()
+        if self.cancelled:
+            return False
+        if self.credits is not None:
+            self.credits -= 1
+        return True
+
+
+_current_connection: "contextvars.ContextVar[AsyncIPCConnection]" = (
+    contextvars.ContextVar("_current_async_connection")
+)
+
+
+class AsyncIPCServer:
+    """
+    基于 asyncio 的 IPC 服务器基类，协议与 IPCServer 相同
+    handle_request 为协程，handle_stream_request 为异步生成器；
+    每个请求都在单独的 Task 中处理，同一事件循环可以同时处理大量请求
+    """
+
+    def __init__(self, id: str, tmp_shm_cache_bytes: int = 1 << 30):
+        self.id = id
+        self.socket_path = generate_socket_path(self.id)
+        self.tmp_shm_cache_bytes = tmp_shm_cache_bytes
+        self._stopped: Union[asyncio.Event, None] = None
+
+    def start_server(self, max_clients: Union[int, None] = 1, exit_when_idle: bool = True):
+        """
+        启动服务器监听，直到 stop 或（exit_when_idle 时）最后一个客户端断开
+        max_clients: 同时服务的客户端数量上限，None 表示不限
+        """
+        asyncio.run(self.serve(max_clients, exit_when_idle))
+
+    async def serve(self, max_clients: Union[int, None] = 1, exit_when_idle: bool = True):
+        """在当前事件循环中运行服务器"""
+        self._stopped = asyncio.Event()
+        conns: Set[AsyncIPCConnection] = set()
+
+        async def on_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+            if max_clients is not None and len(conns) >= max_clients:
+                writer.close()
+                return
+            conn = AsyncIPCConnection(reader, writer, self.tmp_shm_cache_bytes)
+            conns.add(conn)
+            _current_connection.set(conn)
+            try:
+                await self._serve_connection(conn)
+            except Exception:
+                # 单个客户端出错只断开该连接，不影响其他客户端
+                traceback.print_exc()
+            finally:
+                conn.close()
+                conns.discard(conn)
+                if not conns and exit_when_idle:
+                    self.stop()
+
+        server = await asyncio.start_unix_server(on_connect, path=self.socket_path)
+        notify_ready()
+        try:
+            await self._stopped.wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            os.unlink(self.socket_path)
+
+    def stop(self):
+        """通知服务器退出，需要在事件循环线程中调用"""
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def _process_request(
+        self,
+        conn: AsyncIPCConnection,
+        msg: IPCMessage,
+        tmp_shm_arr: Union[ShmArray, None],
+        received_at: int,
+    ):
+        if await self._deadline_exceeded(conn, msg, received_at):
+            if tmp_shm_arr is not None:
+                tmp_shm_arr._lease_finished()
+            return
+        try:
+            response = await self.handle_request(msg.data, tmp_shm=tmp_shm_arr)
+        except Exception as e:
+            await conn.send(IPCMessage(IPCMessageType.ERROR, msg.id, repr(e)))
+            raise
+        finally:
+            if tmp_shm_arr is not None:
+                tmp_shm_arr._lease_finished()
+        try:
+            await conn.send(IPCMessage(IPCMessageType.RESPONSE, msg.id, response))
+        except OSError:
+            raise
+        except Exception as e:
+            # 例如响应无法用协商的编解码器编码：只有该请求失败，连接继续服务
+            traceback.print_exc()
+            await conn.send(IPCMessage(IPCMessageType.ERROR, msg.id, repr(e)))
+
+    async def _deadline_exceeded(
+        self, conn: AsyncIPCConnection, msg: IPCMessage, received_at: int
+    ) -> bool:
+        """请求已超过截止时间时回复 DEADLINE_EXCEEDED 错误并返回 True，不再调用处理函数"""
+        now = time.perf_counter_ns()
+        deadline = request_deadline(msg, received_at)
+        if now <= deadline:
+            return False
+        await conn.send(
+            IPCMessage(
+                IPCMessageType.ERROR,
+                msg.id,
+                f"截止时间已过 {(now - deadline) / 1e6:.1f} ms",
+                {"code": DEADLINE_EXCEEDED},
+            )
+        )
+        return True
+
+    async def _process_stream_request(
+        self, conn: AsyncIPCConnection, msg: IPCMessage, received_at: int
+    ):
+        if await self._deadline_exceeded(conn, msg, received_at):
+            del conn.streams[msg.id]
+            return
+        stream = conn.streams[msg.id]
+        responses = self.handle_stream_request(msg.data).__aiter__()
+        try:
+            # 先取得额度再生成下一个数据，客户端取消后不再多计算
+            while await stream.take():
+                try:
+                    response = await responses.__anext__()
+                except StopAsyncIteration:
+                    break
+                await conn.send(IPCMessage(IPCMessageType.STREAM_DATA, msg.id, response))
+            else:
+                # 客户端已取消该流或断开连接
+                return
+        except Exception as e:
+            await conn.send(IPCMessage(IPCMessageType.ERROR, msg.id, repr(e)))
+            raise
+        finally:
+            del conn.streams[msg.id]
+            if hasattr(responses, "aclose"):
+                await responses.aclose()
+        await conn.send(IPCMessage(IPCMessageType.STREAM_END, msg.id))
+
+    def _spawn(self, conn: AsyncIPCConnection, coro):
+        task = asyncio.ensure_future(coro)
+        conn.tasks.add(task)
+
+        def on_done(task: asyncio.Task):
+            conn.tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                # 错误已经以 ERROR 消息通知客户端，这里只记录
+                traceback.print_exception(
+                    type(task.exception()), task.exception(), None
+                )
+
+        task.add_done_callback(on_done)
+
+    async def _serve_connection(self, conn: AsyncIPCConnection):
+        msg = await async_recv_message(conn.reader)
+        assert msg.type == IPCMessageType.INIT, f"期望 INIT 消息，但收到 {msg.type}"
+        if any("fd" in j for j in msg.data.get("shm_arrs", {}).values()):
+            # asyncio 的流无法接收 SCM_RIGHTS 传来的文件描述符，不回复 INIT，客户端会在握手时失败
+            raise RuntimeError("AsyncIPCServer 不支持 memfd 共享数组")
+        if "codecs" in msg.data:
+            # 协商编解码器；旧版本客户端不提供 codecs，继续使用 JSON 字符串帧
+            codec = choose_codec(msg.data["codecs"])
+            reply: Dict[str, Any] = {"codec": codec.name}
+            if msg.data.get("arrays"):
+                reply["arrays"] = True
+            # 支持流的 CREDIT/CANCEL 和连接过程中的共享数组更新（SHM_UPDATE）
+            reply["flow_control"] = True
+            reply["shared_arrays"] = True
+            await conn.send(IPCMessage(IPCMessageType.INIT, data=reply))
+            conn.codec = codec
+            if msg.data.get("arrays"):
+                # 自动传输请求和响应中的 NumPy 数组
+                conn.array_pool = ShmArrayPool(self.id, max_bytes=self.tmp_shm_cache_bytes)
+                conn.arena = ShmArena(self.id)
+                conn.arrays = ArrayTransport(
+                    conn.array_pool, conn.tmp_shm_cache, arena=conn.arena
+                )
+        for name, shm_json in msg.data.get("shm_arrs", {}).items():
+            conn.shm_arrs[name] = open_shm_array(
+                ShmArrayInfo.from_json(shm_json["info"]), shm_json["name"]
+            )
+
+        await self.after_shm_created()
+
+        try:
+            while True:
+                try:
+                    msg = await async_recv_message(conn.reader, conn.codec, conn.arrays)
+                except ConnectionError:
+                    break
+                received_at = time.perf_counter_ns()
+                if msg.type == IPCMessageType.QUIT:
+                    break
+                elif msg.type in (IPCMessageType.CREDIT, IPCMessageType.CANCEL):
+                    # 已结束的流的控制消息被忽略
+                    stream = conn.streams.get(msg.id)
+                    if stream is not None and msg.type == IPCMessageType.CREDIT:
+                        stream.grant(msg.data)
+                    elif stream is not None:
+                        stream.cancel()
+                elif msg.type == IPCMessageType.STREAM_REQUEST:
+                    conn.streams[msg.id] = AsyncStreamCredit((msg.meta or {}).get("window"))
+                    self._spawn(conn, self._process_stream_request(conn, msg, received_at))
+                elif msg.type == IPCMessageType.REQUEST:
+                    meta = msg.meta or {}
+                    tmp_shm_arr = None
+                    if "tmp_shm" in meta:
+                        shm_json = meta["tmp_shm"]
+                        for name in shm_json.get("evicted", []):
+                            conn.tmp_shm_cache.discard(name)
+                        tmp_shm_arr = conn.tmp_shm_cache.attach(
+                            ShmArrayInfo.from_json(shm_json["info"]), shm_json["name"]
+                        )
+                        tmp_shm_arr._lease_started()
+                    self._spawn(
+                        conn, self._process_request(conn, msg, tmp_shm_arr, received_at)
+                    )
+                elif msg.type == IPCMessageType.SHM_UPDATE:
+                    # 在接收线程中按顺序处理，之后收到的请求都能看到更新后的共享数组
+                    try:
+                        if "fd" in msg.data:
+                            raise RuntimeError("AsyncIPCServer 不支持 memfd 共享数组")
+                        name = apply_shm_update(conn.shm_arrs, msg.data)
+                        await self.after_shm_updated(name)
+                    except Exception as e:
+                        await conn.send(IPCMessage(IPCMessageType.ERROR, msg.id, repr(e)))
+                    else:
+                        await conn.send(IPCMessage(IPCMessageType.RESPONSE, msg.id))
+                else:
+                    raise RuntimeError(f"未知的消息类型: {msg.type}")
+        finally:
+            for stream in list(conn.streams.values()):
+                stream.cancel()
+            if conn.tasks:
+                await asyncio.wait(list(conn.tasks))
+
+    async def handle_request(
+        self, request: Dict[str, Any], tmp_shm: Union[ShmArray, None]
+    ) -> Dict[str, Any]:
+        """
+        处理请求的抽象协程，子类需要实现
+        tmp_shm: 只可以写入，不可以读取
+        """
+        raise NotImplementedError
+
+    def handle_stream_request(self, request: Dict[str, Any]) -> AsyncIterator[Dict[str, Any]]:
+        """
+        处理流式请求的抽象方法，子类需要实现为异步生成器（async def + yield）
+        """
+        raise NotImplementedError
+
+    async def after_shm_created(self):
+        """在共享内存创建后调用的钩子协程，子类可选实现；每个连接调用一次"""
+        pass
+
+    async def after_shm_updated(self, name: str):
+        """客户端在连接过程中注册、调整大小或注销共享数组 name 后调用的钩子协程，子类可选实现"""
+        pass
+
+    def allocate_output(self, shape: Sequence[int], dtype: Any) -> np.ndarray:
+        """
+        在当前客户端的 arena 中分配输出数组，放入响应后以 ShmHandle 的形式零拷贝交给客户端，
+        客户端 release 之后空间被回收；可以先按最大长度分配，再返回其开头的切片
+        客户端不支持数组自动传输时退化为普通数组
+        """
+        conn = _current_connection.get()
+        if conn.arena is None:
+            return np.empty(shape, dtype)
+        return conn.arena.allocate(shape, dtype)
+
+    def get_shared_array(self, name: str = "default") -> ShmArray:
+        """返回当前正在服务的客户端的共享数组"""
+        return _current_connection.get().shm_arrs[name]
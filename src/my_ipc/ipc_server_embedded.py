@@ -1,110 +1,1007 @@
 # 参考 /mnt/ssd/home/zhaozy/my_ipc/src/my_ipc/ipc_server.py 的实现
-# 去掉了所有共享内存相关的逻辑，用于直接嵌入到其他 Python 文件中使用
+# 去掉了 NumPy 和共享数组等逻辑，只依赖标准库（msgpack 可选），用于直接嵌入到其他 Python 文件中使用
+# 较大的 bytes/memoryview/array.array 经过共享内存传输，见 BufferTransport
+# 协议部分复制自 my_ipc.ipc_protocol，性能统计复制自 my_ipc.ipc_metrics，修改时需保持一致
 
+import array
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+import enum
 import json
+import math
+import mmap
+from multiprocessing import shared_memory
 import os
+import pickle
+import select
 import socket
-from typing import Any, Dict
-import enum
+import struct
+import sys
+import threading
+import time
+from typing import Any, Deque, Dict, List, Sequence, Set, Tuple, Union, cast
+import uuid
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 class IPCMessageType(enum.Enum):
+    INIT = "INIT"
     QUIT = "QUIT"
     ERROR = "ERROR"
+    REQUEST = "REQUEST"
+    RESPONSE = "RESPONSE"
     STREAM_REQUEST = "STREAM_REQUEST"
     STREAM_DATA = "STREAM_DATA"
     STREAM_END = "STREAM_END"
+    # 客户端在连接过程中注册、调整大小或注销共享数组，服务器以 RESPONSE 确认
+    SHM_UPDATE = "SHM_UPDATE"
+    # 客户端消费了 data 个流数据，服务器可以再发送这么多
+    CREDIT = "CREDIT"
+    # 客户端放弃该流，服务器停止生成器，不再发送该流的任何消息
+    CANCEL = "CANCEL"
+    # 客户端读取服务器的性能统计（以及 trace 事件），服务器以 RESPONSE 回复
+    STATS = "STATS"
+
+
+@dataclass
+class IPCMessage:
+    """
+    一条协议消息，一个消息对应一个帧
+    id: 请求 id，同一请求（或流）的所有响应消息都带有相同的 id，
+        因此一个连接上可以同时有多个请求在处理，响应可以乱序返回
+    meta: 附加字段，例如 REQUEST 消息的 tmp_shm
+    """
+
+    type: IPCMessageType
+    id: int = 0
+    data: Any = None
+    meta: Union[Dict[str, Any], None] = None
+
+    def to_json(self) -> str:
+        obj = {"type": self.type.value, "id": self.id, "data": self.data}
+        if self.meta is not None:
+            obj["meta"] = self.meta
+        return json.dumps(obj)
+
+    @staticmethod
+    def from_json(data: str) -> "IPCMessage":
+        obj = json.loads(data)
+        return IPCMessage(
+            type=IPCMessageType(obj["type"]),
+            id=obj["id"],
+            data=obj.get("data"),
+            meta=obj.get("meta"),
+        )
+
+
+def _size_class(nbytes: int) -> int:
+    """向上取整到 2 的幂（至少一页），同一尺寸级别的共享内存段可以互相复用"""
+    return max(4096, 1 << max(nbytes - 1, 0).bit_length())
 
 
 def generate_socket_path(id: str) -> str:
     return f"/tmp/ipc_socket_{id}"
 
 
-def recv_exactly(sock: socket.socket, n: int) -> bytes:
-    """接收确切的 n 个字节"""
-    data = b""
-    while len(data) < n:
-        chunk = sock.recv(n - len(data))
-        if not chunk:
+def generate_shm_name(id: str, name: str) -> str:
+    return f"ipc_shm_{id}_{name}"
+
+
+# 客户端通过该环境变量把就绪管道的写端传给服务器进程
+READY_FD_ENV = "IPC_READY_FD"
+
+# 服务器因截止时间跳过请求时，ERROR 消息的 meta 为 {"code": DEADLINE_EXCEEDED}
+DEADLINE_EXCEEDED = "deadline_exceeded"
+
+
+def schedule_key(msg: IPCMessage, received_at: int) -> Tuple[int, float, int, int]:
+    """排序键：优先级从高到低，其次截止时间从早到晚，最后按到达顺序"""
+    meta = msg.meta or {}
+    return (-meta.get("priority", 0), request_deadline(msg, received_at), received_at, msg.id)
+
+
+def request_deadline(msg: IPCMessage, received_at: int) -> float:
+    """
+    请求的截止时间（time.perf_counter_ns），没有截止时间时为 inf
+    同一台机器上 perf_counter_ns 在各进程间一致，从客户端发出请求时起算，
+    包括请求在 socket 中等待服务器读取的时间
+    """
+    meta = msg.meta or {}
+    timeout = meta.get("deadline")
+    if timeout is None:
+        return float("inf")
+    return min(received_at, meta.get("sent_at", received_at)) + timeout * 1e9
+
+
+def notify_ready():
+    """服务器开始 listen 后调用，通知启动它的客户端可以连接了；不是由客户端启动时什么也不做"""
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if fd is None:
+        return
+    try:
+        os.write(int(fd), b"1")
+        os.close(int(fd))
+    except OSError:
+        pass
+
+
+def recv_exactly_into(sock: socket.socket, buffer: memoryview):
+    """用 recv_into 把 buffer 填满，不产生中间对象"""
+    received = 0
+    n = buffer.nbytes
+    while received < n:
+        got = sock.recv_into(buffer[received:])
+        if got == 0:
             raise ConnectionError("连接已关闭，数据不完整")
-        data += chunk
-    return data
+        received += got
+
+
+def sendmsg_all(sock: socket.socket, parts: List[Any], fds: Sequence[int] = ()):
+    """
+    用 sendmsg 把多个缓冲区合并为一次系统调用发送，处理部分发送的情况
+    fds: 通过 SCM_RIGHTS 随第一个字节一起发送的文件描述符
+    """
+    views = [memoryview(part).cast("B") for part in parts if len(part)]
+    ancdata = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))] if fds else []
+    while views:
+        # IOV_MAX 在 Linux 上为 1024
+        sent = sock.sendmsg(views[:1024], ancdata)
+        ancdata = []
+        while views and sent >= views[0].nbytes:
+            sent -= views[0].nbytes
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+
+
+# 一次最多接收的文件描述符数量（Linux 的 SCM_MAX_FD）
+_FDS_ANCBUFSIZE = socket.CMSG_SPACE(253 * array.array("i").itemsize)
+
+
+class SocketReader:
+    """
+    带缓冲的 socket 读取器
+    recv_into 到可复用的 bytearray，一次 recv 读到的多个帧直接在缓冲区中解析，不再产生系统调用；
+    大于缓冲区的数据直接 recv_into 到目标内存
+    """
+
+    def __init__(self, sock: socket.socket, bufsize: int = 256 * 1024):
+        self.sock = sock
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._start = 0  # 未消费数据的起点
+        self._end = 0  # 已接收数据的终点
+        self.consumed = 0  # 已消费的总字节数
+        # 通过 SCM_RIGHTS 收到、尚未被取走的文件描述符
+        self.fds: Deque[int] = deque()
+
+    def _recv(self) -> int:
+        # 对端只在帧的开头附带文件描述符，帧头总是经过这里接收
+        got, ancdata, flags, _ = self.sock.recvmsg_into([self._view[self._end :]], _FDS_ANCBUFSIZE)
+        for level, type, data in ancdata:
+            if level == socket.SOL_SOCKET and type == socket.SCM_RIGHTS:
+                fds = array.array("i")
+                fds.frombytes(data[: len(data) - len(data) % fds.itemsize])
+                self.fds.extend(fds)
+        if flags & socket.MSG_CTRUNC:
+            raise RuntimeError("收到的文件描述符过多，部分已被丢弃")
+        return got
+
+    def _fill(self, n: int, eof_ok: bool = False) -> bool:
+        """保证缓冲区中至少有 n 个未消费的字节；eof_ok 时在帧边界上连接关闭返回 False"""
+        if self._end - self._start >= n:
+            return True
+        if self._start + n > len(self._buf):
+            # 把未消费的数据移到缓冲区开头，腾出空间
+            remaining = self._end - self._start
+            if n > len(self._buf):
+                buf = bytearray(max(n, 2 * len(self._buf)))
+                buf[:remaining] = self._view[self._start : self._end]
+                self._buf, self._view = buf, memoryview(buf)
+            else:
+                self._view[:remaining] = self._view[self._start : self._end]
+            self._start, self._end = 0, remaining
+        while self._end - self._start < n:
+            got = self._recv()
+            if got == 0:
+                if eof_ok and self._end == self._start:
+                    return False
+                raise ConnectionError("连接已关闭，数据不完整")
+            self._end += got
+        return True
+
+    def peek(self, n: int, eof_ok: bool = False) -> Union[memoryview, None]:
+        """返回接下来 n 个字节的视图但不消费；视图只在下一次读取之前有效"""
+        if not self._fill(n, eof_ok):
+            return None
+        return self._view[self._start : self._start + n]
+
+    def skip(self, n: int):
+        self._start += n
+        self.consumed += n
 
+    def read(self, n: int) -> memoryview:
+        """读取 n 个字节，返回的视图只在下一次读取之前有效"""
+        if n > len(self._buf):
+            # 大块数据单独分配，避免撑大复用缓冲区
+            data = bytearray(n)
+            self.read_into(memoryview(data))
+            return memoryview(data)
+        view = self.peek(n)
+        self.skip(n)
+        return cast(memoryview, view)
 
-def recv_str(sock: socket.socket) -> str:
-    # 先接受一个数字作为 bufsize
-    bufsize_bytes = sock.recv(4)
-    bufsize = int.from_bytes(bufsize_bytes, byteorder="big")
-    data = recv_exactly(sock, bufsize).decode("utf-8")
-    return data
+    def buffered(self) -> int:
+        """缓冲区中已接收、尚未消费的字节数"""
+        return self._end - self._start
 
+    def read_into(self, target: memoryview):
+        """读取 target.nbytes 个字节到 target，先取缓冲区中已有的数据，剩余部分直接 recv_into"""
+        n = target.nbytes
+        buffered = min(n, self._end - self._start)
+        target[:buffered] = self._view[self._start : self._start + buffered]
+        self._start += buffered
+        self.consumed += n
+        if buffered < n:
+            recv_exactly_into(self.sock, target[buffered:])
 
-def send_str(sock: socket.socket, data: str):
+
+def encode_str(data: str) -> bytes:
+    """编码为与 send_str 相同格式的帧"""
     data_bytes = data.encode("utf-8")
-    bufsize = len(data_bytes)
-    bufsize_bytes = bufsize.to_bytes(4, byteorder="big")
-    sock.sendall(bufsize_bytes)
-    sock.sendall(data_bytes)
+    return len(data_bytes).to_bytes(4, byteorder="big") + data_bytes
+
+
+class Codec:
+    """
+    消息体编解码器
+    encode 返回 (payload, 带外缓冲区列表)，带外缓冲区紧跟 payload 原样发送，不做拷贝或序列化
+    """
+
+    name = ""
+
+    def encode(self, obj: Any) -> Tuple[bytes, List[memoryview]]:
+        raise NotImplementedError
+
+    def decode(self, payload: memoryview, buffers: List[bytearray]) -> Any:
+        """payload 可能是复用缓冲区的视图，解码结果不能引用它"""
+        raise NotImplementedError
+
+
+class JsonCodec(Codec):
+    name = "json"
+
+    def encode(self, obj: Any) -> Tuple[bytes, List[memoryview]]:
+        return json.dumps(obj).encode("utf-8"), []
+
+    def decode(self, payload: memoryview, buffers: List[bytearray]) -> Any:
+        return json.loads(str(payload, "utf-8"))
+
+
+class PickleCodec(Codec):
+    """pickle protocol 5，bytes 以外的大块缓冲区（如 numpy 数组）走带外传输；只用于互相信任的进程之间"""
+
+    name = "pickle"
+
+    def encode(self, obj: Any) -> Tuple[bytes, List[memoryview]]:
+        buffers: List[pickle.PickleBuffer] = []
+        payload = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+        return payload, [buffer.raw() for buffer in buffers]
+
+    def decode(self, payload: memoryview, buffers: List[bytearray]) -> Any:
+        return pickle.loads(payload, buffers=buffers)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+
+    def encode(self, obj: Any) -> Tuple[bytes, List[memoryview]]:
+        return msgpack.packb(obj, use_bin_type=True), []
+
+    def decode(self, payload: memoryview, buffers: List[bytearray]) -> Any:
+        return msgpack.unpackb(payload, raw=False, strict_map_key=False)
+
+
+# 可用的编解码器，可以通过 register_codec 添加自定义实现
+CODECS: Dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec):
+    CODECS[codec.name] = codec
+
+
+register_codec(JsonCodec())
+register_codec(PickleCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec())
+
+# 二进制帧头：消息类型、标志位、带外缓冲区数量、请求 id、payload 长度
+FRAME_HEADER = struct.Struct("!BBHQI")
+FLAG_META = 1  # payload 为 [data, meta]
+FLAG_ARRAYS = 2  # payload 为 [obj, 数组缓冲区数量]，数组缓冲区位于带外缓冲区的末尾
+
+MESSAGE_TYPE_CODES: Dict[IPCMessageType, int] = {
+    msg_type: code for code, msg_type in enumerate(IPCMessageType)
+}
+MESSAGE_TYPES: List[IPCMessageType] = list(IPCMessageType)
+
+ARRAY_KEY = "__ndarray__"
+SHM_ARRAY_THRESHOLD = 1 << 16  # 自动传输时大于该字节数的数组放入共享内存
+
+# memoryview 的格式字符对应的 NumPy dtype 种类，数组描述与 my_ipc.public.pack_arrays 的相同
+_FORMAT_KINDS = dict(zip("bBhHiIlLqQnNefd?", "iuiuiuiuiuiufffb"))
+_NATIVE_ORDER = "<" if sys.byteorder == "little" else ">"
+# (dtype 种类, 字节数) -> 格式字符，用于把收到的数组解释为 memoryview
+_KIND_FORMATS = {
+    (kind, str(struct.calcsize(fmt))): fmt for fmt, kind in reversed(_FORMAT_KINDS.items())
+}
+
+
+def _dtype_of(view: memoryview) -> Union[str, None]:
+    """memoryview 元素类型对应的 NumPy dtype 字符串，没有对应的类型时为 None"""
+    kind = _FORMAT_KINDS.get(view.format[1:] if view.format[:1] == "@" else view.format)
+    if kind is None:
+        return None
+    return f"{'|' if view.itemsize == 1 else _NATIVE_ORDER}{kind}{view.itemsize}"
+
+
+def _nbytes(spec: Dict[str, Any], available: int) -> int:
+    """
+    数组描述对应的字节数；dtype 不在 _KIND_FORMATS 中时（复数、字符串等）无法得知元素大小，
+    取共享内存中从数组起点开始的全部 available 字节
+    """
+    fmt = _KIND_FORMATS.get((spec["dtype"][1:2], spec["dtype"][2:]))
+    if fmt is None:
+        return available
+    return math.prod(spec["shape"]) * struct.calcsize(fmt)
+
+
+def _typed_view(buffer: Any, dtype: str, shape: List[int]) -> memoryview:
+    """按 dtype 和 shape 解释字节缓冲区；memoryview 不支持的类型（复数、非本机字节序等）返回一维字节视图"""
+    view = memoryview(buffer).cast("B")
+    fmt = _KIND_FORMATS.get((dtype[1:2], dtype[2:]))
+    if fmt is None or dtype[0] not in ("|", "=", _NATIVE_ORDER):
+        return view
+    return view.cast(fmt, shape) if view.nbytes else view.cast(fmt)
+
+
+def _map_shm(name: str, writable: bool = False) -> mmap.mmap:
+    """映射对端的具名共享内存段，不经过 resource_tracker"""
+    fd = os.open(os.path.join("/dev/shm", name), os.O_RDWR if writable else os.O_RDONLY)
+    try:
+        return mmap.mmap(
+            fd,
+            0,
+            flags=mmap.MAP_SHARED | getattr(mmap, "MAP_POPULATE", 0),
+            prot=mmap.PROT_READ | (mmap.PROT_WRITE if writable else 0),
+        )
+    finally:
+        os.close(fd)
+
+
+class BufferTransport:
+    """
+    不依赖 NumPy 的大块数据传输状态，与 my_ipc.public.ArrayTransport 的协议兼容
+    发送的数据写入本端的共享内存段借给对端，对端归还后复用；
+    收到的共享内存数据以零拷贝的 memoryview 使用，映射按段名缓存，
+    某个段上的视图全部被回收后，随下一条消息归还该段（或释放其中的 arena 块）
+    """
+
+    def __init__(self, id: str, max_bytes: int = 1 << 30, bytes_as_views: bool = False):
+        self.id = id
+        # 对端发送的较大 bytes/bytearray 默认拷贝还原为 bytes，为 True 时同其他数据一样返回 memoryview
+        self.bytes_as_views = bytes_as_views
+        # 空闲共享内存段、以及缓存的对端段映射各自的总字节数上限
+        self.max_bytes = max_bytes
+        self._free: "OrderedDict[str, shared_memory.SharedMemory]" = OrderedDict()
+        self._free_bytes = 0
+        # 借给对端、尚未归还的段
+        self._lent: Dict[str, shared_memory.SharedMemory] = {}
+        # 对端段的映射，按最近使用排序；视图通过 memoryview 引用映射，引用计数即可判断是否仍在使用
+        self._maps: "OrderedDict[str, mmap.mmap]" = OrderedDict()
+        self._map_bytes = 0
+        # 视图仍可能存活的对端段：借来的段，以及 arena 段中已交出的块
+        self._borrowed: Set[str] = set()
+        self._blocks: Dict[str, List[List[Any]]] = {}
+        # 等待随下一条消息发给对端的淘汰通知
+        self._evicted: List[str] = []
+        self._lock = threading.Lock()
+
+    def lend(self, view: memoryview, dtype: str) -> Dict[str, Any]:
+        size = _size_class(view.nbytes)
+        with self._lock:
+            shm = next((s for s in reversed(self._free.values()) if s.size == size), None)
+            if shm is not None:
+                del self._free[shm.name]
+                self._free_bytes -= size
+        if shm is None:
+            name = generate_shm_name(self.id, "tmp_" + uuid.uuid4().hex)
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        shm.buf[: view.nbytes] = view.cast("B") if view.c_contiguous else view.tobytes()
+        with self._lock:
+            self._lent[shm.name] = shm
+        return {"dtype": dtype, "shape": list(view.shape), "shm": shm.name}
+
+    def borrow(self, spec: Dict[str, Any]) -> memoryview:
+        """对端借来的段映射为只读 memoryview"""
+        name = spec["shm"]
+        with self._lock:
+            mm = self._map(name, writable=False)
+            self._borrowed.add(name)
+        nbytes = _nbytes(spec, len(mm))
+        return _typed_view(memoryview(mm)[:nbytes], spec["dtype"], spec["shape"])
+
+    def map_block(self, spec: Dict[str, Any]) -> memoryview:
+        """服务器在 arena 中分配的输出数组映射为可写 memoryview，视图全部被回收后通知服务器释放"""
+        name, offset = spec["arena"], spec["offset"]
+        with self._lock:
+            mm = self._map(name, writable=True)
+            self._blocks.setdefault(name, []).append([name, offset])
+        nbytes = _nbytes(spec, len(mm) - offset)
+        return _typed_view(
+            memoryview(mm)[offset : offset + nbytes], spec["dtype"], spec["shape"]
+        )
+
+    def _map(self, name: str, writable: bool) -> mmap.mmap:
+        mm = self._maps.get(name)
+        if mm is None:
+            mm = self._maps[name] = _map_shm(name, writable)
+            self._map_bytes += len(mm)
+        else:
+            self._maps.move_to_end(name)
+        return mm
+
+    def _in_use(self, name: str) -> bool:
+        # 缓存和 getrefcount 的参数之外的引用都来自仍然存活的视图
+        return sys.getrefcount(self._maps[name]) > 2
+
+    def outgoing(self) -> Union[Dict[str, List[Any]], None]:
+        """随下一条消息发给对端的归还、淘汰和释放通知"""
+        with self._lock:
+            released = [name for name in self._borrowed if not self._in_use(name)]
+            self._borrowed.difference_update(released)
+            freed = []
+            for name in [name for name in self._blocks if not self._in_use(name)]:
+                freed += self._blocks.pop(name)
+            # 超出上限时解除最久未使用、且没有视图的映射
+            for name in list(self._maps):
+                if self._map_bytes <= self.max_bytes:
+                    break
+                if name not in self._borrowed and name not in self._blocks:
+                    self._map_bytes -= len(self._maps.pop(name))
+            evicted, self._evicted = self._evicted, []
+        if not released and not evicted and not freed:
+            return None
+        return {"released": released, "evicted": evicted, "freed": freed}
+
+    def incoming(self, notice: Dict[str, List[Any]]):
+        """处理对端的归还通知，以及对端已删除的段的淘汰通知"""
+        with self._lock:
+            for name in notice.get("released", []):
+                shm = self._lent.pop(name, None)
+                if shm is None:
+                    continue
+                self._free[name] = shm
+                self._free_bytes += shm.size
+            while self._free_bytes > self.max_bytes and self._free:
+                name, shm = self._free.popitem(last=False)
+                self._free_bytes -= shm.size
+                shm.close()
+                shm.unlink()
+                self._evicted.append(name)
+            for name in notice.get("evicted", []):
+                # 对端只淘汰已归还的段，映射在最后一个视图被回收时解除
+                mm = self._maps.pop(name, None)
+                if mm is not None:
+                    self._map_bytes -= len(mm)
+                    self._borrowed.discard(name)
+
+    def close(self):
+        with self._lock:
+            segments = list(self._lent.values()) + list(self._free.values())
+            self._lent, self._free, self._free_bytes = {}, OrderedDict(), 0
+            self._maps, self._map_bytes = OrderedDict(), 0
+        for shm in segments:
+            shm.close()
+            shm.unlink()
+
+
+def pack_buffers(obj: Any, buffers: List[memoryview], transport: BufferTransport) -> Any:
+    """
+    把 obj（dict/list/tuple 的任意嵌套）中的 bytes/bytearray/memoryview/array.array 替换为 {ARRAY_KEY: 描述} 标记，
+    对端为 my_ipc 的完整版本时还原为 NumPy 数组：
+    大于 SHM_ARRAY_THRESHOLD 字节的数据写入共享内存借给对端，较小的 memoryview/array.array 追加到 buffers，
+    较小的 bytes/bytearray 仍交给编解码器；较大的 bytes/bytearray 在描述中标记 "bytes"，对端据此还原为 bytes；
+    没有需要替换的值时原样返回 obj 本身
+    """
+    if isinstance(obj, (bytes, bytearray, memoryview, array.array)):
+        if isinstance(obj, (bytes, bytearray)) and len(obj) <= SHM_ARRAY_THRESHOLD:
+            return obj
+        view = memoryview(obj)
+        dtype = _dtype_of(view)
+        if dtype is None:
+            return obj
+        if view.nbytes > SHM_ARRAY_THRESHOLD:
+            spec = transport.lend(view, dtype)
+            if isinstance(obj, (bytes, bytearray)):
+                spec["bytes"] = True
+            return {ARRAY_KEY: spec}
+        contiguous = view.c_contiguous and view.nbytes
+        buffers.append(view.cast("B") if contiguous else memoryview(view.tobytes()))
+        return {ARRAY_KEY: {"dtype": dtype, "shape": list(view.shape), "buf": len(buffers) - 1}}
+    if isinstance(obj, dict):
+        packed = None
+        for key, value in obj.items():
+            new = pack_buffers(value, buffers, transport)
+            if new is not value:
+                if packed is None:
+                    packed = dict(obj)
+                packed[key] = new
+        return obj if packed is None else packed
+    if isinstance(obj, (list, tuple)):
+        packed_list = None
+        for i, value in enumerate(obj):
+            new = pack_buffers(value, buffers, transport)
+            if new is not value:
+                if packed_list is None:
+                    packed_list = list(obj)
+                packed_list[i] = new
+        return obj if packed_list is None else packed_list
+    return obj
+
+
+def unpack_buffers(obj: Any, buffers: List[bytearray], transport: BufferTransport) -> Any:
+    """
+    pack_buffers（以及 my_ipc.public.pack_arrays）的逆操作，数组还原为直接指向接收缓冲区或共享内存的 memoryview；
+    标记了 "bytes" 的数据拷贝为 bytes，保持发送方的类型（transport.bytes_as_views 为 True 时同样返回 memoryview）
+    """
+    if isinstance(obj, dict):
+        spec = obj.get(ARRAY_KEY) if len(obj) == 1 else None
+        if spec is not None:
+            if "shm" in spec:
+                view = transport.borrow(spec)
+            elif "arena" in spec:
+                view = transport.map_block(spec)
+            else:
+                view = _typed_view(buffers[spec["buf"]], spec["dtype"], spec["shape"])
+            if spec.get("bytes") and not transport.bytes_as_views:
+                # 拷贝后视图随即回收，共享内存段随下一条消息归还
+                return view.tobytes()
+            return view
+        for key, value in obj.items():
+            obj[key] = unpack_buffers(value, buffers, transport)
+        return obj
+    if isinstance(obj, list):
+        for i, value in enumerate(obj):
+            obj[i] = unpack_buffers(value, buffers, transport)
+        return obj
+    if isinstance(obj, tuple):
+        return tuple(unpack_buffers(value, buffers, transport) for value in obj)
+    return obj
+
+
+def send_message(
+    sock: socket.socket,
+    msg: IPCMessage,
+    codec: Union[Codec, None] = None,
+    arrays: Union[BufferTransport, None] = None,
+) -> int:
+    """
+    codec 为 None 时使用 JSON 字符串帧，用于还未协商编解码器的 INIT 消息；返回帧的字节数
+    arrays 不为 None 时 data 中的 bytes/memoryview/array.array 见 pack_buffers
+    """
+    if codec is None:
+        frame = encode_str(msg.to_json())
+        sock.sendall(frame)
+        return len(frame)
+    flags = 0
+    obj = msg.data
+    meta = msg.meta
+    array_buffers: List[memoryview] = []
+    has_arrays = False
+    if arrays is not None:
+        obj = pack_buffers(obj, array_buffers, arrays)
+        has_arrays = obj is not msg.data
+        notice = arrays.outgoing()
+        if notice is not None:
+            meta = {**(meta or {}), "arrays": notice}
+    if meta is not None:
+        flags |= FLAG_META
+        obj = [obj, meta]
+    if has_arrays:
+        flags |= FLAG_ARRAYS
+        obj = [obj, len(array_buffers)]
+    payload, buffers = codec.encode(obj)
+    buffers = buffers + array_buffers
+    header = FRAME_HEADER.pack(
+        MESSAGE_TYPE_CODES[msg.type], flags, len(buffers), msg.id, len(payload)
+    )
+    if buffers:
+        header += struct.pack(f"!{len(buffers)}Q", *(buffer.nbytes for buffer in buffers))
+    sendmsg_all(sock, [header, payload, *buffers])
+    return len(header) + len(payload) + sum(buffer.nbytes for buffer in buffers)
+
+
+def recv_message(
+    reader: SocketReader,
+    codec: Union[Codec, None] = None,
+    arrays: Union[BufferTransport, None] = None,
+) -> IPCMessage:
+    """接收一个帧，连接关闭时抛出 ConnectionError；arrays 见 send_message"""
+    if codec is None:
+        bufsize_bytes = reader.peek(4, eof_ok=True)
+        if bufsize_bytes is None:
+            raise ConnectionError("连接已关闭")
+        bufsize = int.from_bytes(bufsize_bytes, byteorder="big")
+        reader.skip(4)
+        return IPCMessage.from_json(str(reader.read(bufsize), "utf-8"))
+    header_bytes = reader.peek(FRAME_HEADER.size, eof_ok=True)
+    if header_bytes is None:
+        raise ConnectionError("连接已关闭")
+    type_code, flags, nbufs, req_id, length = FRAME_HEADER.unpack(header_bytes)
+    reader.skip(FRAME_HEADER.size)
+    lengths = struct.unpack(f"!{nbufs}Q", reader.read(8 * nbufs)) if nbufs else ()
+    if length > 64 * 1024 or nbufs:
+        payload = bytearray(length)
+        reader.read_into(memoryview(payload))
+    else:
+        payload = bytes(reader.read(length))
+    buffers = []
+    for n in lengths:
+        buffer = bytearray(n)
+        reader.read_into(memoryview(buffer))
+        buffers.append(buffer)
+    obj = codec.decode(payload, buffers)
+    array_buffers: List[bytearray] = []
+    if flags & FLAG_ARRAYS:
+        obj, n = obj
+        array_buffers = buffers[len(buffers) - n :]
+    meta = None
+    if flags & FLAG_META:
+        obj, meta = obj
+        if arrays is not None and "arrays" in meta:
+            arrays.incoming(meta.pop("arrays"))
+    if flags & FLAG_ARRAYS and arrays is not None:
+        obj = unpack_buffers(obj, array_buffers, arrays)
+    return IPCMessage(type=MESSAGE_TYPES[type_code], id=req_id, data=obj, meta=meta)
+
+
+# 每个 2 倍区间分成的桶数（2 的幂），分位数的相对误差不超过 1 / _SUB_BUCKETS
+_SUB_BUCKETS = 8
+_SUB_BITS = _SUB_BUCKETS.bit_length() - 1
+
+
+def _bucket(ns: int) -> int:
+    """对数线性分桶：小于 2 * _SUB_BUCKETS 的值各占一个桶，之后每个 2 倍区间 _SUB_BUCKETS 个桶"""
+    if ns < 2 * _SUB_BUCKETS:
+        return max(ns, 0)
+    shift = ns.bit_length() - _SUB_BITS - 1
+    return shift * _SUB_BUCKETS + (ns >> shift)
+
+
+def _bucket_midpoint(bucket: int) -> float:
+    if bucket < 2 * _SUB_BUCKETS:
+        return float(bucket)
+    shift = bucket // _SUB_BUCKETS - 1
+    return ((bucket % _SUB_BUCKETS + _SUB_BUCKETS) << shift) + (1 << shift) / 2
+
+
+class Histogram:
+    """耗时直方图（纳秒），记录一次只需一次分桶计算和几次加法"""
+
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets: Dict[int, int] = {}
+
+    def record(self, ns: int):
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+        bucket = _bucket(ns)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, q: float) -> float:
+        """第 q（0~1）分位数的估计值（纳秒），取所在桶的中点"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(_bucket_midpoint(bucket), float(self.max))
+        return float(self.max)
+
+    def summary(self) -> Dict[str, float]:
+        """次数，以及以秒为单位的总耗时、平均值、p50/p90/p99 和最大值"""
+        return {
+            "count": self.count,
+            "total": self.total / 1e9,
+            "mean": self.total / self.count / 1e9 if self.count else 0.0,
+            "p50": self.percentile(0.5) / 1e9,
+            "p90": self.percentile(0.9) / 1e9,
+            "p99": self.percentile(0.99) / 1e9,
+            "max": self.max / 1e9,
+        }
+
+
+class Metrics:
+    """
+    客户端或服务器的性能统计：各阶段耗时的直方图、字节数和消息数等计数器，以及可选的 trace 事件
+    时间戳使用 time.perf_counter_ns（Linux 上为 CLOCK_MONOTONIC），同一台机器上各进程的事件可以合并到一条时间线
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases: Dict[str, Histogram] = {}
+        self._counters: Dict[str, int] = {}
+        self._since = time.perf_counter_ns()
+        # 开启 trace 后保存最近的事件，超过上限时丢弃最早的
+        self._trace: Union[Deque[Dict[str, Any]], None] = None
+        self._pid = os.getpid()
+
+    def observe(self, phase: str, start_ns: int, end_ns: Union[int, None] = None, id: int = 0):
+        """记录阶段 phase 从 start_ns 到 end_ns（默认为现在）的耗时；id 为请求 id，写入 trace 事件"""
+        if end_ns is None:
+            end_ns = time.perf_counter_ns()
+        with self._lock:
+            histogram = self._phases.get(phase)
+            if histogram is None:
+                histogram = self._phases[phase] = Histogram()
+            histogram.record(end_ns - start_ns)
+            if self._trace is not None:
+                self._trace.append(
+                    {
+                        "name": phase,
+                        "ph": "X",
+                        "ts": start_ns / 1000,
+                        "dur": (end_ns - start_ns) / 1000,
+                        "pid": self._pid,
+                        "tid": threading.get_ident(),
+                        "args": {"id": id},
+                    }
+                )
+
+    def add(self, counter: str, n: int = 1):
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + n
+
+    def snapshot(self, reset: bool = False) -> Dict[str, Any]:
+        """
+        返回统计窗口（上次 reset 以来）的秒数、各阶段的 Histogram.summary、计数器及其每秒速率
+        reset: 读取后清零，便于按时间段统计
+        """
+        now = time.perf_counter_ns()
+        with self._lock:
+            elapsed = (now - self._since) / 1e9
+            stats = {
+                "elapsed": elapsed,
+                "phases": {name: h.summary() for name, h in self._phases.items()},
+                "counters": dict(self._counters),
+                "rates": {
+                    name: n / elapsed if elapsed > 0 else 0.0
+                    for name, n in self._counters.items()
+                },
+            }
+            if reset:
+                self._phases = {}
+                self._counters = {}
+                self._since = now
+        return stats
+
+    def start_trace(self, max_events: int = 1 << 20):
+        """开始记录 trace 事件，最多保留最近的 max_events 个"""
+        with self._lock:
+            # zygote 模式下 fork 出的子进程继承了父进程的 Metrics
+            self._pid = os.getpid()
+            self._trace = deque(maxlen=max_events)
+
+    def stop_trace(self) -> List[Dict[str, Any]]:
+        """停止记录并取走已记录的 trace 事件"""
+        with self._lock:
+            events, self._trace = self._trace, None
+        return list(events or ())
+
+
+
+# 嵌入版服务器处理的消息类型，其他类型（SHM_UPDATE 等）回复 ERROR
+_HANDLED_TYPES = (
+    IPCMessageType.REQUEST,
+    IPCMessageType.STREAM_REQUEST,
+    IPCMessageType.STATS,
+)
 
 
 class IPCServer:
     """IPC服务器基类"""
 
-    def __init__(self, id: str):
+    def __init__(self, id: str, metrics: bool = False, bytes_as_views: bool = False):
         self.id = id
+        # 请求中较大的 bytes 以 memoryview 交给 handle_request，不拷贝
+        self.bytes_as_views = bytes_as_views
         self.socket_path = generate_socket_path(self.id)
+        # 记录各阶段耗时和收发的字节数，见 get_stats
+        self.metrics = Metrics() if metrics else None
 
     def start_server(self):
         """启动服务器监听"""
         server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        arrays: Union[BufferTransport, None] = None
 
         try:
             server_socket.bind(self.socket_path)
             server_socket.listen(1)
+            notify_ready()
 
             client_socket, _ = server_socket.accept()
+            reader = SocketReader(client_socket)
 
             # 接收初始化信息（不包含共享内存信息）
-            data = recv_str(client_socket)
-            init_info = json.loads(data)
+            msg = recv_message(reader)
+            init_info = msg.data
+            codec = None
+            if "codecs" in init_info:
+                # 协商编解码器；旧版本客户端不提供 codecs，继续使用 JSON 字符串帧
+                codec = next(
+                    (CODECS[name] for name in init_info["codecs"] if name in CODECS),
+                    CODECS["json"],
+                )
+                reply: Dict[str, Any] = {"codec": codec.name, "stats": True}
+                if init_info.get("arrays"):
+                    # 较大的 bytes/memoryview/array.array 和完整版客户端的大数组经过共享内存传输
+                    arrays = BufferTransport(self.id, bytes_as_views=self.bytes_as_views)
+                    reply["arrays"] = True
+                send_message(client_socket, IPCMessage(IPCMessageType.INIT, data=reply))
 
             self.after_init(init_info)
 
+            def send(msg: IPCMessage):
+                if self.metrics is None:
+                    send_message(client_socket, msg, codec, arrays)
+                    return
+                start = time.perf_counter_ns()
+                nbytes = send_message(client_socket, msg, codec, arrays)
+                self.metrics.observe("send", start, id=msg.id)
+                self.metrics.add("messages_sent")
+                self.metrics.add("bytes_sent", nbytes)
+
+            def receive():
+                if self.metrics is None:
+                    msg = recv_message(reader, codec, arrays)
+                else:
+                    # 只统计帧到达之后的接收和解码，不包括等待客户端的时间
+                    reader.peek(FRAME_HEADER.size, eof_ok=True)
+                    start, consumed = time.perf_counter_ns(), reader.consumed
+                    msg = recv_message(reader, codec, arrays)
+                    self.metrics.observe("deserialize", start, id=msg.id)
+                    self.metrics.add("messages_received")
+                    self.metrics.add("bytes_received", reader.consumed - consumed)
+                pending.append((msg, time.perf_counter_ns()))
+
+            # 已到达、尚未处理的消息及其到达时间，从中选出优先级最高的请求处理
+            pending: Deque[Tuple[IPCMessage, int]] = deque()
             while True:
-                data = recv_str(client_socket)
-                if not data or data.strip() == IPCMessageType.QUIT.value:
+                try:
+                    if not pending:
+                        receive()
+                    while reader.buffered() or select.select([client_socket], [], [], 0)[0]:
+                        receive()
+                except ConnectionError:
+                    if not pending:
+                        break
+                # 请求不会越过 STATS 等其他消息
+                best, best_key = 0, None
+                for i, (msg, received_at) in enumerate(pending):
+                    if msg.type not in (IPCMessageType.REQUEST, IPCMessageType.STREAM_REQUEST):
+                        break
+                    key = schedule_key(msg, received_at)
+                    if best_key is None or key < best_key:
+                        best, best_key = i, key
+                msg, received_at = pending[best]
+                del pending[best]
+                if msg.type == IPCMessageType.QUIT:
                     break
+                if msg.type not in _HANDLED_TYPES:
+                    # 共享数组更新等嵌入版不支持的消息
+                    error = f"不支持的消息类型: {msg.type.value}"
+                    send(IPCMessage(IPCMessageType.ERROR, msg.id, error))
+                    continue
+
+                now = time.perf_counter_ns()
+                if msg.type != IPCMessageType.STATS and now > request_deadline(msg, received_at):
+                    # 已超过截止时间，不再调用处理函数
+                    if self.metrics is not None:
+                        self.metrics.add("deadline_exceeded")
+                    late_ms = (now - request_deadline(msg, received_at)) / 1e6
+                    send(
+                        IPCMessage(
+                            IPCMessageType.ERROR,
+                            msg.id,
+                            f"截止时间已过 {late_ms:.1f} ms",
+                            {"code": DEADLINE_EXCEEDED},
+                        )
+                    )
+                    continue
 
-                if data.strip() == IPCMessageType.STREAM_REQUEST.value:
+                if msg.type == IPCMessageType.STATS:
+                    try:
+                        stats = self._query_stats(msg.data)
+                    except Exception as e:
+                        send(IPCMessage(IPCMessageType.ERROR, msg.id, repr(e)))
+                    else:
+                        send(IPCMessage(IPCMessageType.RESPONSE, msg.id, stats))
+                elif msg.type == IPCMessageType.STREAM_REQUEST:
                     # 处理流式请求
-                    request = json.loads(recv_str(client_socket))
                     try:
-                        for response in self.handle_stream_request(request):
-                            send_str(client_socket, IPCMessageType.STREAM_DATA.value)
-                            send_str(client_socket, json.dumps(response))
-                        send_str(client_socket, IPCMessageType.STREAM_END.value)
-                    except Exception:
-                        send_str(client_socket, IPCMessageType.ERROR.value)
+                        responses = iter(self.handle_stream_request(msg.data))
+                        while True:
+                            start = time.perf_counter_ns()
+                            try:
+                                response = next(responses)
+                            except StopIteration:
+                                break
+                            if self.metrics is not None:
+                                self.metrics.observe("stream_item", start, id=msg.id)
+                                self.metrics.add("stream_items")
+                            send(IPCMessage(IPCMessageType.STREAM_DATA, msg.id, response))
+                        send(IPCMessage(IPCMessageType.STREAM_END, msg.id))
+                    except Exception as e:
+                        send(IPCMessage(IPCMessageType.ERROR, msg.id, repr(e)))
                         raise
-                else:
+                elif msg.type == IPCMessageType.REQUEST:
                     # 处理普通请求
-                    request = json.loads(data)
+                    start = time.perf_counter_ns()
                     try:
-                        response = self.handle_request(request)
-                    except Exception:
-                        send_str(client_socket, IPCMessageType.ERROR.value)
+                        response = self.handle_request(msg.data)
+                    except Exception as e:
+                        send(IPCMessage(IPCMessageType.ERROR, msg.id, repr(e)))
                         raise
-                    send_str(client_socket, json.dumps(response))
+                    finally:
+                        if self.metrics is not None:
+                            self.metrics.observe("handler", start, id=msg.id)
+                    send(IPCMessage(IPCMessageType.RESPONSE, msg.id, response))
 
             client_socket.close()
 
         finally:
+            if arrays is not None:
+                arrays.close()
             server_socket.close()
             os.unlink(self.socket_path)
 
+    def _query_stats(self, query: Dict[str, Any]) -> Dict[str, Any]:
+        """处理客户端的 STATS 消息"""
+        if self.metrics is None:
+            raise RuntimeError("服务器未开启性能统计")
+        reply: Dict[str, Any] = {"stats": self.get_stats(query.get("reset", False))}
+        if query.get("trace") == "start":
+            self.metrics.start_trace(query.get("max_events", 1 << 20))
+        elif query.get("trace") == "stop":
+            reply["trace"] = self.metrics.stop_trace()
+        return reply
+
+    def get_stats(self, reset: bool = False) -> Dict[str, Any]:
+        """
+        服务器的性能统计，阶段：deserialize、send（编码并发送）、handler、stream_item；
+        计数器：messages_sent/received、bytes_sent/received、stream_items
+        """
+        assert self.metrics is not None, "未开启性能统计"
+        return self.metrics.snapshot(reset)
+
     def handle_request(self, request: Dict[str, Any]) -> Dict[str, Any]:
         """
         处理请求的抽象方法，子类需要实现
+        请求中的 memoryview/array.array 还原为 memoryview，bytes 仍为 bytes（bytes_as_views 时为 memoryview），
+        见 unpack_buffers
         """
         raise NotImplementedError
 
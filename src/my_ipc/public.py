@@ -1,30 +1,90 @@
+import bisect
+from collections import OrderedDict, deque
+import contextlib
 from dataclasses import dataclass
 from multiprocessing import resource_tracker
-import enum
+import array
+import asyncio
+import ctypes
+import fcntl
 import json
+import mmap
 from multiprocessing import shared_memory
+import os
 import socket
-from typing import Tuple
+import struct
+import threading
+import time
+from typing import Any, Callable, Deque, Dict, Iterator, List, Sequence, Tuple, Union
+import uuid
 
 import numpy as np
-
-
-class IPCMessageType(enum.Enum):
-    QUIT = "QUIT"
-    ERROR = "ERROR"
-    TMP_SHARED_ARRAY = "TMP_SHARED_ARRAY"
-    STREAM_REQUEST = "STREAM_REQUEST"
-    STREAM_DATA = "STREAM_DATA"
-    STREAM_END = "STREAM_END"
+from my_ipc.ipc_metrics import Metrics
+# 不依赖 NumPy 的协议部分，从这里重新导出
+from my_ipc.ipc_protocol import (
+    ARRAY_KEY,
+    choose_codec,
+    Codec,
+    CODECS,
+    connect_when_ready,
+    DEADLINE_EXCEEDED,
+    DeadlineExceededError,
+    DEFAULT_CODECS,
+    encode_str,
+    FLAG_ARRAYS,
+    FLAG_META,
+    FRAME_HEADER,
+    generate_shm_name,
+    generate_socket_path,
+    IPCMessage,
+    IPCMessageType,
+    JsonCodec,
+    MESSAGE_TYPE_CODES,
+    MESSAGE_TYPES,
+    MsgpackCodec,
+    notify_ready,
+    PickleCodec,
+    raise_for_error,
+    READY_FD_ENV,
+    recv_exactly,
+    recv_exactly_into,
+    recv_str,
+    register_codec,
+    request_deadline,
+    schedule_key,
+    schedule_meta,
+    send_str,
+    sendmsg_all,
+    ServerStartError,
+    SHM_ARRAY_THRESHOLD,
+    _size_class,
+    SocketReader,
+    spawn_server,
+)
 
 
 @dataclass
 class ShmArrayInfo:
     shape: Tuple[int, ...]
     dtype: type
+    # 大于 1 时为多槽（双缓冲/三缓冲）共享数组，见 ShmSlotArray
+    slots: int = 1
+    # 以下为分配选项，创建方和映射方都会按它们处理自己的映射
+    # "transparent"：madvise(MADV_HUGEPAGE) 使用透明大页；"explicit"：hugetlbfs 大页，需要 memfd 后端和预留的大页
+    hugepages: Union[str, None] = None
+    # 创建和映射时预先触发缺页，第一个请求不再付出缺页的开销
+    prefault: bool = False
+    # 锁定在物理内存中（同时预先触发缺页），受 RLIMIT_MEMLOCK 限制
+    mlock: bool = False
 
     def to_json(self) -> str:
-        return json.dumps({"shape": self.shape, "dtype": np.dtype(self.dtype).str})
+        obj: Dict[str, Any] = {"shape": self.shape, "dtype": np.dtype(self.dtype).str}
+        if self.slots > 1:
+            obj["slots"] = self.slots
+        for key in ("hugepages", "prefault", "mlock"):
+            if getattr(self, key):
+                obj[key] = getattr(self, key)
+        return json.dumps(obj)
 
     @staticmethod
     def from_json(data: str) -> "ShmArrayInfo":
@@ -32,27 +92,238 @@ class ShmArrayInfo:
         return ShmArrayInfo(
             shape=tuple(obj["shape"]),
             dtype=np.dtype(obj["dtype"]).type,
+            slots=obj.get("slots", 1),
+            hugepages=obj.get("hugepages"),
+            prefault=obj.get("prefault", False),
+            mlock=obj.get("mlock", False),
         )
 
+    @property
+    def nbytes(self) -> int:
+        """一份数组（多槽时为一个槽）的字节数"""
+        return int(np.prod(self.shape, dtype=np.int64)) * np.dtype(self.dtype).itemsize
+
+    def segment_size(self, capacity: Union[int, None] = None) -> int:
+        """每份数组可以容纳 capacity（默认 nbytes）字节时，共享内存段的大小"""
+        if capacity is None:
+            capacity = self.nbytes
+        if self.slots == 1:
+            return capacity
+        return self.slots * (_SLOT_HEADER + -(-capacity // _SLOT_HEADER) * _SLOT_HEADER)
+
+
+class MemfdSegment:
+    """
+    memfd_create 创建的匿名共享内存，接口与 SharedMemory 相同（name、buf、size、close、unlink）
+    没有 /dev/shm 中的名字，文件描述符通过 SCM_RIGHTS 传给对端；
+    所有映射和文件描述符都关闭后由内核回收，进程崩溃也不会残留，也不需要 resource_tracker
+    创建时封住大小（F_SEAL_SHRINK/GROW），对端无法截断它使本端访问时收到 SIGBUS
+    """
+
+    def __init__(
+        self,
+        name: str,
+        size: int = 0,
+        fd: Union[int, None] = None,
+        hugetlb: bool = False,  # 使用 hugetlbfs 大页，size 向上取整到大页大小
+    ):
+        if fd is None:
+            flags = os.MFD_CLOEXEC | os.MFD_ALLOW_SEALING
+            if hugetlb:
+                flags |= os.MFD_HUGETLB
+                page = _huge_page_size()
+                size = -(-size // page) * page
+            fd = os.memfd_create(name, flags)
+            try:
+                os.ftruncate(fd, size)
+                fcntl.fcntl(
+                    fd,
+                    fcntl.F_ADD_SEALS,
+                    fcntl.F_SEAL_SHRINK | fcntl.F_SEAL_GROW | fcntl.F_SEAL_SEAL,
+                )
+            except BaseException:
+                os.close(fd)
+                raise
+        else:
+            size = os.fstat(fd).st_size
+        try:
+            # 与 SharedMemory 相同，size 为 0 时映射一个字节
+            self._mmap = mmap.mmap(fd, max(size, 1))
+        except OSError as e:
+            os.close(fd)
+            if hugetlb:
+                raise OSError(e.errno, f"映射大页失败，预留的大页不足（vm.nr_hugepages）: {e}") from None
+            raise
+        self.name = name
+        self.fd = fd
+        self.size = size
+        self.buf = memoryview(self._mmap)
+
+    def close(self):
+        if self.buf is not None:
+            self.buf.release()
+            self.buf = None  # type: ignore
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None  # type: ignore
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def unlink(self):
+        pass
+
+
+def _huge_page_size() -> int:
+    """hugetlbfs 默认大页的大小"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("Hugepagesize:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 2 << 20
+
+
+# Linux 5.14 加入，Python 的 mmap 模块可能没有这个常量
+_MADV_POPULATE_WRITE = getattr(mmap, "MADV_POPULATE_WRITE", 23)
+_libc = ctypes.CDLL(None, use_errno=True)
+
+
+def _prepare_mapping(shm: Union[shared_memory.SharedMemory, MemfdSegment], info: ShmArrayInfo):
+    """按 info 的分配选项处理刚创建或映射的共享内存段"""
+    mm: mmap.mmap = shm._mmap  # type: ignore
+    if info.hugepages == "transparent" and hasattr(mmap, "MADV_HUGEPAGE"):
+        # /dev/shm 还需要 /sys/kernel/mm/transparent_hugepage/shmem_enabled 为 advise 或 always
+        mm.madvise(mmap.MADV_HUGEPAGE)
+    if info.mlock:
+        # 取得地址后立即释放 ctypes 对象，不保留对 buf 的导出
+        address = ctypes.addressof(ctypes.c_char.from_buffer(shm.buf))
+        if _libc.mlock(ctypes.c_void_p(address), ctypes.c_size_t(shm.size)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"mlock 失败: {os.strerror(errno)}")
+    elif info.prefault:
+        try:
+            mm.madvise(_MADV_POPULATE_WRITE)
+        except OSError:
+            # 旧内核：每页读写一个字节，不改变已有的内容
+            pages = np.frombuffer(shm.buf, np.uint8)[:: mmap.PAGESIZE]
+            pages[:] = pages
+            del pages
+
+
+def _open_shm(
+    info: ShmArrayInfo,
+    name: str,
+    create: bool,
+    size: int,
+    memfd: bool = False,
+    fd: Union[int, None] = None,
+) -> Union[shared_memory.SharedMemory, MemfdSegment]:
+    shm = _open_shm_segment(name, create, size, memfd, fd, info.hugepages == "explicit")
+    try:
+        _prepare_mapping(shm, info)
+    except BaseException:
+        shm.close()
+        if create:
+            shm.unlink()
+        raise
+    return shm
+
+
+def _open_shm_segment(
+    name: str,
+    create: bool,
+    size: int,
+    memfd: bool,
+    fd: Union[int, None],
+    hugetlb: bool,
+) -> Union[shared_memory.SharedMemory, MemfdSegment]:
+    if fd is not None:
+        return MemfdSegment(name, fd=fd)
+    if memfd:
+        assert create
+        return MemfdSegment(name, size, hugetlb=hugetlb)
+    if hugetlb and create:
+        raise ValueError('hugepages="explicit" 需要 memfd 后端（shm_backend="memfd"）')
+    if create:
+        return shared_memory.SharedMemory(create=True, size=size, name=name)
+    shm = shared_memory.SharedMemory(name=name, create=False)
+    # 对于 create = False 的共享内存，不要让 resource_tracker 去跟踪它, 否则会报警告
+    resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore
+    return shm
+
 
 class ShmArray:
-    def __init__(self, info: ShmArrayInfo, name: str, create: bool = False):
+    def __init__(
+        self,
+        info: ShmArrayInfo,
+        name: str,
+        create: bool = False,
+        size: Union[int, None] = None,  # 共享内存段大小，默认恰好容纳 info，可以更大以便复用
+        memfd: bool = False,  # create 时使用 memfd 而不是 /dev/shm 中的具名共享内存
+        fd: Union[int, None] = None,  # 映射对端通过 SCM_RIGHTS 传来的 memfd，取得其所有权
+    ):
         self.info = info
+        self.name = name
         self.need_unlink = create
-        if create:
-            self.shm = shared_memory.SharedMemory(
-                create=True,
-                size=np.zeros(info.shape, dtype=info.dtype).nbytes,
-                name=name,
-            )
-        else:
-            self.shm = shared_memory.SharedMemory(name=name, create=False)
-            # 对于 create = False 的共享内存，不要让 resource_tracker 去跟踪它, 否则会报警告
-            resource_tracker.unregister(self.shm._name, "shared_memory")  # type: ignore
+        # 对端（服务器）是否仍在写入该共享内存，写入期间不允许零拷贝读取
+        self.writing = False
+        # 尚未结束的租约（零拷贝视图或正在执行的请求）数量，大于 0 时推迟 close 等操作
+        self._leases = 0
+        self._lease_lock = threading.Lock()
+        self._unleased_callbacks: List[Callable[[], None]] = []
+        # 上次 take_dirty 之后被写入的字节范围 [start, end)，远程连接据此只推送变化的部分
+        self._dirty: Union[Tuple[int, int], None] = None
+        self._dirty_lock = threading.Lock()
+        self.shm = _open_shm(
+            info, name, create, info.segment_size() if size is None else size, memfd, fd
+        )
+
+    @property
+    def fd(self) -> Union[int, None]:
+        """memfd 的文件描述符，具名共享内存为 None"""
+        return self.shm.fd if isinstance(self.shm, MemfdSegment) else None
 
     def get_info(self) -> ShmArrayInfo:
         return self.info
 
+    @property
+    def capacity(self) -> int:
+        """共享内存段的字节数，不超过它的 resize 无需重新映射"""
+        return self.shm.size
+
+    def resize(self, info: ShmArrayInfo):
+        """在容量范围内原地改变形状和类型，共享内存不变"""
+        assert info.nbytes <= self.capacity, (
+            f"需要 {info.nbytes} 字节，超过了共享内存的容量 {self.capacity}"
+        )
+        self.info = info
+
+    def remap(
+        self,
+        info: ShmArrayInfo,
+        name: str,
+        create: bool = False,
+        size: Union[int, None] = None,
+        fd: Union[int, None] = None,
+    ):
+        """
+        切换到另一个共享内存段（create 时新建大小为 size 的段，与当前段同为具名共享内存或 memfd），
+        已有的 ShmArray 引用继续有效
+        旧段的映射在其上的零拷贝租约全部结束后关闭，由本端创建的旧段立即 unlink
+        """
+        memfd = create and self.fd is not None
+        shm = _open_shm(
+            info, name, create, info.segment_size() if size is None else size, memfd, fd
+        )
+        old = self.shm
+        if self.need_unlink:
+            old.unlink()
+        self.shm, self.name, self.info, self.need_unlink = shm, name, info, create
+        self._on_unleased(old.close)
+
     def write(self, data: np.ndarray):
         assert (
             data.shape == self.info.shape
@@ -62,55 +333,1329 @@ class ShmArray:
         ), f"Expected dtype {self.info.dtype}, but got {data.dtype}"
         shared_array = np.ndarray(data.shape, dtype=data.dtype, buffer=self.shm.buf)
         np.copyto(shared_array, data)
+        self.mark_dirty(0, data.nbytes)
+
+    def mark_dirty(self, offset: int = 0, nbytes: Union[int, None] = None):
+        """
+        记录共享内存中从 offset 开始的 nbytes 字节被改写，默认为整个数组
+        write 会自动调用；绕过 write 直接修改 shm.buf 后需要调用它，远程连接才会推送这些内容
+        """
+        end = offset + (self._dirty_bytes() if nbytes is None else nbytes)
+        with self._dirty_lock:
+            if self._dirty is not None:
+                offset, end = min(offset, self._dirty[0]), max(end, self._dirty[1])
+            self._dirty = (offset, end)
+
+    def take_dirty(self) -> Union[Tuple[int, int], None]:
+        """取走并清除被改写的字节范围 (start, end)，没有改写时为 None"""
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, None
+        return dirty
+
+    def _dirty_bytes(self) -> int:
+        return self.info.nbytes
 
     def read(self) -> np.ndarray:
+        """拷贝出一份独立的数组，之后共享内存被改写或释放都不受影响"""
         shared_array = np.ndarray(
             self.info.shape, dtype=self.info.dtype, buffer=self.shm.buf
         )
-        result = np.zeros(self.info.shape, dtype=self.info.dtype)
-        np.copyto(result, shared_array)
-        return result
+        return shared_array.copy()
+
+    def lease(self) -> "ShmArrayLease":
+        """获取零拷贝只读租约，可用作上下文管理器"""
+        return ShmArrayLease(self)
+
+    def view(self) -> np.ndarray:
+        """
+        返回直接指向共享内存的只读数组，不做任何拷贝
+        返回的数组（及其切片）存活期间共享内存不会被释放
+        """
+        return np.asarray(ShmArrayLease(self))
+
+    def _on_unleased(self, callback: Callable[[], None]):
+        """没有租约时立即调用 callback，否则推迟到最后一个租约结束时调用"""
+        with self._lease_lock:
+            if self._leases > 0:
+                self._unleased_callbacks.append(callback)
+                return
+        callback()
+
+    def _lease_started(self):
+        with self._lease_lock:
+            self._leases += 1
+
+    def _lease_finished(self):
+        with self._lease_lock:
+            self._leases -= 1
+            if self._leases > 0:
+                return
+            callbacks, self._unleased_callbacks = self._unleased_callbacks, []
+        for callback in callbacks:
+            callback()
 
     def close(self):
+        with self._lease_lock:
+            if self._leases > 0:
+                # 仍有零拷贝视图或请求在使用这块共享内存，推迟到最后一个租约结束时再关闭
+                self._unleased_callbacks.append(self.close)
+                return
         self.shm.close()
         if self.need_unlink:
             self.shm.unlink()
             self.need_unlink = False  # 防止重复 unlink
 
     def __del__(self):
-        self.close()
+        if hasattr(self, "shm"):
+            self.close()
+
+
+class ShmArrayLease:
+    """
+    ShmArray 的零拷贝只读租约
+    租约对象被 np.asarray 得到的数组引用为 base，因此数组存活期间租约和共享内存都不会被释放；
+    with 语句退出只表示使用方不再读取，之后不应继续访问 array
+    """
+
+    def __init__(self, shm_arr: ShmArray):
+        if shm_arr.writing:
+            raise RuntimeError("服务器仍在写入该共享内存，无法读取")
+        info = shm_arr.get_info()
+        self.shm_arr = shm_arr
+        # 通过 ctypes 对象持有共享内存的 buffer 导出，防止底层 mmap 被提前关闭
+        self._anchor = ctypes.c_char.from_buffer(shm_arr.shm.buf)
+        shm_arr._lease_started()
+        self.__array_interface__ = {
+            "shape": tuple(info.shape),
+            "typestr": np.dtype(info.dtype).str,
+            "data": (ctypes.addressof(self._anchor), True),
+            "version": 3,
+        }
+        self.released = False
+        self.array: Union[np.ndarray, None] = None
+
+    def __enter__(self) -> np.ndarray:
+        self.array = np.asarray(self)
+        return self.array
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def release(self):
+        """结束租约，之后不应再访问由该租约得到的数组"""
+        self.released = True
+        self.array = None
+
+    def __del__(self):
+        if getattr(self, "_anchor", None) is not None:
+            self._anchor = None
+            self.shm_arr._lease_finished()
+
+
+class ShmArrayPool:
+    """
+    发送端的临时共享内存池（客户端的 tmp_shm，以及双方自动传输的大数组）
+    按尺寸级别复用已经映射并触发过缺页的共享内存段，避免每次请求都 shm_open/ftruncate/mmap/unlink；
+    空闲段按 LRU 淘汰，使空闲段总字节数不超过 max_bytes
+    """
+
+    def __init__(self, id: str, max_bytes: int = 1 << 30):
+        self.id = id
+        self.max_bytes = max_bytes
+        self.free_bytes = 0
+        # name -> ShmArray，按最近使用排序，末尾最新
+        self._free: "OrderedDict[str, ShmArray]" = OrderedDict()
+        # 被淘汰但尚未通知服务器的段名
+        self._evicted: List[str] = []
+        self._lock = threading.Lock()
+
+    def acquire(self, info: ShmArrayInfo) -> ShmArray:
+        size = _size_class(info.nbytes)
+        with self._lock:
+            for name, shm_arr in reversed(self._free.items()):
+                if shm_arr.shm.size == size:
+                    del self._free[name]
+                    self.free_bytes -= size
+                    shm_arr.info = info
+                    return shm_arr
+        name = generate_shm_name(self.id, "tmp_" + uuid.uuid4().hex)
+        return ShmArray(info=info, name=name, create=True, size=size)
+
+    def release(self, shm_arr: ShmArray):
+        """归还共享内存段；若仍有零拷贝视图在使用，推迟到视图全部释放后归还"""
+        shm_arr._on_unleased(lambda: self._put_back(shm_arr))
+
+    def _put_back(self, shm_arr: ShmArray):
+        with self._lock:
+            self._free[shm_arr.name] = shm_arr
+            self.free_bytes += shm_arr.shm.size
+            while self.free_bytes > self.max_bytes and self._free:
+                name, evicted = self._free.popitem(last=False)
+                self.free_bytes -= evicted.shm.size
+                evicted.close()
+                self._evicted.append(name)
+
+    def pop_evicted(self) -> List[str]:
+        """取出自上次调用以来被淘汰的段名，用于通知服务器解除映射"""
+        with self._lock:
+            evicted, self._evicted = self._evicted, []
+        return evicted
+
+    def close(self):
+        with self._lock:
+            for shm_arr in self._free.values():
+                shm_arr.close()
+            self._free.clear()
+            self.free_bytes = 0
+
+
+class ShmAttachCache:
+    """
+    服务器端的临时共享内存映射缓存
+    客户端复用同名共享内存段时直接复用已有映射，省去重复的 attach 和 resource_tracker 注销；
+    按 LRU 淘汰，使缓存的映射总字节数不超过 max_bytes
+    """
+
+    def __init__(self, max_bytes: int = 1 << 30):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._cache: "OrderedDict[str, ShmArray]" = OrderedDict()
+
+    def attach(self, info: ShmArrayInfo, name: str) -> ShmArray:
+        shm_arr = self._cache.get(name)
+        if shm_arr is not None:
+            self._cache.move_to_end(name)
+            shm_arr.info = info
+            return shm_arr
+        shm_arr = ShmArray(info=info, name=name, create=False)
+        self._cache[name] = shm_arr
+        self.total_bytes += shm_arr.shm.size
+        while self.total_bytes > self.max_bytes and len(self._cache) > 1:
+            _, evicted = self._cache.popitem(last=False)
+            self.total_bytes -= evicted.shm.size
+            evicted.close()
+        return shm_arr
+
+    def discard(self, name: str):
+        shm_arr = self._cache.pop(name, None)
+        if shm_arr is not None:
+            self.total_bytes -= shm_arr.shm.size
+            shm_arr.close()
+
+    def close(self):
+        for shm_arr in self._cache.values():
+            shm_arr.close()
+        self._cache.clear()
+        self.total_bytes = 0
+
+
+class RingClosedError(ConnectionError):
+    """环形缓冲区的消费者已经放弃该流"""
+
+
+# 控制区中各计数的 uint64 下标：生产者和消费者写入的字段各占一个缓存行
+_RING_HEAD = 0
+_RING_TAIL = 8
+_RING_WAITING = 16  # 消费者即将阻塞等待唤醒
+_RING_CLOSED = 24  # 消费者已放弃该流
+_RING_CAPACITY = 31
+_RING_DATA_OFFSET = 256
+_RING_RECORD = struct.Struct("=II")  # 记录长度（含记录头，8 字节对齐）、记录类型
+# 二进制记录之后是 uint64 的数据长度
+_RING_ARRAY = struct.Struct("=16sI4x")  # dtype.str、ndim，之后是 ndim 个 uint64 的形状
+_RING_OBJECT = struct.Struct("=IIQ")  # 带外缓冲区数量、是否含数组、payload 长度，之后是各缓冲区长度
+RING_WRAP, RING_ARRAY, RING_BYTES, RING_OBJECT = 0, 1, 2, 3
+
+
+def _align8(n: int) -> int:
+    return (n + 7) & ~7
+
+
+class _RingView:
+    """ShmRing 返回的零拷贝视图的 base，存活期间推迟解除环形缓冲区的映射"""
+
+    def __init__(self, ring: "ShmRing", shape: Tuple[int, ...], typestr: str, address: int):
+        self.ring = ring
+        ring._view_started()
+        self.__array_interface__ = {
+            "shape": shape,
+            "typestr": typestr,
+            "data": (address, True),
+            "version": 3,
+        }
+
+    def __del__(self):
+        self.ring._view_finished()
+
+
+class ShmRing:
+    """
+    单生产者单消费者的共享内存环形缓冲区，用于高速传输流式数据
+    head/tail 是单调递增的字节计数，分别只由生产者/消费者写入，读写数据不需要任何系统调用；
+    记录按 8 字节对齐，NumPy 数组和二进制数据直接写入缓冲区，其他对象用编解码器序列化
+    """
+
+    def __init__(self, name: str, size: Union[int, None] = None, create: bool = False):
+        self.name = name
+        self.need_unlink = create
+        if create:
+            assert size is not None, "创建环形缓冲区时需要指定 size"
+            size = _align8(size)
+            self.shm = shared_memory.SharedMemory(
+                create=True, size=_RING_DATA_OFFSET + size, name=name
+            )
+        else:
+            self.shm = shared_memory.SharedMemory(name=name, create=False)
+            resource_tracker.unregister(self.shm._name, "shared_memory")  # type: ignore
+        self._ctrl = np.ndarray((_RING_DATA_OFFSET // 8,), dtype=np.uint64, buffer=self.shm.buf)
+        if create:
+            self._ctrl[:] = 0
+            self._ctrl[_RING_CAPACITY] = size
+        self.capacity = int(self._ctrl[_RING_CAPACITY])
+        self._data = self.shm.buf[_RING_DATA_OFFSET : _RING_DATA_OFFSET + self.capacity]
+        self._anchor = ctypes.c_char.from_buffer(self._data)
+        # 尚未被回收的零拷贝视图数量，大于 0 时推迟解除映射
+        self._views = 0
+        self._view_lock = threading.Lock()
+        self._closing = False
+        # 生产者：已写入的位置；消费者：已释放的位置和已读取（但视图可能仍在使用）的位置
+        self._head = int(self._ctrl[_RING_HEAD])
+        self._tail = int(self._ctrl[_RING_TAIL])
+        self._read = self._tail
+
+    # ---- 生产者 ----
+
+    def put(
+        self,
+        item: Any,
+        codec: "Codec",
+        cancelled: Callable[[], bool] = lambda: False,
+    ) -> bool:
+        """
+        写入一个流数据，缓冲区已满时等待消费者读取
+        返回 True 表示消费者正在等待，需要通过其他途径唤醒它
+        """
+        if (
+            isinstance(item, np.ndarray)
+            and item.dtype.fields is None
+            and not item.dtype.hasobject
+            and len(item.dtype.str) <= 16
+        ):
+            header = _align8(_RING_RECORD.size + _RING_ARRAY.size + 8 * item.ndim)
+            offset = self._reserve(header + item.nbytes, cancelled)
+            _RING_RECORD.pack_into(
+                self._data, offset, _align8(header + item.nbytes), RING_ARRAY
+            )
+            _RING_ARRAY.pack_into(
+                self._data, offset + _RING_RECORD.size, item.dtype.str.encode(), item.ndim
+            )
+            struct.pack_into(
+                f"={item.ndim}Q",
+                self._data,
+                offset + _RING_RECORD.size + _RING_ARRAY.size,
+                *item.shape,
+            )
+            target = np.ndarray(
+                item.shape, dtype=item.dtype, buffer=self._data, offset=offset + header
+            )
+            np.copyto(target, item)
+            return self._commit(_align8(header + item.nbytes))
+        if isinstance(item, (bytes, bytearray, memoryview)):
+            data = memoryview(item).cast("B")
+            n = _align8(_RING_RECORD.size + 8 + data.nbytes)
+            offset = self._reserve(n, cancelled)
+            _RING_RECORD.pack_into(self._data, offset, n, RING_BYTES)
+            struct.pack_into("=Q", self._data, offset + _RING_RECORD.size, data.nbytes)
+            start = offset + _RING_RECORD.size + 8
+            self._data[start : start + data.nbytes] = data
+            return self._commit(n)
+        # 对象中的数组作为记录的带外缓冲区直接拷贝，不经过编解码器
+        array_buffers: List[memoryview] = []
+        obj = pack_arrays(item, array_buffers)
+        has_arrays = obj is not item
+        if has_arrays:
+            obj = [obj, len(array_buffers)]
+        payload, buffers = codec.encode(obj)
+        views = [memoryview(b).cast("B") for b in buffers] + array_buffers
+        header = _RING_RECORD.size + _RING_OBJECT.size + 8 * len(views)
+        n = header + _align8(len(payload)) + sum(_align8(v.nbytes) for v in views)
+        offset = self._reserve(n, cancelled)
+        _RING_RECORD.pack_into(self._data, offset, n, RING_OBJECT)
+        _RING_OBJECT.pack_into(
+            self._data, offset + _RING_RECORD.size, len(views), has_arrays, len(payload)
+        )
+        struct.pack_into(
+            f"={len(views)}Q",
+            self._data,
+            offset + _RING_RECORD.size + _RING_OBJECT.size,
+            *(v.nbytes for v in views),
+        )
+        pos = offset + header
+        for part in [memoryview(payload)] + views:
+            self._data[pos : pos + part.nbytes] = part
+            pos += _align8(part.nbytes)
+        return self._commit(n)
+
+    def _reserve(self, n: int, cancelled: Callable[[], bool]) -> int:
+        """等待足够的空间，返回记录的写入位置；末尾放不下时先写入 WRAP 记录"""
+        if n > self.capacity // 2:
+            raise ValueError(
+                f"单个流数据（{n} 字节）超过环形缓冲区容量（{self.capacity} 字节）的一半"
+            )
+        offset = self._head % self.capacity
+        pad = self.capacity - offset if offset + n > self.capacity else 0
+        delay = 0.0
+        while self.capacity - (self._head - int(self._ctrl[_RING_TAIL])) < pad + n:
+            if self._ctrl[_RING_CLOSED] or cancelled():
+                raise RingClosedError("流已被客户端放弃")
+            # 缓冲区满说明消费者更慢，逐渐退避即可
+            time.sleep(delay)
+            delay = min(delay * 2 or 1e-5, 1e-3)
+        if pad:
+            _RING_RECORD.pack_into(self._data, offset, pad, RING_WRAP)
+            self._head += pad
+            offset = 0
+        return offset
+
+    def _commit(self, n: int) -> bool:
+        self._head += n
+        self._ctrl[_RING_HEAD] = self._head
+        if self._ctrl[_RING_WAITING]:
+            self._ctrl[_RING_WAITING] = 0
+            return True
+        return False
+
+    # ---- 消费者 ----
+
+    def get(self, codec: "Codec") -> Tuple[bool, Any]:
+        """
+        读取下一个流数据，返回 (是否读到, 数据)
+        NumPy 数组以只读视图、二进制数据以 memoryview 返回，它们在下一次调用 get 之前有效
+        """
+        # 上一个数据的视图从此失效，把它占用的空间还给生产者
+        if self._tail != self._read:
+            self._tail = self._read
+            self._ctrl[_RING_TAIL] = self._tail
+        while self._read != int(self._ctrl[_RING_HEAD]):
+            offset = self._read % self.capacity
+            n, kind = _RING_RECORD.unpack_from(self._data, offset)
+            self._read += n
+            if kind == RING_WRAP:
+                self._tail = self._read
+                self._ctrl[_RING_TAIL] = self._tail
+                continue
+            if kind == RING_ARRAY:
+                dtype_str, ndim = _RING_ARRAY.unpack_from(
+                    self._data, offset + _RING_RECORD.size
+                )
+                shape = struct.unpack_from(
+                    f"={ndim}Q", self._data, offset + _RING_RECORD.size + _RING_ARRAY.size
+                )
+                header = _align8(_RING_RECORD.size + _RING_ARRAY.size + 8 * ndim)
+                return True, np.asarray(
+                    _RingView(
+                        self,
+                        shape,
+                        dtype_str.rstrip(b"\0").decode(),
+                        ctypes.addressof(self._anchor) + offset + header,
+                    )
+                )
+            if kind == RING_BYTES:
+                (length,) = struct.unpack_from("=Q", self._data, offset + _RING_RECORD.size)
+                start = offset + _RING_RECORD.size + 8
+                view = _RingView(
+                    self, (length,), "|u1", ctypes.addressof(self._anchor) + start
+                )
+                return True, memoryview(np.asarray(view))
+            nbufs, has_arrays, payload_len = _RING_OBJECT.unpack_from(
+                self._data, offset + _RING_RECORD.size
+            )
+            lengths = struct.unpack_from(
+                f"={nbufs}Q", self._data, offset + _RING_RECORD.size + _RING_OBJECT.size
+            )
+            pos = offset + _RING_RECORD.size + _RING_OBJECT.size + 8 * nbufs
+            payload = bytes(self._data[pos : pos + payload_len])
+            pos += _align8(payload_len)
+            buffers = []
+            for length in lengths:
+                # 对象可能比这条记录存活得更久，复制出来
+                buffers.append(bytearray(self._data[pos : pos + length]))
+                pos += _align8(length)
+            obj = codec.decode(payload, buffers)
+            if has_arrays:
+                obj, n_arrays = obj
+                obj = unpack_arrays(obj, buffers[len(buffers) - n_arrays :])
+            return True, obj
+        return False, None
+
+    def has_data(self) -> bool:
+        return self._read != int(self._ctrl[_RING_HEAD])
+
+    def begin_wait(self) -> bool:
+        """
+        消费者准备阻塞等待前调用，通知生产者下一次写入后唤醒它
+        返回 True 表示登记期间已经有新数据，无需等待
+        """
+        self._ctrl[_RING_WAITING] = 1
+        if self.has_data():
+            self._ctrl[_RING_WAITING] = 0
+            return True
+        return False
+
+    def abandon(self):
+        """消费者不再读取，正在等待空间的生产者会收到 RingClosedError"""
+        self._ctrl[_RING_CLOSED] = 1
+
+    def _view_started(self):
+        with self._view_lock:
+            self._views += 1
+
+    def _view_finished(self):
+        with self._view_lock:
+            self._views -= 1
+            unmap = self._closing and self._views == 0
+        if unmap:
+            self._unmap()
+
+    def close(self):
+        if self.need_unlink:
+            self.shm.unlink()
+            self.need_unlink = False
+        with self._view_lock:
+            if self._closing:
+                return
+            self._closing = True
+            if self._views > 0:
+                # 仍有零拷贝视图，推迟到最后一个视图被回收时再解除映射
+                return
+        self._unmap()
+
+    def _unmap(self):
+        self._anchor = None
+        del self._ctrl
+        self._data.release()
+        self.shm.close()
+
+
+def apply_shm_update(
+    shm_arrs: Dict[str, ShmArray],
+    update: Dict[str, Any],
+    fds: Sequence[int] = (),
+    remote: bool = False,
+) -> str:
+    """
+    服务器端处理 SHM_UPDATE 消息，修改连接的 shm_arrs，返回被修改的数组名
+    op: "register" 映射新的数组；"resize" 改变形状，name 变化时重新映射；"unregister" 解除映射；
+        "sync" 远程连接的客户端推送的数组内容，写入共享内存段的 offset 处
+    fds: 随消息传来的文件描述符，update 中的 "fd" 为 memfd 在其中的下标
+    remote: 客户端在另一台机器上，服务器用 update 中的 "size" 创建自己的 memfd 保存数组的副本
+    """
+    op, name = update["op"], update["name"]
+    if op == "unregister":
+        shm_arrs.pop(name).close()
+        return name
+    if op == "sync":
+        data = update["data"]
+        np.frombuffer(
+            shm_arrs[name].shm.buf, np.uint8, count=data.nbytes, offset=update.get("offset", 0)
+        )[:] = data
+        return name
+    info = ShmArrayInfo.from_json(update["info"])
+    fd = fds[update["fd"]] if "fd" in update else None
+    size = update.get("size") if remote else None
+    if op == "register":
+        assert name not in shm_arrs, f"共享数组 {name} 已存在"
+        shm_arrs[name] = open_shm_array(
+            info, update["shm_name"], create=remote, size=size, memfd=remote, fd=fd
+        )
+    elif op == "resize":
+        shm_arr = shm_arrs[name]
+        if update["shm_name"] == shm_arr.name:
+            shm_arr.resize(info)
+        else:
+            shm_arr.remap(info, update["shm_name"], create=remote, size=size, fd=fd)
+    else:
+        raise ValueError(f"未知的共享数组操作: {op}")
+    return name
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    """解析 TCP 地址 host:port，IPv6 地址写作 [::1]:port"""
+    host, sep, port = address.rpartition(":")
+    assert sep and port.isdigit(), f"TCP 地址应为 host:port，但收到 {address}"
+    return host.strip("[]"), int(port)
+
+
+def tcp_listen(address: str, backlog: int) -> socket.socket:
+    """在 address 上监听 TCP 连接"""
+    host, port = parse_address(address)
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    return socket.create_server((host, port), family=family, backlog=backlog)
+
+
+def tcp_connect(address: str, timeout: float) -> socket.socket:
+    """连接 address 上已经在运行的服务器"""
+    sock = socket.create_connection(parse_address(address), timeout=timeout)
+    sock.settimeout(None)
+    set_nodelay(sock)
+    return sock
+
+
+def set_nodelay(sock: socket.socket):
+    """TCP 连接关闭 Nagle 算法，小消息立即发出；Unix socket 什么也不做"""
+    if sock.family in (socket.AF_INET, socket.AF_INET6):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+def pack_arrays(
+    obj: Any, buffers: List[memoryview], transport: Union["ArrayTransport", None] = None
+) -> Any:
+    """
+    把 obj（dict/list/tuple 的任意嵌套）中的 NumPy 数组替换为 {ARRAY_KEY: 描述} 标记，
+    数组数据追加到 buffers，或者（transport 不为 None 且数组较大时）放入共享内存；
+    没有数组时原样返回 obj 本身，不做任何拷贝
+    """
+    if isinstance(obj, np.ndarray):
+        if transport is not None and transport.arena is not None:
+            spec = transport.arena.claim(obj)
+            if spec is not None:
+                # 在 arena 中分配的输出数组，以句柄交给客户端，不拷贝
+                return {ARRAY_KEY: spec}
+        if obj.dtype.hasobject or obj.dtype.fields is not None:
+            # 对象数组和结构化数组交给编解码器处理
+            return obj
+        if (
+            transport is not None
+            and transport.threshold is not None
+            and obj.nbytes > transport.threshold
+            and obj.dtype == np.dtype(obj.dtype.type)
+        ):
+            return {ARRAY_KEY: transport.lend(obj)}
+        data = np.ascontiguousarray(obj).reshape(-1).view(np.uint8)
+        buffers.append(data.data)
+        return {ARRAY_KEY: {"dtype": obj.dtype.str, "shape": list(obj.shape), "buf": len(buffers) - 1}}
+    if isinstance(obj, dict):
+        packed = None
+        for key, value in obj.items():
+            new = pack_arrays(value, buffers, transport)
+            if new is not value:
+                if packed is None:
+                    packed = dict(obj)
+                packed[key] = new
+        return obj if packed is None else packed
+    if isinstance(obj, (list, tuple)):
+        packed_list = None
+        for i, value in enumerate(obj):
+            new = pack_arrays(value, buffers, transport)
+            if new is not value:
+                if packed_list is None:
+                    packed_list = list(obj)
+                packed_list[i] = new
+        return obj if packed_list is None else packed_list
+    return obj
+
+
+def unpack_arrays(
+    obj: Any, buffers: List[bytearray], transport: Union["ArrayTransport", None] = None
+) -> Any:
+    """
+    pack_arrays 的逆操作，原地替换解码得到的对象中的标记；数组直接构造在接收缓冲区或共享内存上，
+    嵌入版发送的 bytes（描述中标记 "bytes"）还原为 bytes
+    """
+    if isinstance(obj, dict):
+        spec = obj.get(ARRAY_KEY) if len(obj) == 1 else None
+        if spec is not None:
+            if spec.get("bytes"):
+                if "shm" in spec:
+                    assert transport is not None, "未启用共享内存数组传输"
+                    return transport.borrow(spec).tobytes()
+                return bytes(buffers[spec["buf"]])
+            if "shm" in spec:
+                assert transport is not None, "未启用共享内存数组传输"
+                return transport.borrow(spec)
+            if "arena" in spec:
+                assert transport is not None, "未启用共享内存数组传输"
+                return ShmHandle(transport, spec)
+            return np.frombuffer(buffers[spec["buf"]], dtype=spec["dtype"]).reshape(
+                spec["shape"]
+            )
+        for key, value in obj.items():
+            obj[key] = unpack_arrays(value, buffers, transport)
+        return obj
+    if isinstance(obj, list):
+        for i, value in enumerate(obj):
+            obj[i] = unpack_arrays(value, buffers, transport)
+        return obj
+    if isinstance(obj, tuple):
+        return tuple(unpack_arrays(value, buffers, transport) for value in obj)
+    return obj
+
+
+class _ShmBlockView:
+    """指向共享内存段中一段数据的数组的 base，存活期间推迟关闭该段"""
+
+    def __init__(
+        self,
+        shm_arr: ShmArray,
+        offset: int,
+        shape: Tuple[int, ...],
+        typestr: str,
+        readonly: bool,
+        on_collected: Union[Callable[[], None], None] = None,
+    ):
+        self.shm_arr = shm_arr
+        self._anchor = ctypes.c_char.from_buffer(shm_arr.shm.buf)
+        shm_arr._lease_started()
+        self._on_collected = on_collected
+        self.__array_interface__ = {
+            "shape": shape,
+            "typestr": typestr,
+            "data": (ctypes.addressof(self._anchor) + offset, readonly),
+            "version": 3,
+        }
+
+    def __del__(self):
+        if self._on_collected is not None:
+            self._on_collected()
+        self._anchor = None
+        self.shm_arr._lease_finished()
+
+
+_SLOT_HEADER = 64
+
+
+class ShmSlotArray(ShmArray):
+    """
+    多槽（双缓冲/三缓冲）共享数组，每个槽都能容纳一份 info 形状的数组
+    客户端用 acquire 取得空闲的槽写入下一份输入，同时服务器读取之前的请求引用的槽，传输和计算可以重叠
+    每个槽头带有序列号（seqlock）：写入期间为奇数，读取前后序列号相同且为偶数才说明读到了完整的数据
+    """
+
+    def __init__(
+        self,
+        info: ShmArrayInfo,
+        name: str,
+        create: bool = False,
+        size: Union[int, None] = None,
+        memfd: bool = False,
+        fd: Union[int, None] = None,
+    ):
+        super().__init__(info, name, create, size, memfd, fd)
+        if create:
+            self._init_headers()
+        # 客户端空闲的槽；服务器端不使用
+        self._free: Deque[int] = deque(range(info.slots))
+        self._free_cond = threading.Condition()
+
+    def _init_headers(self):
+        # 槽头：序列号 + 槽的间距，对端从槽头读取间距，不依赖共享内存段的大小
+        stride = self.shm.size // self.info.slots // _SLOT_HEADER * _SLOT_HEADER
+        for index in range(self.info.slots):
+            struct.pack_into("<QQ", self.shm.buf, index * stride, 0, stride)
+
+    @property
+    def _stride(self) -> int:
+        return struct.unpack_from("<Q", self.shm.buf, 8)[0]
+
+    @property
+    def capacity(self) -> int:
+        """每个槽的字节数，不超过它的 resize 无需重新映射"""
+        return self._stride - _SLOT_HEADER
+
+    def resize(self, info: ShmArrayInfo):
+        assert info.slots == self.info.slots, "不能改变槽的数量"
+        super().resize(info)
+
+    def remap(
+        self,
+        info: ShmArrayInfo,
+        name: str,
+        create: bool = False,
+        size: Union[int, None] = None,
+        fd: Union[int, None] = None,
+    ):
+        assert info.slots == self.info.slots, "不能改变槽的数量"
+        super().remap(info, name, create, size, fd)
+        if create:
+            self._init_headers()
+
+    def _unsupported(self, *args, **kwargs):
+        raise TypeError("多槽共享数组需要指定槽，见 acquire、read_slot 和 view_slot")
+
+    write = read = lease = view = _unsupported  # type: ignore
+
+    def _dirty_bytes(self) -> int:
+        # 槽的位置取决于段的大小，整体包括所有槽头
+        return self.shm.size
+
+    def acquire(self, timeout: Union[float, None] = None) -> "ShmSlot":
+        """客户端取得一个空闲的槽，所有槽都被尚未完成的请求占用时等待"""
+        with self._free_cond:
+            if not self._free_cond.wait_for(lambda: self._free, timeout):
+                raise TimeoutError("等待空闲的槽超时")
+            return ShmSlot(self, self._free.popleft())
+
+    def _give_back(self, index: int):
+        with self._free_cond:
+            self._free.append(index)
+            self._free_cond.notify()
+
+    def _offset(self, index: int) -> int:
+        assert 0 <= index < self.info.slots, f"槽 {index} 不存在"
+        return index * self._stride + _SLOT_HEADER
+
+    def slot_seq(self, index: int) -> int:
+        """槽的序列号，每写入一次加 2，奇数表示正在写入"""
+        return struct.unpack_from("<Q", self.shm.buf, index * self._stride)[0]
+
+    def _set_seq(self, index: int, seq: int):
+        struct.pack_into("<Q", self.shm.buf, index * self._stride, seq)
+
+    def read_slot(self, index: int) -> np.ndarray:
+        """拷贝出槽中的数组；槽正在被写入或读取期间被改写时抛出 RuntimeError"""
+        seq = self.slot_seq(index)
+        if seq & 1:
+            raise RuntimeError(f"槽 {index} 正在被写入")
+        data = np.ndarray(
+            self.info.shape, self.info.dtype, buffer=self.shm.buf, offset=self._offset(index)
+        ).copy()
+        if self.slot_seq(index) != seq:
+            raise RuntimeError(f"读取期间槽 {index} 被改写")
+        return data
+
+    def view_slot(self, index: int, readonly: bool = True) -> np.ndarray:
+        """
+        返回指向槽的零拷贝数组，存活期间共享内存不会被释放
+        只在引用该槽的请求处理期间有效，收到响应后客户端会复用该槽
+        """
+        if readonly and self.slot_seq(index) & 1:
+            raise RuntimeError(f"槽 {index} 正在被写入")
+        return np.asarray(
+            _ShmBlockView(
+                self,
+                self._offset(index),
+                tuple(self.info.shape),
+                np.dtype(self.info.dtype).str,
+                readonly,
+            )
+        )
+
+
+class ShmSlot:
+    """
+    客户端独占的 ShmSlotArray 中的一个槽
+    作为 submit/send_request 的 slots 参数随请求发出后，收到响应时自动归还；未发出时需要调用 release
+    """
+
+    def __init__(self, slot_arr: ShmSlotArray, index: int):
+        self.slot_arr = slot_arr
+        self.index = index
+        self.released = False
+
+    @property
+    def seq(self) -> int:
+        return self.slot_arr.slot_seq(self.index)
+
+    @contextlib.contextmanager
+    def fill(self) -> Iterator[np.ndarray]:
+        """以可写数组的形式直接填充槽，退出 with 语句后数据才对服务器可见"""
+        assert not self.released, "槽已归还"
+        seq = self.seq
+        self.slot_arr._set_seq(self.index, seq + 1)
+        try:
+            yield self.slot_arr.view_slot(self.index, readonly=False)
+        finally:
+            self.slot_arr._set_seq(self.index, seq + 2)
+            # 槽头（序列号）和槽的内容
+            stride = self.slot_arr._stride
+            self.slot_arr.mark_dirty(self.index * stride, stride)
+
+    def write(self, data: np.ndarray):
+        info = self.slot_arr.info
+        assert data.shape == tuple(info.shape), f"Expected shape {info.shape}, but got {data.shape}"
+        assert data.dtype == info.dtype, f"Expected dtype {info.dtype}, but got {data.dtype}"
+        with self.fill() as arr:
+            np.copyto(arr, data)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.slot_arr._give_back(self.index)
+
+
+def open_shm_array(
+    info: ShmArrayInfo,
+    name: str,
+    create: bool = False,
+    size: Union[int, None] = None,
+    memfd: bool = False,
+    fd: Union[int, None] = None,
+) -> ShmArray:
+    """创建或映射持久共享数组，info.slots 大于 1 时为 ShmSlotArray"""
+    cls = ShmSlotArray if info.slots > 1 else ShmArray
+    return cls(info=info, name=name, create=create, size=size, memfd=memfd, fd=fd)
+
+
+_ARENA_ALIGN = 64
+
+
+class ShmArena:
+    """
+    服务器端的输出数组 arena，由若干大共享内存段组成，段内按首次适配分配
+    分配的数组随响应以句柄交给客户端；服务器端的数组已被回收、且客户端已释放句柄（或从未发出）后，
+    这块空间才会被重新分配
+    """
+
+    def __init__(self, id: str, chunk_bytes: int = 64 << 20):
+        self.id = id
+        self.chunk_bytes = chunk_bytes
+        self._chunks: Dict[str, ShmArray] = {}
+        # 段名 -> 按偏移排序的空闲区间 [offset, size]
+        self._free: Dict[str, List[List[int]]] = {}
+        # (段名, 偏移) -> [大小, 服务器端数组是否存活, 是否由客户端持有, 数据地址]
+        self._blocks: Dict[Tuple[str, int], List[Any]] = {}
+        # 尚未发出的块的数据地址 -> (段名, 偏移)
+        self._addresses: Dict[int, Tuple[str, int]] = {}
+        # 数组被回收时可能在持有锁的同一线程中回调 _collected
+        self._lock = threading.RLock()
+
+    def allocate(self, shape: Sequence[int], dtype: Any) -> np.ndarray:
+        dtype = np.dtype(dtype)
+        shape = tuple(int(n) for n in shape)
+        nbytes = int(np.prod(shape, dtype=np.int64)) * dtype.itemsize
+        size = max(_ARENA_ALIGN, (nbytes + _ARENA_ALIGN - 1) & ~(_ARENA_ALIGN - 1))
+        with self._lock:
+            name, offset = self._find(size)
+            self._blocks[(name, offset)] = [size, True, False, None]
+            chunk = self._chunks[name]
+        arr = np.asarray(
+            _ShmBlockView(
+                chunk,
+                offset,
+                shape,
+                dtype.str,
+                readonly=False,
+                on_collected=lambda: self._collected(name, offset),
+            )
+        )
+        address = arr.__array_interface__["data"][0]
+        with self._lock:
+            self._blocks[(name, offset)][3] = address
+            self._addresses[address] = (name, offset)
+        return arr
+
+    def _find(self, size: int) -> Tuple[str, int]:
+        for name, free in self._free.items():
+            for i, (offset, free_size) in enumerate(free):
+                if free_size >= size:
+                    if free_size == size:
+                        del free[i]
+                    else:
+                        free[i] = [offset + size, free_size - size]
+                    return name, offset
+        chunk_size = max(self.chunk_bytes, _size_class(size))
+        name = generate_shm_name(self.id, "arena_" + uuid.uuid4().hex)
+        self._chunks[name] = ShmArray(
+            ShmArrayInfo((chunk_size,), np.uint8), name=name, create=True
+        )
+        self._free[name] = [[size, chunk_size - size]] if chunk_size > size else []
+        return name, 0
+
+    def _free_block(self, name: str, offset: int, size: int):
+        free = self._free[name]
+        i = bisect.bisect(free, [offset, size])
+        free.insert(i, [offset, size])
+        # 与后一个、前一个空闲区间合并
+        if i + 1 < len(free) and offset + size == free[i + 1][0]:
+            free[i][1] += free.pop(i + 1)[1]
+        if i > 0 and free[i - 1][0] + free[i - 1][1] == offset:
+            free[i - 1][1] += free.pop(i)[1]
+
+    def claim(self, arr: np.ndarray) -> Union[Dict[str, Any], None]:
+        """
+        arr 由 allocate 分配（或是其开头的连续切片）且尚未发出时，把它交给客户端持有，返回句柄描述；
+        否则返回 None
+        """
+        address = arr.__array_interface__["data"][0]
+        with self._lock:
+            key = self._addresses.get(address)
+            if key is None or not arr.flags.c_contiguous or arr.nbytes > self._blocks[key][0]:
+                return None
+            del self._addresses[address]
+            self._blocks[key][2] = True
+        return {
+            "dtype": arr.dtype.str,
+            "shape": list(arr.shape),
+            "arena": key[0],
+            "offset": key[1],
+        }
+
+    def _collected(self, name: str, offset: int):
+        with self._lock:
+            block = self._blocks[(name, offset)]
+            block[1] = False
+            self._addresses.pop(block[3], None)
+            if not block[2]:
+                del self._blocks[(name, offset)]
+                self._free_block(name, offset, block[0])
+
+    def release(self, name: str, offset: int):
+        """客户端释放了句柄"""
+        with self._lock:
+            block = self._blocks.get((name, offset))
+            if block is None:
+                return
+            block[2] = False
+            if not block[1]:
+                del self._blocks[(name, offset)]
+                self._free_block(name, offset, block[0])
+
+    def close(self):
+        with self._lock:
+            chunks, self._chunks = list(self._chunks.values()), {}
+        for chunk in chunks:
+            chunk.close()
+
+
+class ShmHandle:
+    """
+    服务器在 arena 中分配的输出数组的句柄，第一次访问 array 时才映射对应的共享内存段
+    使用完后调用 release（或用 with 语句）归还，通知随下一条消息发给服务器，release 之后不应再访问 array
+    """
+
+    def __init__(self, transport: "ArrayTransport", spec: Dict[str, Any]):
+        self.shape: Tuple[int, ...] = tuple(spec["shape"])
+        self.dtype = np.dtype(spec["dtype"])
+        self.released = False
+        self._transport = transport
+        self._spec = spec
+        self._array: Union[np.ndarray, None] = None
+
+    @property
+    def nbytes(self) -> int:
+        return int(np.prod(self.shape, dtype=np.int64)) * self.dtype.itemsize
+
+    @property
+    def array(self) -> np.ndarray:
+        """直接指向服务器 arena 的可写数组，不做任何拷贝"""
+        if self.released:
+            raise RuntimeError("句柄已释放")
+        if self._array is None:
+            self._array = self._transport.map_block(self._spec)
+        return self._array
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        return np.asarray(self.array, dtype=dtype)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self._array = None
+            self._transport.free_block(self._spec)
+
+    def __enter__(self) -> np.ndarray:
+        return self.array
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def __del__(self):
+        # 忘记 release 时的兜底
+        if hasattr(self, "_transport"):
+            self.release()
+
+    def __repr__(self) -> str:
+        return f"ShmHandle(shape={self.shape}, dtype={self.dtype}, released={self.released})"
+
+
+class ArrayTransport:
+    """
+    连接一端的数组自动传输状态
+    大数组写入本端共享内存池中的段借给对端，对端以只读零拷贝视图使用；
+    视图全部被回收后，对端在下一条消息的 meta 中归还段名，本端再把段放回池中复用
+    """
+
+    def __init__(
+        self,
+        pool: ShmArrayPool,  # 本端发送大数组使用的共享内存池
+        cache: ShmAttachCache,  # 对端共享内存段的映射缓存
+        threshold: Union[int, None] = SHM_ARRAY_THRESHOLD,  # None 表示不使用共享内存（远程连接）
+        arena: Union[ShmArena, None] = None,  # 服务器端：handle_request 中分配输出数组的 arena
+    ):
+        self.pool = pool
+        self.cache = cache
+        self.threshold = threshold
+        self.arena = arena
+        # 客户端：对端 arena 段的映射，按需创建
+        self._arena_maps: Dict[str, ShmArray] = {}
+        # 客户端：已释放、等待随下一条消息通知服务器的句柄 [段名, 偏移]
+        self._freed: List[List[Any]] = []
+        # 借给对端、尚未归还的段
+        self._lent: Dict[str, ShmArray] = {}
+        # 对端的段上的视图已全部回收，等待随下一条消息归还的段名
+        self._released: List[str] = []
+        # 视图被回收时可能在持有锁的同一线程中回调 _give_back
+        self._lock = threading.RLock()
+
+    def lend(self, arr: np.ndarray) -> Dict[str, Any]:
+        shm_arr = self.pool.acquire(ShmArrayInfo(tuple(arr.shape), arr.dtype.type))
+        shm_arr.write(arr)
+        with self._lock:
+            self._lent[shm_arr.name] = shm_arr
+        return {"dtype": arr.dtype.str, "shape": list(arr.shape), "shm": shm_arr.name}
+
+    def borrow(self, spec: Dict[str, Any]) -> np.ndarray:
+        name = spec["shm"]
+        shm_arr = self.cache.attach(
+            ShmArrayInfo(tuple(spec["shape"]), np.dtype(spec["dtype"]).type), name
+        )
+        view = shm_arr.view()
+        shm_arr._on_unleased(lambda: self._give_back(name))
+        return view
+
+    def map_block(self, spec: Dict[str, Any]) -> np.ndarray:
+        name = spec["arena"]
+        with self._lock:
+            chunk = self._arena_maps.get(name)
+            if chunk is None:
+                chunk = ShmArray(ShmArrayInfo((0,), np.uint8), name=name, create=False)
+                self._arena_maps[name] = chunk
+        return np.asarray(
+            _ShmBlockView(
+                chunk,
+                spec["offset"],
+                tuple(spec["shape"]),
+                np.dtype(spec["dtype"]).str,
+                readonly=False,
+            )
+        )
 
+    def free_block(self, spec: Dict[str, Any]):
+        with self._lock:
+            self._freed.append([spec["arena"], spec["offset"]])
 
-def generate_socket_path(id: str) -> str:
-    return f"/tmp/ipc_socket_{id}"
+    def _give_back(self, name: str):
+        # 可能在任意线程的垃圾回收中调用，只记录，不发送消息
+        with self._lock:
+            self._released.append(name)
 
+    def outgoing(self) -> Union[Dict[str, List[str]], None]:
+        """随下一条消息发给对端的归还和淘汰通知"""
+        with self._lock:
+            released, self._released = self._released, []
+            freed, self._freed = self._freed, []
+        evicted = self.pool.pop_evicted()
+        if not released and not evicted and not freed:
+            return None
+        return {"released": released, "evicted": evicted, "freed": freed}
 
-def generate_shm_name(id: str, name: str) -> str:
-    return f"ipc_shm_{id}_{name}"
+    def incoming(self, notice: Dict[str, List[str]]):
+        """处理对端的归还和淘汰通知"""
+        for name in notice.get("released", []):
+            with self._lock:
+                shm_arr = self._lent.pop(name, None)
+            if shm_arr is not None:
+                self.pool.release(shm_arr)
+        for name in notice.get("evicted", []):
+            self.cache.discard(name)
+        if self.arena is not None:
+            for name, offset in notice.get("freed", []):
+                self.arena.release(name, offset)
 
+    def close(self):
+        with self._lock:
+            lent, self._lent = list(self._lent.values()), {}
+            maps, self._arena_maps = list(self._arena_maps.values()), {}
+        for shm_arr in lent + maps:
+            shm_arr.close()
+
+
+def encode_message(
+    msg: IPCMessage, codec: Union[Codec, None], arrays: Union[ArrayTransport, None] = None
+) -> List[Any]:
+    """
+    把消息编码为一个帧，返回需要依次发送的缓冲区列表
+    codec 为 None 时使用旧的 JSON 字符串帧，用于还未协商编解码器的 INIT 消息或旧版本的对端
+    arrays 不为 None 时自动传输 data 中的 NumPy 数组
+    """
+    if codec is None:
+        return [encode_str(msg.to_json())]
+    flags = 0
+    obj = msg.data
+    meta = msg.meta
+    array_buffers: List[memoryview] = []
+    has_arrays = False
+    if arrays is not None:
+        obj = pack_arrays(obj, array_buffers, arrays)
+        has_arrays = obj is not msg.data
+        notice = arrays.outgoing()
+        if notice is not None:
+            meta = {**(meta or {}), "arrays": notice}
+    if meta is not None:
+        flags |= FLAG_META
+        obj = [obj, meta]
+    if has_arrays:
+        flags |= FLAG_ARRAYS
+        obj = [obj, len(array_buffers)]
+    payload, buffers = codec.encode(obj)
+    buffers = buffers + array_buffers
+    header = FRAME_HEADER.pack(
+        MESSAGE_TYPE_CODES[msg.type], flags, len(buffers), msg.id, len(payload)
+    )
+    if buffers:
+        header += struct.pack(f"!{len(buffers)}Q", *(buffer.nbytes for buffer in buffers))
+    return [header, payload, *buffers]
+
+
+def decode_message(
+    header: Tuple[int, ...],
+    payload: memoryview,
+    buffers: List[bytearray],
+    codec: Codec,
+    arrays: Union[ArrayTransport, None] = None,
+) -> IPCMessage:
+    """header 为 FRAME_HEADER 解包后的字段"""
+    type_code, flags, _, req_id, _ = header
+    obj = codec.decode(payload, buffers)
+    array_buffers: List[bytearray] = []
+    if flags & FLAG_ARRAYS:
+        obj, n = obj
+        array_buffers = buffers[len(buffers) - n :]
+    meta = None
+    if flags & FLAG_META:
+        obj, meta = obj
+        if arrays is not None and "arrays" in meta:
+            arrays.incoming(meta.pop("arrays"))
+    if flags & FLAG_ARRAYS:
+        obj = unpack_arrays(obj, array_buffers, arrays)
+    return IPCMessage(type=MESSAGE_TYPES[type_code], id=req_id, data=obj, meta=meta)
+
+
+async def async_recv_message(
+    reader: asyncio.StreamReader,
+    codec: Union[Codec, None] = None,
+    arrays: Union[ArrayTransport, None] = None,
+) -> IPCMessage:
+    """asyncio 版本的 IPCChannel.recv，连接关闭时抛出 ConnectionError"""
+    try:
+        if codec is None:
+            bufsize_bytes = await reader.readexactly(4)
+            bufsize = int.from_bytes(bufsize_bytes, byteorder="big")
+            data = (await reader.readexactly(bufsize)).decode("utf-8")
+            return IPCMessage.from_json(data)
+        header = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+        _, _, nbufs, _, length = header
+        lengths = await reader.readexactly(8 * nbufs)
+        payload = await reader.readexactly(length)
+        buffers = [
+            bytearray(await reader.readexactly(n))
+            for n in struct.unpack(f"!{nbufs}Q", lengths)
+        ]
+    except asyncio.IncompleteReadError as e:
+        raise ConnectionError("连接已关闭") from e
+    return decode_message(header, memoryview(payload), buffers, codec, arrays)
 
-def recv_exactly(sock: socket.socket, n: int) -> bytes:
-    """接收确切的 n 个字节"""
-    data = b""
-    while len(data) < n:
-        chunk = sock.recv(n - len(data))
-        if not chunk:
-            raise ConnectionError("连接已关闭，数据不完整")
-        data += chunk
-    return data
 
+def async_send_message(
+    writer: asyncio.StreamWriter,
+    msg: IPCMessage,
+    codec: Union[Codec, None] = None,
+    arrays: Union[ArrayTransport, None] = None,
+):
+    """asyncio 版本的消息发送，只写入缓冲区，需要时由调用方 drain"""
+    writer.writelines(encode_message(msg, codec, arrays))
 
-def recv_str(sock: socket.socket) -> str:
-    # 先接受一个数字作为 bufsize
-    bufsize_bytes = sock.recv(4)
-    bufsize = int.from_bytes(bufsize_bytes, byteorder="big")
-    data = recv_exactly(sock, bufsize).decode("utf-8")
-    return data
 
+class IPCChannel:
+    """
+    在 socket 上收发 IPCMessage，send 可以被多个线程并发调用
+    codec 在 INIT 握手协商完成后设置，在此之前使用 JSON 字符串帧；
+    双方都支持时同时设置 arrays，自动传输消息中的 NumPy 数组
+    """
 
-def send_str(sock: socket.socket, data: str):
-    data_bytes = data.encode("utf-8")
-    bufsize = len(data_bytes)
-    bufsize_bytes = bufsize.to_bytes(4, byteorder="big")
-    sock.sendall(bufsize_bytes)
-    sock.sendall(data_bytes)
+    def __init__(self, sock: socket.socket, codec: Union[Codec, None] = None):
+        self.sock = sock
+        self.codec = codec
+        self.arrays: Union[ArrayTransport, None] = None
+        # 设置后记录编解码和发送的耗时，以及收发的消息数和字节数
+        self.metrics: Union[Metrics, None] = None
+        self._frame_bytes = 0
+        self.reader = SocketReader(sock)
+        self._send_lock = threading.Lock()
+
+    def send(self, msg: IPCMessage, fds: Sequence[int] = ()):
+        """fds: 随消息发送的文件描述符，对端收到该消息后用 take_fds 取走"""
+        metrics = self.metrics
+        if metrics is None:
+            parts = encode_message(msg, self.codec, self.arrays)
+            with self._send_lock:
+                sendmsg_all(self.sock, parts, fds)
+            return
+        start = time.perf_counter_ns()
+        parts = encode_message(msg, self.codec, self.arrays)
+        encoded = time.perf_counter_ns()
+        with self._send_lock:
+            sendmsg_all(self.sock, parts, fds)
+        metrics.observe("serialize", start, encoded, msg.id)
+        metrics.observe("send", encoded, id=msg.id)
+        metrics.add("messages_sent")
+        metrics.add("bytes_sent", sum(memoryview(part).nbytes for part in parts))
+
+    def take_fds(self, n: int) -> List[int]:
+        """取走随已接收的消息传来的 n 个文件描述符，之后由调用方负责关闭"""
+        fds = self.reader.fds
+        assert len(fds) >= n, f"期望 {n} 个文件描述符，但只收到 {len(fds)} 个"
+        return [fds.popleft() for _ in range(n)]
+
+    def recv(self) -> IPCMessage:
+        """接收一个帧，连接关闭时抛出 ConnectionError"""
+        if self.metrics is None or self.codec is None:
+            return self._recv()
+        # 只统计帧到达之后的接收和解码，不包括等待对端发送的时间
+        self.reader.peek(FRAME_HEADER.size, eof_ok=True)
+        start = time.perf_counter_ns()
+        msg = self._recv()
+        self.metrics.observe("deserialize", start, id=msg.id)
+        self.metrics.add("messages_received")
+        self.metrics.add("bytes_received", self._frame_bytes)
+        return msg
+
+    def _recv(self) -> IPCMessage:
+        if self.codec is None:
+            bufsize_bytes = self.reader.peek(4, eof_ok=True)
+            if bufsize_bytes is None:
+                raise ConnectionError("连接已关闭")
+            bufsize = int.from_bytes(bufsize_bytes, byteorder="big")
+            self.reader.skip(4)
+            return IPCMessage.from_json(str(self.reader.read(bufsize), "utf-8"))
+        header_bytes = self.reader.peek(FRAME_HEADER.size, eof_ok=True)
+        if header_bytes is None:
+            raise ConnectionError("连接已关闭")
+        header = FRAME_HEADER.unpack(header_bytes)
+        _, _, nbufs, _, length = header
+        self.reader.skip(FRAME_HEADER.size)
+        self._frame_bytes = FRAME_HEADER.size + 8 * nbufs + length
+        if not nbufs:
+            # 常见情况：payload 直接在复用缓冲区中解码
+            return decode_message(
+                header, self.reader.read(length), [], self.codec, self.arrays
+            )
+        lengths = struct.unpack(f"!{nbufs}Q", self.reader.read(8 * nbufs))
+        self._frame_bytes += sum(lengths)
+        # 接收带外缓冲区会覆盖复用缓冲区，先把 payload 拷贝出来
+        payload = bytes(self.reader.read(length))
+        # 带外缓冲区（如大数组）直接接收到独立分配的内存中，交给解码结果持有
+        buffers = []
+        for n in lengths:
+            buffer = bytearray(n)
+            self.reader.read_into(memoryview(buffer))
+            buffers.append(buffer)
+        return decode_message(header, memoryview(payload), buffers, self.codec, self.arrays)
+
+    def close(self):
+        self.sock.close()
+        for fd in self.reader.fds:
+            os.close(fd)
+        self.reader.fds.clear()
+        if self.arrays is not None:
+            self.arrays.close()
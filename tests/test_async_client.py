@@ -0,0 +1,46 @@
+"""AsyncIPCClient 的接收任务因意外错误退出时，所有等待中的请求都以该错误失败，而不是一直等待"""
+
+import asyncio
+import uuid
+
+import pytest
+
+from my_ipc import ipc_client_async
+from my_ipc.ipc_client_async import AsyncIPCClient
+from my_ipc.ipc_protocol import IPCMessageType
+from test_server_errors import FaultyServer, start_local
+
+
+def test_read_error_fails_pending(monkeypatch):
+    recv = ipc_client_async.async_recv_message
+
+    async def broken_recv(*args):
+        msg = await recv(*args)
+        if msg.type == IPCMessageType.RESPONSE and msg.data == {"ok": 0}:
+            raise ValueError("无法解码")
+        return msg
+
+    monkeypatch.setattr(ipc_client_async, "async_recv_message", broken_recv)
+    server = FaultyServer(uuid.uuid4().hex)
+    thread = start_local(server, max_clients=None, exit_when_idle=False)
+
+    async def main():
+        async with AsyncIPCClient(None, server_id=server.id) as client:
+            results = await asyncio.wait_for(
+                asyncio.gather(
+                    client.send_request({"i": 0}),
+                    client.send_request({"i": 1}),
+                    return_exceptions=True,
+                ),
+                5,
+            )
+            assert [type(r) for r in results] == [ValueError, ValueError]
+            # 连接已关闭，后续请求立即失败
+            with pytest.raises((ConnectionError, OSError)):
+                await asyncio.wait_for(client.send_request({"i": 2}), 5)
+
+    try:
+        asyncio.run(main())
+    finally:
+        server.stop()
+        thread.join(10)
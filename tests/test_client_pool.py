@@ -0,0 +1,81 @@
+"""IPCClientPool 在后台替换退出的进程，分发请求的线程不等待新进程启动，也不会收到启动错误"""
+
+import os
+import sys
+import time
+
+import pytest
+
+from my_ipc.ipc_client_pool import IPCClientPool
+from my_ipc.ipc_server import IPCServer
+
+
+class PidServer(IPCServer):
+    def handle_request(self, request, tmp_shm):
+        if request.get("die"):
+            os._exit(3)
+        return {"pid": os.getpid()}
+
+
+@pytest.fixture(autouse=True)
+def pythonpath(monkeypatch):
+    # 服务器进程需要导入 my_ipc 和本文件
+    src = os.path.join(os.path.dirname(__file__), "..", "src")
+    paths = [os.path.abspath(src), os.path.dirname(os.path.abspath(__file__))]
+    monkeypatch.setenv("PYTHONPATH", os.pathsep.join(paths))
+
+
+SERVER_CMD = f"{sys.executable} -m test_client_pool {{id}}"
+
+
+def kill_one(pool):
+    with pytest.raises(ConnectionError):
+        pool.send_request({"die": True})
+
+
+def test_dead_worker_replaced_in_background():
+    started = []
+
+    def on_worker_started(client):
+        started.append(client)
+        if len(started) > 2:
+            # 替换的进程启动很慢
+            time.sleep(2)
+
+    with IPCClientPool(
+        SERVER_CMD, 2, strategy="round_robin", on_worker_started=on_worker_started
+    ) as pool:
+        kill_one(pool)
+        start = time.monotonic()
+        pids = {pool.send_request({})["pid"] for _ in range(10)}
+        assert time.monotonic() - start < 1
+        assert len(pids) == 1
+        assert pool.check_health(wait=True) >= 1
+        assert len({pool.send_request({})["pid"] for _ in range(10)}) == 2
+
+
+def test_replacement_errors_not_raised_to_callers():
+    started = []
+
+    def on_worker_started(client):
+        started.append(client)
+        if len(started) > 2:
+            raise RuntimeError("启动失败")
+
+    with IPCClientPool(
+        SERVER_CMD, 2, on_worker_started=on_worker_started, health_check_interval=0.1
+    ) as pool:
+        kill_one(pool)
+        pool.check_health(wait=True)
+        assert len(started) == 3
+        # 替换失败的进程被跳过，之后按 health_check_interval 重试
+        deadline = time.monotonic() + 10
+        while len(started) == 3:
+            assert time.monotonic() < deadline, "替换失败后没有重试"
+            pool.send_request({})
+            time.sleep(0.02)
+        assert sum(w.client.is_alive() for w in pool.workers) == 1
+
+
+if __name__ == "__main__":
+    PidServer(sys.argv[1]).start_server()
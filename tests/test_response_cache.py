@@ -0,0 +1,33 @@
+"""ResponseCache 的磁盘缓存：clear 只删除自己写入的文件，总字节数不超过 max_disk_bytes"""
+
+import os
+import time
+
+from my_ipc.ipc_client_cache import ResponseCache, request_key
+
+
+def test_clear_keeps_unrelated_files(tmp_path):
+    (tmp_path / "notes.txt").write_text("keep")
+    cache = ResponseCache(disk_dir=str(tmp_path))
+    key = request_key({"a": 1})
+    cache.put(key, {"x": 1})
+    assert ResponseCache(disk_dir=str(tmp_path)).get(key) == (True, {"x": 1})
+    cache.clear()
+    assert sorted(os.listdir(tmp_path)) == ["notes.txt"]
+    assert cache.get(key) == (False, None)
+
+
+def test_disk_evicts_oldest(tmp_path):
+    cache = ResponseCache(disk_dir=str(tmp_path), max_disk_bytes=3500)
+    keys = [request_key({"i": i}) for i in range(5)]
+    for i, key in enumerate(keys):
+        cache.put(key, bytes(1000))
+        # 修改时间依次递增，使淘汰顺序确定
+        mtime = time.time() - 100 + i
+        os.utime(cache._disk_path(key), (mtime, mtime))
+    sizes = [os.path.getsize(tmp_path / name) for name in os.listdir(tmp_path)]
+    assert sum(sizes) <= 3500
+    # 新实例的内存中没有缓存，只从磁盘读取
+    fresh = ResponseCache(disk_dir=str(tmp_path), max_disk_bytes=3500)
+    assert not fresh.get(keys[0])[0]
+    assert fresh.get(keys[-1]) == (True, bytes(1000))
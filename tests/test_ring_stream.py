@@ -0,0 +1,65 @@
+"""经过环形缓冲区的流被客户端取消后，服务器停止生成器"""
+
+import os
+import threading
+import time
+import uuid
+
+import pytest
+
+from my_ipc.ipc_client import IPCClient
+from my_ipc.ipc_server import IPCServer
+
+
+class CountingServer(IPCServer):
+    def __init__(self, id, **kwargs):
+        super().__init__(id, **kwargs)
+        self.produced = 0
+        self.stopped = threading.Event()
+
+    def handle_request(self, request, tmp_shm):
+        return {"produced": self.produced}
+
+    def handle_stream_request(self, request):
+        try:
+            while True:
+                self.produced += 1
+                yield {"i": self.produced}
+                # 生成得比较慢，环形缓冲区不会被写满
+                time.sleep(0.01)
+        finally:
+            self.stopped.set()
+
+
+@pytest.fixture
+def server():
+    server = CountingServer(uuid.uuid4().hex)
+    thread = threading.Thread(
+        target=server.start_server,
+        kwargs={"max_clients": None, "exit_when_idle": False},
+        daemon=True,
+    )
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not os.path.exists(server.socket_path):
+        assert time.monotonic() < deadline, "服务器没有开始监听"
+        time.sleep(0.01)
+    yield server
+    server.stop()
+    thread.join(10)
+
+
+def test_cancel_ring_stream(server):
+    client = IPCClient(None, server_id=server.id)
+    try:
+        responses = client.send_stream_request({}, ring_bytes=1 << 20)
+        assert [next(responses)["i"] for _ in range(5)] == [1, 2, 3, 4, 5]
+        responses.close()
+        assert server.stopped.wait(5), "取消后生成器没有停止"
+        produced = server.produced
+        time.sleep(0.1)
+        assert server.produced == produced
+        # 连接仍然可用
+        assert client.send_request({}) == {"produced": produced}
+    finally:
+        client.close()
@@ -0,0 +1,131 @@
+"""出错时（例如请求或响应无法编码）只有该请求失败，释放它占用的资源，连接继续服务后续请求"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+import pytest
+
+from my_ipc.ipc_client import IPCClient
+from my_ipc.ipc_server import IPCServer
+from my_ipc.ipc_server_async import AsyncIPCServer
+from my_ipc.public import ShmArrayInfo
+
+
+class FaultyServer(IPCServer):
+    def handle_request(self, request, tmp_shm):
+        if request.get("bad"):
+            # 任何编解码器都无法编码
+            return {"lock": threading.Lock()}
+        return {"ok": request["i"]}
+
+
+def start(server):
+    thread = threading.Thread(
+        target=server.start_server,
+        kwargs={"max_clients": None, "exit_when_idle": False},
+        daemon=True,
+    )
+    thread.start()
+    deadline = time.monotonic() + 10
+    while server.address.endswith(":0"):
+        assert time.monotonic() < deadline, "服务器没有开始监听"
+        time.sleep(0.01)
+    return thread
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def serve(server):
+        servers.append((server, start(server)))
+        return IPCClient(None, address=server.address)
+
+    yield serve
+    for server, thread in servers:
+        server.stop()
+        thread.join(10)
+
+
+def test_batch_unencodable_response(serve):
+    server = FaultyServer("batch_errors", address="127.0.0.1:0", max_batch_size=4)
+    client = serve(server)
+    try:
+        with pytest.raises(RuntimeError):
+            client.submit({"bad": True}).result(timeout=5)
+        futures = [client.submit({"i": i}) for i in range(8)]
+        assert [f.result(timeout=5) for f in futures] == [{"ok": i} for i in range(8)]
+        assert server.batcher._thread.is_alive()
+    finally:
+        client.close()
+
+
+@pytest.mark.parametrize("max_concurrency", [None, 2])
+@pytest.mark.parametrize("executor", [False, True])
+def test_unencodable_response(serve, executor, max_concurrency):
+    kwargs = {"executor": ThreadPoolExecutor(2)} if executor else {}
+    client = serve(
+        FaultyServer(
+            "response_errors",
+            address="127.0.0.1:0",
+            max_concurrency=max_concurrency,
+            **kwargs,
+        )
+    )
+    try:
+        with pytest.raises(RuntimeError):
+            client.submit({"bad": True}).result(timeout=5)
+        # 连接仍然可用
+        assert client.send_request({"i": 1}) == {"ok": 1}
+    finally:
+        client.close()
+
+
+class AsyncFaultyServer(AsyncIPCServer):
+    async def handle_request(self, request, tmp_shm):
+        return FaultyServer.handle_request(self, request, tmp_shm)
+
+
+def start_local(server, **kwargs):
+    """在线程中启动监听 Unix socket 的服务器"""
+    thread = threading.Thread(target=server.start_server, kwargs=kwargs, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 10
+    while not os.path.exists(server.socket_path):
+        assert time.monotonic() < deadline, "服务器没有开始监听"
+        time.sleep(0.01)
+    return thread
+
+
+def test_async_unencodable_response():
+    server = AsyncFaultyServer(uuid.uuid4().hex)
+    thread = start_local(server)
+    client = IPCClient(None, server_id=server.id)
+    try:
+        with pytest.raises(RuntimeError):
+            client.submit({"bad": True}).result(timeout=5)
+        assert client.send_request({"i": 2}) == {"ok": 2}
+    finally:
+        client.close()
+        thread.join(10)
+
+
+def test_unencodable_request_released():
+    server = FaultyServer(uuid.uuid4().hex)
+    thread = start_local(server, max_clients=None, exit_when_idle=False)
+    client = IPCClient(None, server_id=server.id)
+    try:
+        with pytest.raises(TypeError):
+            client.submit({"lock": threading.Lock()}, tmp_shm=ShmArrayInfo((4,), np.int32))
+        # 请求没有发出：不再等待它的响应，tmp_shm 使用的段回到池中
+        assert not client.pending._waiters
+        assert client.tmp_shm_pool.free_bytes > 0
+        assert client.send_request({"i": 3}) == {"ok": 3}
+    finally:
+        client.close()
+        server.stop()
+        thread.join(10)
@@ -0,0 +1,116 @@
+"""IPCServer 与 IPCClient 通过 TCP 回环地址通信，处理函数与 Unix socket 时相同"""
+
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from my_ipc.ipc_client import IPCClient
+from my_ipc.ipc_server import IPCServer
+from my_ipc.public import ShmArrayInfo
+
+
+class EchoServer(IPCServer):
+    def handle_request(self, request, tmp_shm):
+        op = request.get("op")
+        if tmp_shm is not None:
+            tmp_shm.write(np.full(tmp_shm.info.shape, request["fill"], tmp_shm.info.dtype))
+        if op == "sum":
+            return {"sum": float(self.get_shared_array(request["name"]).read().sum())}
+        if op == "double":
+            return {"x": request["x"] * 2}
+        return {"echo": request}
+
+    def handle_stream_request(self, request):
+        for i in range(request["n"]):
+            yield {"i": i, "a": np.full(1000, i, np.uint8)}
+
+
+@pytest.fixture(scope="module")
+def address():
+    server = EchoServer("tcp_loopback", address="127.0.0.1:0")
+    thread = threading.Thread(
+        target=server.start_server,
+        kwargs={"max_clients": None, "exit_when_idle": False},
+        daemon=True,
+    )
+    thread.start()
+    # 端口为 0，开始监听后 address 变为系统分配的端口
+    deadline = time.monotonic() + 10
+    while server.address.endswith(":0"):
+        assert time.monotonic() < deadline, "服务器没有开始监听"
+        time.sleep(0.01)
+    yield server.address
+    server.stop()
+    thread.join(10)
+
+
+@pytest.fixture
+def client(address):
+    client = IPCClient(None, address=address)
+    yield client
+    client.close()
+
+
+def test_request(client):
+    assert client.remote
+    assert client.send_request({"a": 1}) == {"echo": {"a": 1}}
+    futures = [client.submit({"i": i}) for i in range(10)]
+    assert [f.result() for f in futures] == [{"echo": {"i": i}} for i in range(10)]
+
+
+def test_tmp_shm_inline(client):
+    response, arr = client.send_request(
+        {"fill": 3}, tmp_shm=ShmArrayInfo((4, 4), np.int32)
+    )
+    assert response == {"echo": {"fill": 3}}
+    assert arr.dtype == np.int32
+    assert arr.shape == (4, 4)
+    assert (arr == 3).all()
+
+
+def test_ndarray_payload(client):
+    x = np.arange(10, dtype=np.float32)
+    np.testing.assert_array_equal(client.send_request({"op": "double", "x": x})["x"], x * 2)
+    # 超过共享内存阈值的数组同样随消息传输
+    big = np.ones(1 << 20, np.float64)
+    np.testing.assert_array_equal(client.send_request({"op": "double", "x": big})["x"], big * 2)
+
+
+def test_shared_arrays(address):
+    client = IPCClient(
+        None, address=address, shm_arrs={"default": ShmArrayInfo((1000,), np.float64)}
+    )
+    try:
+        arr = client.get_shared_array()
+        assert client.send_request({"op": "sum", "name": "default"}) == {"sum": 0.0}
+        arr.write(np.ones(1000))
+        assert client.send_request({"op": "sum", "name": "default"}) == {"sum": 1000.0}
+        arr.write(np.full(1000, 2.0))
+        assert client.send_request({"op": "sum", "name": "default"}) == {"sum": 2000.0}
+        # 绕过 write 修改后用 mark_dirty 标记
+        view = np.ndarray((1000,), np.float64, buffer=arr.shm.buf)
+        view[:10] = 0
+        del view
+        arr.mark_dirty(0, 80)
+        assert client.send_request({"op": "sum", "name": "default"}) == {"sum": 1980.0}
+    finally:
+        client.close()
+
+
+def test_registered_shared_array(client):
+    client.register_shared_array("y", ShmArrayInfo((10,), np.int64))
+    client.get_shared_array("y").write(np.arange(10))
+    assert client.send_request({"op": "sum", "name": "y"}) == {"sum": 45.0}
+    client.resize_shared_array("y", ShmArrayInfo((100000,), np.int64))
+    client.get_shared_array("y").write(np.ones(100000, np.int64))
+    assert client.send_request({"op": "sum", "name": "y"}) == {"sum": 100000.0}
+    client.unregister_shared_array("y")
+    assert "y" not in client.shm_arrs
+
+
+def test_stream_falls_back_to_socket(client):
+    items = list(client.send_stream_request({"n": 4}, ring_bytes=1 << 20))
+    assert [item["i"] for item in items] == [0, 1, 2, 3]
+    assert all((item["a"] == item["i"]).all() for item in items)